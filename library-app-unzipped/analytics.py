@@ -0,0 +1,181 @@
+"""Circulation analytics, kept in rollup tables by a batch job: ``python
+analytics.py`` (from cron, or with --every to keep running).
+
+The rollups (see create_db.add_analytics) are
+
+- ``analytics_days``: borrows, returns, total loan time and late returns per
+  UTC day and department, borrows counted on the day they were made and
+  returns on the day they came back;
+- ``analytics_book_months`` and ``analytics_books``: borrows per book per
+  month and in all, each with an index in borrows order for the top books;
+- ``analytics_departments``: copies owned and on loan per department, for
+  utilization. Triggers on books keep the copies on the shelf in it (see
+  create_db.add_analytics_department_copies), and the borrows and returns
+  below move copies between the shelf and on loan.
+
+Like fines.py, a run picks up after the checkpoints the previous one left
+(see batch.py), one for new borrows (along ``idx_borrows_ts``) and one for
+new returns (along ``idx_borrows_returned``), so it reads what changed
+since then and not the whole history. Each chunk of ANALYTICS_CHUNK borrows is one write
+transaction: a few INSERT ... SELECT ... GROUP BY statements add its counts
+to the rollups, and the checkpoint moves in the same commit.
+
+``report`` reads the rollups for /admin/analytics. Every query it makes is
+a keyed range over a rollup table, so it takes the same few milliseconds
+however many borrows there are.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+import batch
+import create_db
+import db as db_pool
+
+# the most months the page and JSON list in one response
+MAX_MONTHS = 60
+
+
+def env_config():
+    """Default analytics settings, overridable through LIB_ANALYTICS_* environment variables."""
+    return {
+        # borrows per write transaction, and seconds between transactions
+        'ANALYTICS_CHUNK': int(os.environ.get('LIB_ANALYTICS_CHUNK', 5000)),
+        'ANALYTICS_PAUSE': float(os.environ.get('LIB_ANALYTICS_PAUSE', 0.05)),
+    }
+
+
+# name -> (key column, the borrows the source covers, the statements adding a
+# chunk of them to the rollups). {where} selects the chunk from borrows br.
+SOURCES = {
+    'analytics_borrowed': ('borrowed_ts', 'br.borrowed_ts IS NOT NULL', (
+        '''INSERT INTO analytics_days (day, department, borrows)
+        SELECT date(br.borrowed_ts, 'unixepoch'), COALESCE(b.department, ''), COUNT(*)
+        FROM borrows br LEFT JOIN books b ON b.id = br.book_id WHERE {where} GROUP BY 1, 2
+        ON CONFLICT (day, department) DO UPDATE SET borrows = borrows + excluded.borrows''',
+        '''INSERT INTO analytics_book_months (month, book_id, borrows)
+        SELECT strftime('%Y-%m', br.borrowed_ts, 'unixepoch'), br.book_id, COUNT(*)
+        FROM borrows br WHERE {where} GROUP BY 1, 2
+        ON CONFLICT (month, book_id) DO UPDATE SET borrows = borrows + excluded.borrows''',
+        '''INSERT INTO analytics_books (book_id, borrows)
+        SELECT br.book_id, COUNT(*) FROM borrows br WHERE {where} GROUP BY 1
+        ON CONFLICT (book_id) DO UPDATE SET borrows = borrows + excluded.borrows''',
+        # a copy out on loan is still owned: triggers took it off the shelf count
+        '''INSERT INTO analytics_departments (department, copies, on_loan)
+        SELECT COALESCE(b.department, ''), COUNT(*), COUNT(*)
+        FROM borrows br LEFT JOIN books b ON b.id = br.book_id WHERE {where} GROUP BY 1
+        ON CONFLICT (department) DO UPDATE SET copies = copies + excluded.copies, on_loan = on_loan + excluded.on_loan''',
+    )),
+    'analytics_returned': ('returned_ts', 'br.returned_ts IS NOT NULL', (
+        '''INSERT INTO analytics_days (day, department, returns, loan_seconds, late_returns)
+        SELECT date(br.returned_ts, 'unixepoch'), COALESCE(b.department, ''), COUNT(*),
+               SUM(br.returned_ts - br.borrowed_ts), SUM(br.returned_ts > br.due_ts)
+        FROM borrows br LEFT JOIN books b ON b.id = br.book_id WHERE {where} GROUP BY 1, 2
+        ON CONFLICT (day, department) DO UPDATE SET returns = returns + excluded.returns,
+            loan_seconds = loan_seconds + excluded.loan_seconds, late_returns = late_returns + excluded.late_returns''',
+        '''INSERT INTO analytics_departments (department, copies, on_loan)
+        SELECT COALESCE(b.department, ''), -COUNT(*), -COUNT(*)
+        FROM borrows br LEFT JOIN books b ON b.id = br.book_id WHERE {where} GROUP BY 1
+        ON CONFLICT (department) DO UPDATE SET copies = copies + excluded.copies, on_loan = on_loan + excluded.on_loan''',
+    )),
+}
+
+
+def run_chunk(conn, config, name, bound):
+    """Add the next chunk of source ``name``, up to keys in second ``bound``,
+    to the rollups and move its checkpoint past it, in one transaction.
+
+    Returns (borrows added, whether the source is done up to ``bound``).
+    """
+    key, covers, statements = SOURCES[name]
+
+    def write(where, params):
+        added = conn.execute(f'SELECT COUNT(*) FROM borrows br WHERE {where}', params).fetchone()[0]
+        if added:
+            for sql in statements:
+                conn.execute(sql.format(where=where), params)
+        return added
+    return batch.run_chunk(conn, name, key, covers, config['ANALYTICS_CHUNK'], bound, write)
+
+
+def run(conn, config, now=None):
+    """Catch the rollups up with the borrow history; returns {source name:
+    borrows added}.
+
+    ``conn`` must be in autocommit mode (``isolation_level=None``).
+    """
+    now = int(time.time()) if now is None else now
+    bound = now - batch.SETTLE_SECONDS
+    totals = batch.catch_up(SOURCES, lambda name: run_chunk(conn, config, name, bound), config['ANALYTICS_PAUSE'])
+    # the stamp pages key on
+    conn.execute("UPDATE meta SET value = ? WHERE key = 'analytics_ts'", (bound,))
+    return totals
+
+
+def month_of(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m')
+
+
+def months_back(month, n):
+    """The month ``n`` months before 'YYYY-MM' ``month``."""
+    year, m = map(int, month.split('-'))
+    i = year * 12 + m - 1 - n
+    return f'{i // 12:04d}-{i % 12 + 1:02d}'
+
+
+def report(db, month, months, top=10):
+    """The analytics for /admin/analytics: the ``months`` months up to and
+    including 'YYYY-MM' ``month`` per department, the ``top`` most borrowed
+    books in ``month`` and in all, and utilization per department now."""
+    first = months_back(month, months - 1)
+    rows = db.execute('''
+        SELECT substr(day, 1, 7) AS month, department, SUM(borrows) AS borrows, SUM(returns) AS returns,
+               SUM(loan_seconds) AS loan_seconds, SUM(late_returns) AS late_returns
+        FROM analytics_days WHERE day >= ? AND day < ?
+        GROUP BY 1, 2 ORDER BY 1 DESC, 2
+    ''', (first + '-01', months_back(month, -1) + '-01')).fetchall()
+    by_month = [{'month': r['month'], 'department': r['department'], 'borrows': r['borrows'],
+                 'returns': r['returns'], 'late_returns': r['late_returns'],
+                 'average_loan_days': round(r['loan_seconds'] / r['returns'] / 86400, 1) if r['returns'] else None}
+                for r in rows]
+    top_month = [dict(r) for r in db.execute('''
+        SELECT a.book_id, b.title, a.borrows FROM analytics_book_months a LEFT JOIN books b ON b.id = a.book_id
+        WHERE a.month = ? ORDER BY a.borrows DESC, a.book_id LIMIT ?
+    ''', (month, top))]
+    top_all = [dict(r) for r in db.execute('''
+        SELECT a.book_id, b.title, a.borrows FROM analytics_books a LEFT JOIN books b ON b.id = a.book_id
+        ORDER BY a.borrows DESC, a.book_id LIMIT ?
+    ''', (top,))]
+    departments = [{'department': r['department'], 'copies': r['copies'], 'on_loan': r['on_loan'],
+                    'utilization': round(r['on_loan'] / r['copies'], 3) if r['copies'] else None}
+                   # a department emptied by catalogue edits keeps its row, at zero
+                   for r in db.execute('SELECT department, copies, on_loan FROM analytics_departments'
+                                       ' WHERE copies != 0 OR on_loan != 0 ORDER BY department')]
+    return {'month': month, 'months': months, 'by_month': by_month, 'top_books_month': top_month,
+            'top_books': top_all, 'departments': departments}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Add the borrows and returns since the last run to the analytics rollups.')
+    parser.add_argument('--every', type=float, help='keep running, starting a run this many seconds after the last')
+    parser.add_argument('--chunk', type=int, help='borrows per write transaction (LIB_ANALYTICS_CHUNK)')
+    parser.add_argument('--pause', type=float, help='seconds between transactions (LIB_ANALYTICS_PAUSE)')
+    args = parser.parse_args(argv)
+
+    config = dict(db_pool.env_config(), **env_config())
+    if args.chunk:
+        config['ANALYTICS_CHUNK'] = args.chunk
+    if args.pause is not None:
+        config['ANALYTICS_PAUSE'] = args.pause
+    conn = db_pool.connect(os.environ.get('LIB_DB_PATH') or create_db.DB_PATH, config)
+    conn.isolation_level = None
+
+    def once():
+        totals = run(conn, config)
+        return f"{totals['analytics_borrowed']} borrows, {totals['analytics_returned']} returns"
+    return batch.repeat('analytics', args.every, once)
+
+if __name__ == '__main__':
+    sys.exit(main())
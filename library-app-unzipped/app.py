@@ -1,15 +1,39 @@
-from flask import Flask, render_template, request, jsonify, g, session, redirect, url_for, flash
+from flask import Flask, render_template, stream_template, request, jsonify, g, session, redirect, url_for, flash, get_flashed_messages, Response, make_response, stream_with_context
 import sqlite3
 import os
+import re
+import json
+import base64
+import csv
+import io
+import hashlib
+import random
+import time
 import functools
-from werkzeug.security import generate_password_hash, check_password_hash
+import threading
 from flask_wtf import CSRFProtect
-from datetime import datetime
+from flask_wtf.csrf import generate_csrf
+from datetime import datetime, timedelta, timezone
+
+import analytics
+import ask
+import cache
+import catalog_io
+import create_db
+import db as db_pool
+import fines
+import fuzzy
+import hashing
+import holds
+import metrics
+import recs
+import replica
 
 BASE_DIR = os.path.dirname(__file__)
-DB_PATH = os.path.join(BASE_DIR, 'instance', 'library.db')
 
 app = Flask(__name__, template_folder=os.path.join(BASE_DIR, 'templates'), static_folder=os.path.join(BASE_DIR, 'static'))
+# the database: a file, or db.memory_path(name) for one in memory; see create_app
+app.config['DB_PATH'] = os.environ.get('LIB_DB_PATH') or os.path.join(BASE_DIR, 'instance', 'library.db')
 app.secret_key = os.environ.get('LIB_APP_SECRET', 'dev-secret-change-me')
 # Simple admin password (use env var in production)
 # Default changed to rahul@123 for convenience; override with env var LIB_ADMIN_PASS
@@ -17,6 +41,80 @@ ADMIN_PASSWORD = os.environ.get('LIB_ADMIN_PASS', 'rahul@123')
 # enable CSRF protection for all POST/PUT/DELETE requests
 csrf = CSRFProtect()
 csrf.init_app(app)
+# /api/search page sizes; larger result sets are paged with next_cursor or sent with stream=1
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# a first page with fewer text matches than this is filled up with close spellings
+FUZZY_MIN_RESULTS = 5
+# "also borrowed" books listed per search result and per borrow on the dashboard
+ALSO_BORROWED = 3
+# books one /api/availability or /api/borrow request may name
+BATCH_LIMIT = 100
+# books listed per /api/ask answer
+ASK_RESULTS = 5
+MAX_ASK_RESULTS = 20
+# search result cache (see cache.env_config for the LIB_SEARCH_CACHE_* env vars)
+app.config.from_mapping(cache.env_config())
+search_cache = cache.SearchCache(cache.MemoryBackend(app.config['SEARCH_CACHE_SIZE'], app.config['SEARCH_CACHE_TTL']))
+# /admin/export formats
+EXPORT_TYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+# open borrows allowed per student
+BORROW_LIMIT = 3
+# a borrow is due back this long after it is taken out
+LOAN_PERIOD_DAYS = 14
+BORROW_STATUSES = ('all', 'active', 'overdue', 'returned')
+# connection pool and pragma settings (see db.env_config for the LIB_DB_* env vars)
+app.config.from_mapping(db_pool.env_config())
+# password hashing process pool (see hashing.env_config for the LIB_HASH_* env vars)
+app.config.from_mapping(hashing.env_config())
+hasher = hashing.Hasher.from_config(app.config)
+# /metrics and the sampling profiler (see metrics.env_config for the LIB_METRICS_* / LIB_PROFILE_* env vars)
+app.config.from_mapping(metrics.env_config())
+# local read replica for searches (see replica.env_config for the LIB_REPLICA_* env vars)
+app.config.from_mapping(replica.env_config())
+# fine amounts and the fines batch job (see fines.env_config for the LIB_FINE_* / LIB_FINES_* env vars)
+app.config.from_mapping(fines.env_config())
+# hold queues and /student/events (see holds.env_config for the LIB_HOLD_* env vars)
+app.config.from_mapping(holds.env_config())
+# "also borrowed" recommendations built by recs.py (see recs.env_config for the LIB_RECS_* env vars)
+app.config.from_mapping(recs.env_config())
+# the /api/ask index (see ask.env_config for the LIB_ASK_* env vars)
+app.config.from_mapping(ask.env_config())
+# the analytics batch job (see analytics.env_config for the LIB_ANALYTICS_* env vars)
+app.config.from_mapping(analytics.env_config())
+hold_notifier = holds.Notifier(lambda: database_pool(readonly=True),
+                               app.config['HOLD_EVENTS_POLL'], expire=lambda: expire_lapsed_holds())
+app_metrics = metrics.Metrics()
+app_metrics.collectors['library_search_cache'] = lambda: search_cache.stats()
+app_metrics.collectors['library_password_hashing'] = lambda: hasher.stats()
+metrics.init_app(app, app_metrics)
+# writes wait DB_BUSY_TIMEOUT for the lock, then the transaction is retried
+WRITE_RETRIES = 5
+WRITE_RETRY_DELAY = 0.05
+
+# static files are linked as /static/<file>?v=<content hash>, so a fingerprinted
+# URL never changes content and browsers may keep it for a year
+ASSET_MAX_AGE = 365 * 24 * 3600
+_asset_hashes = {}
+
+
+@app.template_global()
+def asset_url(filename):
+    path = os.path.join(app.static_folder, filename)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _asset_hashes.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = _asset_hashes[filename] = (mtime, hashlib.md5(f.read()).hexdigest()[:12])
+    return url_for('static', filename=filename, v=cached[1])
+
+
+@app.after_request
+def cache_static_assets(response):
+    if request.endpoint == 'static' and request.args.get('v') and response.status_code in (200, 304):
+        response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+    return response
+
 
 def admin_required(view):
     @functools.wraps(view)
@@ -35,55 +133,559 @@ def login_required(view):
         return view(*args, **kwargs)
     return wrapped
 
+def create_app(config=None):
+    """Point the app at a database and settings and return it.
+
+    ``config`` overrides app.config, e.g. ``{'DB_PATH': db.memory_path('t')}``
+    for a database that lives in memory. Nothing is opened here: the first
+    request to use the database fills it from create_db's template when it is
+    new (see database_pool).
+
+    This configures the module's ``app`` rather than building another: the
+    routes are registered on it, so there is one app per process, and
+    ``gunicorn app:app`` uses it as configured from the environment. The
+    search cache, the password hasher and the hold notifier's poll are
+    rebuilt from the new settings; the metrics hooks are registered at
+    import, so METRICS_ENABLED only takes effect from LIB_METRICS_ENABLED.
+    """
+    global search_cache, hasher
+    app.config.update(config or {})
+    search_cache = cache.SearchCache(cache.MemoryBackend(app.config['SEARCH_CACHE_SIZE'], app.config['SEARCH_CACHE_TTL']))
+    hasher.close()
+    hasher = hashing.Hasher.from_config(app.config)
+    hold_notifier.poll = app.config['HOLD_EVENTS_POLL']
+    return app
+
+
+def database_pool(readonly=False):
+    # the first use of a database in this process copies the template into it
+    # when it has no tables yet, instead of needing create_db.py first
+    return db_pool.get_pool(app.config['DB_PATH'], app.config, readonly, init=create_db.init_database)
+
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-        db = g._database = sqlite3.connect(DB_PATH)
-        db.row_factory = sqlite3.Row
-    return db
+        path = app.config['DB_PATH']
+        if not db_pool.is_memory(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = g._database = database_pool().acquire()
+    return metrics.track(db)
+
+
+def get_read_db():
+    # read-only connection for routes that never write; with WAL these neither
+    # block nor are blocked by the borrow/return writers
+    db = getattr(g, '_read_database', None)
+    if db is None:
+        db = g._read_database = database_pool(readonly=True).acquire()
+    return metrics.track(db)
+
+
+def get_catalog_db():
+    # catalogue searches read the local replica while it is no more than
+    # REPLICA_MAX_LAG seconds behind the primary (see replica.py)
+    path = app.config['REPLICA_PATH']
+    if not path:
+        return get_read_db()
+    db = getattr(g, '_catalog_database', None)
+    if db is None:
+        try:
+            db = g._catalog_database = db_pool.get_pool(path, app.config, readonly=True).acquire()
+        except sqlite3.OperationalError:
+            # not restored yet
+            return get_read_db()
+    if not replica.fresh(db, app.config['REPLICA_MAX_LAG']):
+        return get_read_db()
+    return metrics.track(db)
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
+    if db is not None:
+        database_pool().release(db)
+    db = g.pop('_read_database', None)
+    if db is not None:
+        database_pool(readonly=True).release(db)
+    db = g.pop('_catalog_database', None)
     if db is not None:
-        db.close()
+        db_pool.get_pool(app.config['REPLICA_PATH'], app.config, readonly=True).release(db)
+
+
+class WriteRefused(Exception):
+    """Raised inside run_write to roll the transaction back; carries the flash message
+    and the endpoint to redirect to."""
+
+    def __init__(self, message, endpoint):
+        super().__init__(message)
+        self.message = message
+        self.endpoint = endpoint
+
+
+def run_write(db, work):
+    """Run ``work(db)`` in a short ``BEGIN IMMEDIATE`` transaction and commit it.
+
+    Taking the write lock up front means two workers can never interleave a
+    read-check-write sequence. If another worker holds the lock past the busy
+    timeout, the whole transaction is retried a bounded number of times with
+    jittered backoff before the error is raised.
+    """
+    for attempt in range(WRITE_RETRIES):
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                result = work(db)
+                db.commit()
+            except BaseException:
+                db.rollback()
+                raise
+            return result
+        except sqlite3.OperationalError as e:
+            if ('locked' not in str(e) and 'busy' not in str(e)) or attempt == WRITE_RETRIES - 1:
+                raise
+            time.sleep(WRITE_RETRY_DELAY * (2 ** attempt) * (0.5 + random.random()))
+
+
+def active_borrow_count(db, student_id):
+    # maintained alongside every borrow/return; see create_db.repair_active_borrows
+    row = db.execute('SELECT active_borrows FROM students WHERE id = ?', (student_id,)).fetchone()
+    return row['active_borrows'] if row else 0
+
+
+def utc_now():
+    """The current UTC time as (ISO text for the *_at columns, epoch seconds for *_ts)."""
+    now = datetime.now(timezone.utc)
+    return now.replace(tzinfo=None).isoformat(), int(now.timestamp())
+
+
+def expire_holds(db, now):
+    # run at the start of every write that touches holds or copies, so a copy
+    # nobody collected moves on to the next in line
+    return holds.expire(db, now, int(app.config['HOLD_PICKUP_DAYS'] * 86400))
+
+
+def expire_lapsed_holds():
+    # the hold notifier's pass, for quiet periods with no write to run
+    # expire_holds; the write lock is taken only when the probe finds a hold
+    now = utc_now()[1]
+    pool = database_pool(readonly=True)
+    conn = pool.acquire()
+    try:
+        if not holds.lapsed(conn, now, int(app.config['HOLD_PICKUP_DAYS'] * 86400)):
+            return 0
+    finally:
+        pool.release(conn)
+    pool = database_pool()
+    db = pool.acquire()
+    try:
+        return run_write(db, lambda db: expire_holds(db, now))
+    finally:
+        pool.release(db)
+
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def fts_query(q):
+    # quote every term so FTS5 syntax in user input is matched literally, and
+    # mark it as a prefix so partially typed words still find results
+    terms = re.findall(r'\w+', q)
+    return ' '.join('"%s"*' % t for t in terms)
+
+
+def encode_cursor(key, row_id):
+    raw = json.dumps([key, row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        key, row_id = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(row_id, int) or not isinstance(key, (str, int, float)):
+        return None
+    return key, row_id
+
+
+def iter_query(sql, params=(), connection=get_read_db):
+    # executed lazily: a streamed body runs after the view's app context has been
+    # torn down, so it has to query on the connection of its own context
+    for row in connection().execute(sql, params):
+        yield row
+
+
+def stream_json_results(rows):
+    # same envelope as a paged response, written one row at a time
+    yield '{"results": ['
+    for i, r in enumerate(rows):
+        book = dict(r)
+        book.pop('sort_key', None)
+        yield (',' if i else '') + json.dumps(book)
+    yield '], "next_cursor": null}'
+
+
+def parse_search_args(args):
+    """Normalize the /api/search arguments. Equivalent requests give equal results,
+    which is what the search cache keys on. Raises ValueError for a bad cursor."""
+    available = args.get('available', '').strip().lower()  # '1' or 'true'
+    min_year = args.get('min_year', '').strip()
+    max_year = args.get('max_year', '').strip()
+    # paging: results are ordered by (sort_key, id) and the cursor is the last pair sent
+    limit = args.get('limit', '').strip()
+    cursor = args.get('cursor', '').strip()
+    if cursor:
+        cursor = decode_cursor(cursor)
+        if cursor is None:
+            raise ValueError('Invalid cursor')
+    return {
+        # FTS matching ignores case and spacing, department filtering does not
+        'q': ' '.join(args.get('q', '').lower().split()),
+        'dept': args.get('dept', '').strip(),
+        'min_year': int(min_year) if min_year.isdigit() else None,
+        'max_year': int(max_year) if max_year.isdigit() else None,
+        'available': available in ('1', 'true', 'yes'),
+        'limit': min(int(limit), MAX_PAGE_SIZE) if limit.isdigit() and int(limit) > 0 else PAGE_SIZE,
+        'cursor': tuple(cursor) if cursor else None,
+        'stream': args.get('stream', '').strip().lower() in ('1', 'true', 'yes'),
+        # catalogue-wide counts per filter value alongside a page (not with stream=1)
+        'facets': args.get('facets', '').strip().lower() in ('1', 'true', 'yes'),
+    }
+
+
+def search_filters(s, params):
+    """The department/year/availability conditions on ``b`` as " AND ..." SQL,
+    appending their values to ``params``."""
+    sql = ''
+    if s['dept']:
+        sql += " AND b.department = ?"
+        params.append(s['dept'])
+    if s['min_year'] is not None:
+        sql += " AND b.year >= ?"
+        params.append(s['min_year'])
+    if s['max_year'] is not None:
+        sql += " AND b.year <= ?"
+        params.append(s['max_year'])
+    if s['available']:
+        sql += " AND b.copies > 0"
+    return sql
+
+
+def search_sql(s):
+    """SQL and parameters for a parsed search, ordered but without a LIMIT.
+    Returns (None, None) when the text query has nothing to match on."""
+    params = []
+    if s['q']:
+        match = fts_query(s['q'])
+        if not match:
+            return None, None
+        # sort by relevance, ranking title hits above author hits above isbn hits
+        sql = ("SELECT b.id, b.title, b.author, b.year, b.isbn, b.copies, b.department,"
+               " bm25(books_fts, 10.0, 5.0, 1.0) AS sort_key"
+               " FROM books_fts JOIN books b ON b.id = books_fts.rowid"
+               " WHERE books_fts MATCH ?")
+        params.append(match)
+    else:
+        sql = ("SELECT b.id, b.title, b.author, b.year, b.isbn, b.copies, b.department,"
+               " b.title AS sort_key FROM books b WHERE 1=1")
+    sql += search_filters(s, params)
+    sort_expr = "bm25(books_fts, 10.0, 5.0, 1.0)" if s['q'] else "b.title"
+    if s['cursor'] and not s['stream']:
+        sql += f" AND ({sort_expr}, b.id) > (?, ?)"
+        params.extend(s['cursor'])
+    sql += f" ORDER BY {sort_expr}, b.id"
+    return sql, params
+
+
+def search_page(db, s):
+    sql, params = search_sql(s)
+    if sql is None:
+        return {'results': [], 'next_cursor': None}
+    # fetch one extra row to know whether another page exists
+    rows = db.execute(sql + " LIMIT ?", params + [s['limit'] + 1]).fetchall()
+    next_cursor = None
+    if len(rows) > s['limit']:
+        rows = rows[:s['limit']]
+        next_cursor = encode_cursor(rows[-1]['sort_key'], rows[-1]['id'])
+    books = []
+    for r in rows:
+        book = dict(r)
+        del book['sort_key']
+        books.append(book)
+    page = {'results': books, 'next_cursor': next_cursor}
+    if s['q'] and not s['cursor'] and next_cursor is None and len(books) < FUZZY_MIN_RESULTS:
+        add_close_matches(db, s, page)
+    return page
+
+
+def add_close_matches(db, s, page):
+    """Fill up a page with few exact matches with books matching close spellings
+    of the query words, most similar first (see fuzzy.py)."""
+    match, found = fuzzy.fuzzy_match(db, re.findall(r'\w+', s['q']))
+    if match is None:
+        return
+    params = [match]
+    # no ORDER BY: FTS5 hands rows over in index order and stops at the LIMIT,
+    # where ranking every book with a common corrected word would not
+    sql = ("SELECT b.id, b.title, b.author, b.year, b.isbn, b.copies, b.department"
+           " FROM books_fts JOIN books b ON b.id = books_fts.rowid WHERE books_fts MATCH ?"
+           + search_filters(s, params) + " LIMIT ?")
+    seen = {b['id'] for b in page['results']}
+    rows = [r for r in db.execute(sql, params + [fuzzy.CANDIDATE_BOOKS]).fetchall() if r['id'] not in seen]
+    rows.sort(key=lambda r: (-fuzzy.score(r, found), r['title'], r['id']))
+    if rows:
+        page['results'] += [dict(r) for r in rows[:s['limit'] - len(page['results'])]]
+        page['fuzzy'] = True
+
+
+def facet_counts(db):
+    """{'department': {'CSE': n, ...}, 'decade': {'2010': n, ...}, 'available': {'1': n, '0': m}}
+    over the whole catalogue, from the trigger-maintained facet_counts table."""
+    facets = {'department': {}, 'decade': {}, 'available': {}}
+    for r in db.execute('SELECT facet, value, books FROM facet_counts WHERE books > 0'):
+        facets.setdefault(r['facet'], {})[str(r['value'])] = r['books']
+    return facets
+
+
+def recommendations():
+    """This worker's reader of the newest recs.py build, refreshed."""
+    reader = recs.get_reader(recs.directory(app.config['DB_PATH'], app.config))
+    reader.refresh()
+    return reader
+
+
+def also_borrowed(db, reader, book_ids, n):
+    """{book id: [{'id': ..., 'title': ...}, ...]}, the ``n`` books most often
+    borrowed together with each of ``book_ids``."""
+    picks = {b: [other for other, _ in reader.also_borrowed(b, n)] for b in book_ids}
+    wanted = sorted({other for others in picks.values() for other in others})
+    if not wanted:
+        return {b: [] for b in book_ids}
+    titles = dict(db.execute(f"SELECT id, title FROM books WHERE id IN ({','.join('?' * len(wanted))})",
+                             wanted).fetchall())
+    # books deleted since the build drop out
+    return {b: [{'id': o, 'title': titles[o]} for o in others if o in titles] for b, others in picks.items()}
+
+
+def catalog_version(db):
+    return db.execute("SELECT value FROM meta WHERE key = 'catalog_version'").fetchone()[0]
+
+
+def data_versions(db):
+    # {'catalog_version': n, 'borrow_version': m, ...}; bumped by triggers on every
+    # write, fine_version by fines.py and analytics_ts by analytics.py
+    return dict(db.execute("SELECT key, value FROM meta WHERE key IN ('catalog_version', 'borrow_version',"
+                           " 'hold_version', 'fine_version', 'analytics_ts')").fetchall())
+
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def page_etag(*parts):
+    """ETag for an HTML page rendered from the given version stamps.
+
+    Pages embed the session's CSRF token, so the tag covers the session's raw
+    token and also rolls over every half WTF_CSRF_TIME_LIMIT, before a cached
+    copy could be holding an expired token.
+    """
+    limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    period = int(time.time() // (limit / 2)) if limit else 0
+    return make_etag(request.endpoint, session.get('csrf_token'), period, *parts)
+
+
+def not_modified(etag, cache_control):
+    """A 304 response if the client already holds ``etag``, else None."""
+    # a page with pending flash messages has to be rendered to show them
+    if '_flashes' in session or not request.if_none_match.contains(etag):
+        return None
+    return tag_response(Response(status=304), etag, cache_control)
+
+
+def tag_response(response, etag, cache_control):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def cached_search(db, s, if_none_match):
+    """(etag, JSON body) for a parsed, non-streamed search; the body is None
+    when ``if_none_match`` already holds the etag. Shared with asgi.py."""
+    reader = recommendations()
+    key = (app.config['DB_PATH'], catalog_version(db), reader.generation) + tuple(s.values())
+    etag = make_etag(*key)
+    if if_none_match.contains(etag):
+        return etag, None
+    body = search_cache.get(key)
+    if body is None:
+        page = search_page(db, s)
+        picks = also_borrowed(db, reader, [b['id'] for b in page['results']], ALSO_BORROWED)
+        for book in page['results']:
+            book['also_borrowed'] = picks[book['id']]
+        if s['facets']:
+            # facet_counts changes only with books, which the catalog version already covers
+            page['facets'] = facet_counts(db)
+        body = json.dumps(page).encode()
+        search_cache.set(key, body)
+    return etag, body
+
+
 @app.route('/api/search')
 def api_search():
-    q = request.args.get('q', '').strip()
-    dept = request.args.get('dept', '').strip()
-    # expanded filters
-    min_year = request.args.get('min_year', '').strip()
-    max_year = request.args.get('max_year', '').strip()
-    available = request.args.get('available', '').strip().lower()  # '1' or 'true'
+    try:
+        s = parse_search_args(request.args)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    if s['stream']:
+        sql, params = search_sql(s)
+        rows = iter_query(sql, params, get_catalog_db) if sql else iter(())
+        return Response(stream_with_context(stream_json_results(rows)), mimetype='application/json')
+    etag, body = cached_search(get_catalog_db(), s, request.if_none_match)
+    # results are the same for every user, but must be revalidated on each use
+    if body is None:
+        return tag_response(Response(status=304), etag, 'public, no-cache')
+    return tag_response(Response(body, mimetype='application/json'), etag, 'public, no-cache')
+
+
+@app.route('/api/ask')
+def api_ask():
+    question = ' '.join(request.args.get('q', '').split())
+    if not question:
+        return jsonify(error='Ask a question with ?q='), 400
+    limit = request.args.get('limit', '').strip()
+    limit = min(int(limit), MAX_ASK_RESULTS) if limit.isdigit() and int(limit) > 0 else ASK_RESULTS
+    db = get_read_db()
+    # answers read nothing but books, copies included
+    etag = make_etag(app.config['DB_PATH'], catalog_version(db), question, limit)
+    if request.if_none_match.contains(etag):
+        return tag_response(Response(status=304), etag, 'public, no-cache')
+    try:
+        answer = ask.get_assistant(ask.directory(app.config['DB_PATH'], app.config), app.config).ask(db, question, limit)
+    except ask.NotIndexed as e:
+        # python ask.py has not built the first index yet
+        response = jsonify(error=str(e))
+        response.status_code = 503
+        response.headers['Retry-After'] = '60'
+        return response
+    return tag_response(jsonify(answer), etag, 'public, no-cache')
+
+
+def parse_batch(ids, isbns):
+    """``[('id', n) | ('isbn', s), ...]`` from the ids and ISBNs of a batch
+    request, in the order given. Raises ValueError for a bad list."""
+    if not isinstance(ids, list) or not isinstance(isbns, list):
+        raise ValueError('ids and isbns must be lists')
+    keys = []
+    for value in ids:
+        value = str(value).strip()
+        if not value.isdigit():
+            raise ValueError(f'Not a book id: {value!r}')
+        keys.append(('id', int(value)))
+    keys.extend(('isbn', str(value).strip()) for value in isbns if str(value).strip())
+    if not keys:
+        raise ValueError('Name at least one book in ids or isbns')
+    if len(keys) > BATCH_LIMIT:
+        raise ValueError(f'At most {BATCH_LIMIT} books per request')
+    return keys
+
+
+def find_books(db, keys):
+    """{key: books row} for the keys from parse_batch, looked up in one query
+    through the primary key and idx_books_isbn; an ISBN shared by several
+    books finds the oldest, as imports do."""
+    ids = json.dumps([v for k, v in keys if k == 'id'])
+    isbns = json.dumps([v for k, v in keys if k == 'isbn'])
+    rows = db.execute('''
+        SELECT 'id' AS k, id AS v, id, isbn, title, copies FROM books WHERE id IN (SELECT value FROM json_each(?))
+        UNION ALL
+        SELECT 'isbn', isbn, MIN(id), isbn, title, copies FROM books WHERE isbn IN (SELECT value FROM json_each(?))
+        GROUP BY isbn
+    ''', (ids, isbns)).fetchall()
+    return {(r['k'], r['v']): r for r in rows}
+
+
+def batch_item(key, book):
+    item = {key[0]: key[1], 'found': book is not None}
+    if book is not None:
+        item.update(book_id=book['id'], isbn=book['isbn'], title=book['title'])
+    return item
+
+
+def split_list(values):
+    return [v for value in values for v in value.split(',')]
+
+
+@app.route('/api/availability')
+def api_availability():
+    try:
+        keys = parse_batch(split_list(request.args.getlist('ids')), split_list(request.args.getlist('isbns')))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    db = get_read_db()
+    # copies change with every borrow and return, which also bump catalog_version
+    etag = make_etag(app.config['DB_PATH'], catalog_version(db), keys)
+    if request.if_none_match.contains(etag):
+        return tag_response(Response(status=304), etag, 'public, no-cache')
+    books = find_books(db, keys)
+    results = []
+    for key in keys:
+        item = batch_item(key, books.get(key))
+        if item['found']:
+            item.update(copies=books[key]['copies'], available=books[key]['copies'] > 0)
+        results.append(item)
+    return tag_response(jsonify(results=results), etag, 'public, no-cache')
+
+
+@app.route('/api/borrow', methods=['POST'])
+def api_borrow():
+    student_id = session.get('student_id')
+    if not student_id:
+        return jsonify(error='Log in as a student first'), 401
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify(error='Send a JSON object with ids and/or isbns'), 400
+    try:
+        keys = parse_batch(body.get('ids', []), body.get('isbns', []))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
     db = get_db()
-    params = []
-    sql = "SELECT id, title, author, year, isbn, copies, department FROM books WHERE 1=1"
-    if q:
-        sql += " AND (title LIKE ? OR author LIKE ? OR isbn LIKE ? )"
-        like = f"%{q}%"
-        params.extend([like, like, like])
-    if dept:
-        sql += " AND department = ?"
-        params.append(dept)
-    if min_year.isdigit():
-        sql += " AND year >= ?"
-        params.append(int(min_year))
-    if max_year.isdigit():
-        sql += " AND year <= ?"
-        params.append(int(max_year))
-    if available in ('1', 'true', 'yes'):
-        sql += " AND copies > 0"
-    sql += " ORDER BY title LIMIT 200"
-    cur = db.execute(sql, params)
-    rows = cur.fetchall()
-    books = [dict(r) for r in rows]
-    return jsonify(books)
+    books = find_books(db, keys)
+
+    def borrow_many(db):
+        # one transaction for every checkout; each book that cannot be borrowed
+        # is reported on its own and the rest still go through
+        now = utc_now()
+        expire_holds(db, now[1])
+        active = active_borrow_count(db, student_id)
+        results, taken = [], set()
+        for key in keys:
+            book = books.get(key)
+            item = batch_item(key, book)
+            if book is None:
+                item['error'] = 'Book not found'
+            elif book['id'] in taken:
+                item['error'] = 'Already borrowed in this request'
+            elif active >= BORROW_LIMIT:
+                item['error'] = f'Borrow limit reached ({BORROW_LIMIT} books)'
+            else:
+                borrow_id = take_copy(db, student_id, book['id'], now)
+                if borrow_id is None:
+                    item['error'] = 'Book not available'
+                else:
+                    item.update(borrow_id=borrow_id, due_ts=now[1] + LOAN_PERIOD_DAYS * 86400)
+                    taken.add(book['id'])
+                    active += 1
+            item['borrowed'] = 'borrow_id' in item
+            results.append(item)
+        if taken:
+            db.execute('UPDATE students SET active_borrows = ? WHERE id = ?', (active, student_id))
+        return results, active
+
+    results, active = run_write(db, borrow_many)
+    session['borrow_count'] = active
+    return jsonify(results=results, active_borrows=active)
 
 
 @app.route('/admin/login', methods=['GET', 'POST'])
@@ -104,6 +706,28 @@ def admin_logout():
     return redirect(url_for('index'))
 
 
+def busy_response(error, template):
+    # the hashing pool is full: refuse quickly rather than queue behind it
+    flash(str(error), 'error')
+    response = make_response(render_template(template), 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def rehash_password(db, user, password):
+    """Upgrade a stored hash made with older KDF parameters; best effort."""
+    try:
+        if not hasher.needs_rehash(user['password_hash']):
+            return
+        new_hash = hasher.hash(password)
+    except hashing.HashingBusy:
+        return
+    # conditional on the old hash, so a concurrent password change wins
+    db.execute('UPDATE students SET password_hash = ? WHERE id = ? AND password_hash = ?',
+               (new_hash, user['id'], user['password_hash']))
+    db.commit()
+
+
 @app.route('/student/register', methods=['GET', 'POST'])
 def student_register():
     if request.method == 'POST':
@@ -113,9 +737,12 @@ def student_register():
         if not name or not email or not password:
             flash('Name, email and password are required', 'error')
             return redirect(url_for('student_register'))
+        try:
+            pwd_hash = hasher.hash(password)
+        except hashing.HashingBusy as e:
+            return busy_response(e, 'student_register.html')
         db = get_db()
         try:
-            pwd_hash = generate_password_hash(password)
             db.execute('INSERT INTO students (name,email,password_hash) VALUES (?,?,?)', (name, email, pwd_hash))
             db.commit()
             flash('Registration successful, please login', 'success')
@@ -132,15 +759,18 @@ def student_login():
         email = request.form.get('email','').strip().lower()
         password = request.form.get('password','')
         db = get_db()
-        cur = db.execute('SELECT id, name, password_hash FROM students WHERE email = ?', (email,))
+        cur = db.execute('SELECT id, name, password_hash, active_borrows FROM students WHERE email = ?', (email,))
         user = cur.fetchone()
-        if user and check_password_hash(user['password_hash'], password):
+        try:
+            ok = user is not None and hasher.verify(user['password_hash'], password)
+        except hashing.HashingBusy as e:
+            return busy_response(e, 'student_login.html')
+        if ok:
+            rehash_password(db, user, password)
             session['student_id'] = user['id']
             session['student_name'] = user['name']
             # populate active borrow count in session
-            cur2 = db.execute('SELECT COUNT(*) as cnt FROM borrows WHERE student_id = ? AND returned_at IS NULL', (user['id'],))
-            cnt = cur2.fetchone()['cnt']
-            session['borrow_count'] = cnt
+            session['borrow_count'] = user['active_borrows']
             flash('Logged in', 'success')
             return redirect(url_for('index'))
         flash('Invalid credentials', 'error')
@@ -158,74 +788,233 @@ def student_logout():
 @app.route('/admin')
 @admin_required
 def admin_dashboard():
-    db = get_db()
-    cur = db.execute('SELECT id, title, author, year, isbn, copies, department FROM books ORDER BY title')
-    books = [dict(r) for r in cur.fetchall()]
-    return render_template('admin_dashboard.html', books=books)
+    etag = page_etag(catalog_version(get_read_db()))
+    cached = not_modified(etag, 'private, no-cache')
+    if cached:
+        return cached
+    # the session is saved before a streamed body renders, so pop the flashes and
+    # create the CSRF token now rather than from inside the template
+    get_flashed_messages(with_categories=True)
+    generate_csrf()
+    # rows are pulled from the cursor as the template renders, never all at once
+    books = iter_query('SELECT id, title, author, year, isbn, copies, department FROM books ORDER BY title, id')
+    return tag_response(Response(stream_template('admin_dashboard.html', books=books), mimetype='text/html'),
+                        etag, 'private, no-cache')
 
 
-@app.route('/admin/borrows')
+@app.route('/admin/cache-stats')
 @admin_required
-def admin_borrows():
-    db = get_db()
-    cur = db.execute('''
-        SELECT br.id as borrow_id, br.borrowed_at, br.returned_at,
-               br.student_id, s.name as student_name, s.email, bk.id as book_id, bk.title
+def admin_cache_stats():
+    return jsonify(search_cache.stats())
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if not app.config['METRICS_ENABLED']:
+        return Response('Metrics are disabled\n', 404, mimetype='text/plain')
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('Unauthorized\n', 401, {'WWW-Authenticate': 'Bearer'}, mimetype='text/plain')
+    return Response(app_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/export')
+@admin_required
+def admin_export():
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in EXPORT_TYPES:
+        return jsonify(error='format must be csv or jsonl'), 400
+
+    def generate():
+        # connection taken inside the generator; see iter_query
+        yield from catalog_io.export_books(get_read_db(), fmt)
+    return Response(stream_with_context(generate()), mimetype=EXPORT_TYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename=books.{fmt}'})
+
+
+@app.route('/admin/import', methods=['POST'])
+@admin_required
+def admin_import():
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('Choose a CSV or JSONL file to import', 'error')
+        return redirect(url_for('admin_dashboard'))
+    fmt = catalog_io.detect_format(upload.filename)
+    # werkzeug spools large uploads to disk; rows are parsed from it incrementally
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    try:
+        report = catalog_io.import_books(get_db(), catalog_io.read_records(stream, fmt))
+    except (UnicodeDecodeError, csv.Error) as e:
+        flash(f'Import failed, nothing was changed: {e}', 'error')
+        return redirect(url_for('admin_dashboard'))
+    flash(report.summary(), 'success' if not report.skipped else 'error')
+    for error in report.errors:
+        flash(error, 'error')
+    return redirect(url_for('admin_dashboard'))
+
+
+def parse_borrow_filters(args):
+    """Normalize the /admin/borrows filters. Raises ValueError for a bad value."""
+    f = {
+        'status': args.get('status', '').strip().lower() or 'all',
+        'student': args.get('student', '').strip(),
+        'date_from': args.get('from', '').strip(),
+        'date_to': args.get('to', '').strip(),
+    }
+    if f['status'] not in BORROW_STATUSES:
+        raise ValueError(f"Unknown status: {f['status']}")
+    for key in ('date_from', 'date_to'):
+        if f[key]:
+            try:
+                datetime.strptime(f[key], '%Y-%m-%d')
+            except ValueError:
+                raise ValueError('Dates must be YYYY-MM-DD') from None
+    return f
+
+
+def day_start_ts(day, days_after=0):
+    start = datetime.strptime(day, '%Y-%m-%d').replace(tzinfo=timezone.utc) + timedelta(days=days_after)
+    return int(start.timestamp())
+
+
+def borrow_history_sql(db, f, cursor, now):
+    """``(sql, params)`` for one page of borrows, newest first, or ``(None, None)``
+    when the student filter matches nobody.
+
+    Durations are formatted in SQL from the epoch columns; each filter narrows
+    one of the borrowed_ts indexes (see create_db.add_borrow_timestamps).
+    """
+    where, params = [], []
+    if f['student']:
+        if f['student'].isdigit():
+            student_id = int(f['student'])
+        else:
+            row = db.execute('SELECT id FROM students WHERE email = ?', (f['student'],)).fetchone()
+            if row is None:
+                return None, None
+            student_id = row['id']
+        where.append('br.student_id = ?')
+        params.append(student_id)
+    if f['status'] in ('active', 'overdue'):
+        where.append('br.returned_ts IS NULL')
+    elif f['status'] == 'returned':
+        where.append('br.returned_ts IS NOT NULL')
+    if f['status'] == 'overdue':
+        where.append('br.due_ts < ?')
+        params.append(now)
+    if f['date_from']:
+        where.append('br.borrowed_ts >= ?')
+        params.append(day_start_ts(f['date_from']))
+    if f['date_to']:
+        where.append('br.borrowed_ts < ?')
+        params.append(day_start_ts(f['date_to'], days_after=1))
+    if cursor:
+        where.append('(br.borrowed_ts, br.id) < (?, ?)')
+        params.extend(cursor)
+    age = '(COALESCE(br.returned_ts, ?) - br.borrowed_ts)'
+    sql = f'''
+        SELECT br.id as borrow_id, br.borrowed_at, br.returned_at, br.borrowed_ts,
+               br.student_id, s.name as student_name, s.email, bk.id as book_id, bk.title,
+               printf('%dd %dh', {age} / 86400, {age} % 86400 / 3600)
+                   || CASE WHEN br.returned_ts IS NULL THEN ' (ongoing)' ELSE '' END AS duration_readable,
+               date(br.due_ts, 'unixepoch') AS due_date,
+               COALESCE(f.amount_cents, {fines.amount_sql(app.config, 'f.due_ts', 'COALESCE(br.returned_ts, ?)')}) AS fine_cents
         FROM borrows br
         JOIN students s ON br.student_id = s.id
         JOIN books bk ON br.book_id = bk.id
-        ORDER BY br.borrowed_at DESC
-    ''')
-    rows = [dict(r) for r in cur.fetchall()]
-    for r in rows:
-        try:
-            borrowed = datetime.fromisoformat(r['borrowed_at']) if r['borrowed_at'] else None
-            if r.get('returned_at'):
-                returned = datetime.fromisoformat(r['returned_at'])
-                delta = returned - borrowed if borrowed else None
-                if delta is not None:
-                    days = delta.days
-                    hours = delta.seconds // 3600
-                    r['duration_readable'] = f"{days}d {hours}h"
-                else:
-                    r['duration_readable'] = 'n/a'
-            else:
-                if borrowed:
-                    delta = datetime.utcnow() - borrowed
-                    days = delta.days
-                    hours = delta.seconds // 3600
-                    r['duration_readable'] = f"{days}d {hours}h (ongoing)"
-                else:
-                    r['duration_readable'] = 'n/a'
-        except Exception:
-            r['duration_readable'] = 'n/a'
-    return render_template('admin_borrows.html', borrows=rows)
+        LEFT JOIN fines f ON f.borrow_id = br.id
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY br.borrowed_ts DESC, br.id DESC
+        LIMIT ?
+    '''
+    return sql, [now, now, now] + params + [PAGE_SIZE + 1]
+
+
+@app.route('/admin/borrows')
+@admin_required
+def admin_borrows():
+    db = get_read_db()
+    versions = data_versions(db)
+    # ongoing loans show their duration to the hour, so the page also ages hourly
+    etag = page_etag(versions['catalog_version'], versions['borrow_version'], versions['fine_version'],
+                     int(time.time() // 3600), request.query_string)
+    cached = not_modified(etag, 'private, no-cache')
+    if cached:
+        return cached
+    rows, next_cursor, error = [], None, None
+    try:
+        filters = parse_borrow_filters(request.args)
+        cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        if request.args.get('cursor') and cursor is None:
+            raise ValueError('Invalid cursor')
+    except ValueError as e:
+        filters, error = parse_borrow_filters({}), str(e)
+    else:
+        sql, params = borrow_history_sql(db, filters, cursor, int(time.time()))
+        if sql:
+            rows = [dict(r) for r in db.execute(sql, params)]
+        if len(rows) > PAGE_SIZE:
+            rows = rows[:PAGE_SIZE]
+            next_cursor = encode_cursor(rows[-1]['borrowed_ts'], rows[-1]['borrow_id'])
+    page = render_template('admin_borrows.html', borrows=rows, filters=filters, statuses=BORROW_STATUSES,
+                           next_cursor=next_cursor, error=error)
+    return tag_response(make_response(page, 400 if error else 200), etag, 'private, no-cache')
+
+
+def parse_analytics_args(args, default_month):
+    """``(month, months)`` from the /admin/analytics query. Raises ValueError for a bad value."""
+    month = args.get('month', '').strip() or default_month
+    try:
+        datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        raise ValueError('Month must be YYYY-MM') from None
+    months = args.get('months', '').strip() or '12'
+    if not months.isdigit() or not 1 <= int(months) <= analytics.MAX_MONTHS:
+        raise ValueError(f'Months must be between 1 and {analytics.MAX_MONTHS}')
+    return month, int(months)
+
+
+@app.route('/admin/analytics')
+@admin_required
+def admin_analytics():
+    db = get_read_db()
+    versions = data_versions(db)
+    as_json = request.args.get('format') == 'json'
+    # titles come from books; everything else changes only when analytics.py runs
+    etag = page_etag(versions['catalog_version'], versions['analytics_ts'], request.query_string)
+    cached = not_modified(etag, 'private, no-cache')
+    if cached:
+        return cached
+    updated = versions['analytics_ts']
+    try:
+        month, months = parse_analytics_args(request.args, analytics.month_of(updated or time.time()))
+    except ValueError as e:
+        if as_json:
+            return jsonify(error=str(e)), 400
+        month, months = parse_analytics_args({}, analytics.month_of(updated or time.time()))
+        error = str(e)
+    else:
+        error = None
+    report = analytics.report(db, month, months)
+    report['updated_ts'] = updated or None
+    if as_json:
+        return tag_response(jsonify(report), etag, 'private, no-cache')
+    updated = datetime.fromtimestamp(updated, timezone.utc).strftime('%Y-%m-%d %H:%M UTC') if updated else None
+    page = render_template('admin_analytics.html', report=report, updated=updated, error=error)
+    return tag_response(make_response(page, 400 if error else 200), etag, 'private, no-cache')
 
 
 @app.route('/admin/add', methods=['POST'])
 @admin_required
 def admin_add():
-    title = request.form.get('title','').strip()
-    author = request.form.get('author','').strip()
-    year = request.form.get('year','').strip()
-    isbn = request.form.get('isbn','').strip()
-    copies = request.form.get('copies','1').strip()
-    department = request.form.get('department','').strip()
     db = get_db()
-    # server-side validation
-    errors = []
-    if not title:
-        errors.append('Title is required')
-    if copies and not copies.isdigit():
-        errors.append('Copies must be a number')
-    if year and not year.isdigit():
-        errors.append('Year must be a number')
+    # server-side validation (shared with bulk imports)
+    row, errors = catalog_io.validate_book(request.form)
     if errors:
         for e in errors:
             flash(e, 'error')
         return redirect(url_for('admin_dashboard'))
-    db.execute('INSERT INTO books (title,author,year,isbn,copies,department) VALUES (?,?,?,?,?,?)',
-               (title, author, int(year) if year.isdigit() else None, isbn, int(copies) if copies.isdigit() else 1, department))
+    db.execute('INSERT INTO books (title,author,year,isbn,copies,department) VALUES (?,?,?,?,?,?)', row)
     db.commit()
     flash('Book added', 'success')
     return redirect(url_for('admin_dashboard'))
@@ -236,25 +1025,13 @@ def admin_add():
 def admin_edit(book_id):
     db = get_db()
     if request.method == 'POST':
-        title = request.form.get('title','').strip()
-        author = request.form.get('author','').strip()
-        year = request.form.get('year','').strip()
-        isbn = request.form.get('isbn','').strip()
-        copies = request.form.get('copies','1').strip()
-        department = request.form.get('department','').strip()
-        errors = []
-        if not title:
-            errors.append('Title is required')
-        if copies and not copies.isdigit():
-            errors.append('Copies must be a number')
-        if year and not year.isdigit():
-            errors.append('Year must be a number')
+        row, errors = catalog_io.validate_book(request.form)
         if errors:
             for e in errors:
                 flash(e, 'error')
             return redirect(url_for('admin_edit', book_id=book_id))
         db.execute('UPDATE books SET title=?,author=?,year=?,isbn=?,copies=?,department=? WHERE id=?',
-                   (title, author, int(year) if year.isdigit() else None, isbn, int(copies) if copies.isdigit() else 1, department, book_id))
+                   row + (book_id,))
         db.commit()
         flash('Book updated', 'success')
         return redirect(url_for('admin_dashboard'))
@@ -276,32 +1053,49 @@ def admin_delete(book_id):
     return redirect(url_for('admin_dashboard'))
 
 
+def take_copy(db, student_id, book_id, now):
+    """Take a copy of the book off the shelf for the student and record the
+    borrow, inside run_write; returns the borrow id, or None when no copy is
+    free. The caller keeps students.active_borrows in step."""
+    # a copy set aside for the student's hold is already off the shelf
+    if not holds.take(db, student_id, book_id):
+        cur = db.execute('UPDATE books SET copies = copies - 1 WHERE id = ? AND copies > 0', (book_id,))
+        if cur.rowcount == 0:
+            return None
+    return db.execute('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts, due_ts) VALUES (?,?,?,?,?)',
+                      (student_id, book_id) + now + (now[1] + LOAN_PERIOD_DAYS * 86400,)).lastrowid
+
+
 @app.route('/student/borrow/<int:book_id>', methods=['POST'])
 @login_required
 def student_borrow(book_id):
     db = get_db()
-    cur = db.execute('SELECT id, title, copies FROM books WHERE id = ?', (book_id,))
+    cur = db.execute('SELECT id, title FROM books WHERE id = ?', (book_id,))
     book = cur.fetchone()
     if not book:
         flash('Book not found', 'error')
         return redirect(url_for('index'))
-    # enforce per-student borrow limit
-    cur2 = db.execute('SELECT COUNT(*) as cnt FROM borrows WHERE student_id = ? AND returned_at IS NULL', (session['student_id'],))
-    active = cur2.fetchone()['cnt']
-    if active >= 3:
-        flash('Borrow limit reached (3 books). Return a book before borrowing another.', 'error')
-        return redirect(url_for('student_dashboard'))
-    if book['copies'] <= 0:
-        flash('Book not available', 'error')
-        return redirect(url_for('index'))
-    # decrement copies and create borrow record
-    db.execute('UPDATE books SET copies = copies - 1 WHERE id = ?', (book_id,))
-    db.execute('INSERT INTO borrows (student_id, book_id, borrowed_at) VALUES (?,?,?)',
-               (session['student_id'], book_id, datetime.utcnow().isoformat()))
-    db.commit()
+    student_id = session['student_id']
+
+    def borrow(db):
+        now = utc_now()
+        expire_holds(db, now[1])
+        # the conditional updates are the checks: under BEGIN IMMEDIATE no other
+        # worker can change either row between the test and the write
+        cur = db.execute('UPDATE students SET active_borrows = active_borrows + 1 WHERE id = ? AND active_borrows < ?',
+                         (student_id, BORROW_LIMIT))
+        if cur.rowcount == 0:
+            raise WriteRefused('Borrow limit reached (3 books). Return a book before borrowing another.', 'student_dashboard')
+        if take_copy(db, student_id, book_id, now) is None:
+            raise WriteRefused('Book not available. Place a hold to be told when a copy comes back.', 'index')
+
+    try:
+        run_write(db, borrow)
+    except WriteRefused as e:
+        flash(e.message, 'error')
+        return redirect(url_for(e.endpoint))
     # update session borrow_count
-    cur3 = db.execute('SELECT COUNT(*) as cnt FROM borrows WHERE student_id = ? AND returned_at IS NULL', (session['student_id'],))
-    session['borrow_count'] = cur3.fetchone()['cnt']
+    session['borrow_count'] = active_borrow_count(db, student_id)
     flash(f"Borrowed: {book['title']}", 'success')
     return redirect(url_for('student_dashboard'))
 
@@ -321,32 +1115,169 @@ def student_return(borrow_id):
     if rec['returned_at']:
         flash('Already returned', 'error')
         return redirect(url_for('student_dashboard'))
-    # mark returned and increment copies
-    db.execute('UPDATE borrows SET returned_at = ? WHERE id = ?', (datetime.utcnow().isoformat(), borrow_id))
-    db.execute('UPDATE books SET copies = copies + 1 WHERE id = ?', (rec['book_id'],))
-    db.commit()
+
+    def give_back(db):
+        # mark returned and hand the copy on; a concurrent return of the same
+        # record loses the race on the returned_at IS NULL condition
+        now = utc_now()
+        expire_holds(db, now[1])
+        cur = db.execute('UPDATE borrows SET returned_at = ?, returned_ts = ? WHERE id = ? AND returned_at IS NULL',
+                         now + (borrow_id,))
+        if cur.rowcount == 0:
+            raise WriteRefused('Already returned', 'student_dashboard')
+        # to the next student waiting for it, or back on the shelf
+        holds.pass_on(db, rec['book_id'], now[1])
+        db.execute('UPDATE students SET active_borrows = active_borrows - 1 WHERE id = ?', (rec['student_id'],))
+
+    try:
+        run_write(db, give_back)
+    except WriteRefused as e:
+        flash(e.message, 'error')
+        return redirect(url_for(e.endpoint))
     # update session borrow_count
-    cur2 = db.execute('SELECT COUNT(*) as cnt FROM borrows WHERE student_id = ? AND returned_at IS NULL', (session['student_id'],))
-    session['borrow_count'] = cur2.fetchone()['cnt']
+    session['borrow_count'] = active_borrow_count(db, session['student_id'])
     flash('Book returned', 'success')
     return redirect(url_for('student_dashboard'))
 
 
+@app.route('/student/hold/<int:book_id>', methods=['POST'])
+@login_required
+def student_hold(book_id):
+    db = get_db()
+    student_id = session['student_id']
+
+    def hold(db):
+        now = utc_now()[1]
+        expire_holds(db, now)
+        # holds are for books with no copy left; under BEGIN IMMEDIATE no copy
+        # can come back between this check and joining the queue
+        book = db.execute('SELECT title, copies FROM books WHERE id = ?', (book_id,)).fetchone()
+        if book is None:
+            raise WriteRefused('Book not found', 'index')
+        if book['copies'] > 0:
+            raise WriteRefused('A copy is available, borrow it instead', 'index')
+        if db.execute('SELECT 1 FROM borrows WHERE student_id = ? AND book_id = ? AND returned_at IS NULL',
+                      (student_id, book_id)).fetchone():
+            raise WriteRefused('You already have this book', 'student_dashboard')
+        if not holds.place(db, student_id, book_id, now):
+            raise WriteRefused('You already have a hold on this book', 'student_dashboard')
+        return book['title']
+
+    try:
+        title = run_write(db, hold)
+    except WriteRefused as e:
+        flash(e.message, 'error')
+        return redirect(url_for(e.endpoint))
+    flash(f'Hold placed: {title}. You will be notified when a copy is set aside for you.', 'success')
+    return redirect(url_for('student_dashboard'))
+
+
+@app.route('/student/cancel-hold/<int:hold_id>', methods=['POST'])
+@login_required
+def student_cancel_hold(hold_id):
+    db = get_db()
+    student_id = session['student_id']
+
+    def cancel(db):
+        now = utc_now()[1]
+        expire_holds(db, now)
+        if not holds.cancel(db, hold_id, student_id, now):
+            raise WriteRefused('Hold not found', 'student_dashboard')
+
+    try:
+        run_write(db, cancel)
+    except WriteRefused as e:
+        flash(e.message, 'error')
+        return redirect(url_for(e.endpoint))
+    flash('Hold cancelled', 'success')
+    return redirect(url_for('student_dashboard'))
+
+
+@app.route('/student/events')
+@login_required
+def student_events():
+    """Server-Sent Events: a ``ready`` event whenever a copy is set aside for
+    one of the student's holds. asgi.py serves the same stream on its event loop."""
+    student_id = session['student_id']
+    after = holds.last_event_id(request.headers.get('Last-Event-ID'))
+    pool = database_pool(readonly=True)
+    pickup = app.config['HOLD_PICKUP_DAYS'] * 86400
+    keepalive = app.config['HOLD_EVENTS_KEEPALIVE']
+    deadline = time.monotonic() + app.config['HOLD_EVENTS_TIMEOUT']
+
+    def generate():
+        # the stream outlives the request, so it borrows a pooled connection per read
+        nonlocal after
+        woken = threading.Event()
+        hold_notifier.subscribe(student_id, woken.set)
+        try:
+            yield f'retry: {holds.RETRY_MS}\n\n'
+            while True:
+                woken.clear()
+                conn = pool.acquire()
+                try:
+                    rows = holds.ready_holds(conn, student_id, after)
+                finally:
+                    pool.release(conn)
+                for row in rows:
+                    after = row['ready_seq']
+                    yield holds.format_event(row, pickup)
+                while not woken.is_set():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    if not woken.wait(min(keepalive, remaining)):
+                        yield holds.KEEPALIVE
+        finally:
+            hold_notifier.unsubscribe(student_id, woken.set)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def utc_text(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d %H:%M')
+
+
 @app.route('/student/dashboard')
 @login_required
 def student_dashboard():
     db = get_db()
-    cur = db.execute('''
-        SELECT br.id as borrow_id, bk.id as book_id, bk.title, bk.author, br.borrowed_at, br.returned_at
+    versions = data_versions(db)
+    reader = recommendations()
+    # fines on books still out grow by the day, so the page ages daily too
+    etag = page_etag(session['student_id'], versions['catalog_version'], versions['borrow_version'],
+                     versions['hold_version'], versions['fine_version'], reader.generation, int(time.time() // 86400))
+    cached = not_modified(etag, 'private, no-cache')
+    if cached:
+        return cached
+    cur = db.execute(f'''
+        SELECT br.id as borrow_id, bk.id as book_id, bk.title, bk.author, br.borrowed_at, br.returned_at,
+               date(br.due_ts, 'unixepoch') as due_date,
+               COALESCE(f.amount_cents, {fines.amount_sql(app.config, 'f.due_ts', 'COALESCE(br.returned_ts, ?)')}) as fine_cents
         FROM borrows br JOIN books bk ON br.book_id = bk.id
+        LEFT JOIN fines f ON f.borrow_id = br.id
         WHERE br.student_id = ?
         ORDER BY br.borrowed_at DESC
-    ''', (session['student_id'],))
+    ''', (int(time.time()), session['student_id']))
     borrows = [dict(r) for r in cur.fetchall()]
+    picks = also_borrowed(db, reader, sorted({br['book_id'] for br in borrows}), ALSO_BORROWED)
+    for br in borrows:
+        br['also_borrowed'] = picks[br['book_id']]
+    cur = db.execute('''
+        SELECT h.id as hold_id, bk.id as book_id, bk.title, bk.author, h.placed_ts, h.ready_ts
+        FROM holds h JOIN books bk ON h.book_id = bk.id
+        WHERE h.student_id = ?
+        ORDER BY h.id
+    ''', (session['student_id'],))
+    pickup = app.config['HOLD_PICKUP_DAYS'] * 86400
+    student_holds = [dict(r, placed_at=utc_text(r['placed_ts']),
+                          collect_by=utc_text(r['ready_ts'] + pickup) if r['ready_ts'] is not None else None)
+                     for r in cur.fetchall()]
     # refresh session borrow count
-    cur2 = db.execute('SELECT COUNT(*) as cnt FROM borrows WHERE student_id = ? AND returned_at IS NULL', (session['student_id'],))
-    session['borrow_count'] = cur2.fetchone()['cnt']
-    return render_template('student_dashboard.html', borrows=borrows)
+    session['borrow_count'] = active_borrow_count(db, session['student_id'])
+    page = render_template('student_dashboard.html', borrows=borrows, holds=student_holds)
+    return tag_response(make_response(page), etag, 'private, no-cache')
 
 if __name__ == '__main__':
     app.run(debug=True)
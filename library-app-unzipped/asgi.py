@@ -0,0 +1,242 @@
+"""ASGI entry point: ``uvicorn asgi:app``.
+
+Under ``gunicorn app:app`` every request holds a sync worker for its whole
+duration, including the time spent waiting on SQLite, so a few slow searches
+can leave nothing to serve the rest. Here /api/search, which carries most of
+the traffic, is answered on the event loop: its queries run on the
+``async_db`` reader threads, and one process can keep thousands of searches
+open while a handful of threads do the work. Every other route is the
+unchanged Flask app, run through asgiref's WSGI adapter on a thread per
+request, at most ASGI_SYNC_THREADS at a time.
+
+Searches answer exactly as ``app.api_search`` does, with the same parsing,
+cache, ETags and metrics, since both go through ``app.parse_search_args`` and
+``app.cached_search``.
+
+/student/events, the Server-Sent Events stream of hold notifications, is
+served on the loop too: a stream mostly waits, so under Flask each open one
+would keep a thread busy. Streams wait on an ``asyncio.Event`` that the
+process's ``holds.Notifier`` sets.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from urllib.parse import parse_qsl
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_etags
+from werkzeug.wrappers import Request
+
+import app as app_module
+import async_db
+import holds
+import metrics
+import replica
+
+
+def env_config():
+    """Default ASGI settings, overridable through LIB_ASGI_* environment variables."""
+    return {
+        # Flask requests (everything but /api/search) running at once per process
+        'ASGI_SYNC_THREADS': int(os.environ.get('LIB_ASGI_SYNC_THREADS', 16)),
+    }
+
+
+class LibraryASGI:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = WsgiToAsgi(flask_app)
+        # created on first use, on the server's event loop
+        self.db = None
+        self.replica_db = None
+        self.sync_slots = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] != 'http':
+            # no websocket routes; returning without accepting makes the server refuse it
+            return
+        elif scope['path'] == '/api/search' and scope['method'] == 'GET':
+            await self.search(scope, send)
+        elif scope['path'] == '/student/events' and scope['method'] == 'GET':
+            # without a student the Flask view answers (a redirect to the login)
+            student_id = self.student_id(scope)
+            if student_id:
+                await self.events(scope, receive, send, student_id)
+            else:
+                await self.run_sync(scope, receive, send)
+        else:
+            await self.run_sync(scope, receive, send)
+
+    def database(self):
+        if self.db is None:
+            # the Flask side's pool fills a new or in-memory database first
+            app_module.database_pool()
+            self.db = async_db.AsyncDatabase.from_config(self.flask_app.config['DB_PATH'], self.flask_app.config)
+        return self.db
+
+    async def catalog_database(self):
+        # searches read the local replica while it is fresh enough (see replica.py)
+        config = self.flask_app.config
+        if config['REPLICA_PATH']:
+            if self.replica_db is None:
+                self.replica_db = async_db.AsyncDatabase.from_config(config['REPLICA_PATH'], config)
+            try:
+                if await self.replica_db.read(replica.fresh, config['REPLICA_MAX_LAG']):
+                    return self.replica_db
+            except sqlite3.OperationalError:
+                # not restored yet
+                pass
+        return self.database()
+
+    async def run_sync(self, scope, receive, send):
+        if self.sync_slots is None:
+            self.sync_slots = asyncio.Semaphore(self.flask_app.config['ASGI_SYNC_THREADS'])
+        async with self.sync_slots:
+            # asgiref runs every request on one shared thread unless each gets a context of its own
+            async with ThreadSensitiveContext():
+                await self.wsgi(scope, receive, send)
+
+    async def search(self, scope, send):
+        stats = metrics.RequestStats() if self.flask_app.config['METRICS_ENABLED'] else None
+        status = 500
+        try:
+            status = await self.serve_search(scope, send, stats)
+        finally:
+            if stats is not None:
+                app_module.app_metrics.observe('api_search', status, stats)
+
+    async def serve_search(self, scope, send, stats):
+        def timed(conn):
+            return metrics.TimedConnection(conn, stats) if stats is not None else conn
+
+        args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+        try:
+            s = app_module.parse_search_args(args)
+        except ValueError as e:
+            await respond(send, 400, json.dumps({'error': str(e)}).encode(), [(b'content-type', b'application/json')])
+            return 400
+        if s['stream']:
+            await self.stream_search(s, send, timed)
+            return 200
+
+        if_none_match = parse_etags(header(scope, b'if-none-match'))
+        etag, body = await (await self.catalog_database()).read(
+            lambda conn: app_module.cached_search(timed(conn), s, if_none_match))
+        headers = [(b'etag', f'"{etag}"'.encode()), (b'cache-control', b'public, no-cache')]
+        if body is None:
+            await respond(send, 304, b'', headers)
+            return 304
+        await respond(send, 200, body, headers + [(b'content-type', b'application/json')])
+        return 200
+
+    async def stream_search(self, s, send, timed):
+        # the same body as app.stream_json_results, sent a chunk of rows at a time
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': b'{"results": [', 'more_body': True})
+        sql, params = app_module.search_sql(s)
+        if sql is not None:
+            sep = ''
+            async for rows in (await self.catalog_database()).stream(sql, params, timed):
+                books = []
+                for r in rows:
+                    book = dict(r)
+                    book.pop('sort_key', None)
+                    books.append(json.dumps(book))
+                await send({'type': 'http.response.body', 'body': (sep + ','.join(books)).encode(),
+                            'more_body': True})
+                sep = ','
+        await send({'type': 'http.response.body', 'body': b'], "next_cursor": null}'})
+
+    def student_id(self, scope):
+        # the Flask session cookie, read through the app's session interface
+        cookies = Request({'HTTP_COOKIE': header(scope, b'cookie') or ''})
+        session = self.flask_app.session_interface.open_session(self.flask_app, cookies)
+        return session.get('student_id') if session is not None else None
+
+    async def events(self, scope, receive, send, student_id):
+        # the same stream as app.student_events
+        config = self.flask_app.config
+        loop = asyncio.get_running_loop()
+        after = holds.last_event_id(header(scope, b'last-event-id'))
+        pickup = config['HOLD_PICKUP_DAYS'] * 86400
+        deadline = time.monotonic() + config['HOLD_EVENTS_TIMEOUT']
+        woken = asyncio.Event()
+
+        def wake():
+            loop.call_soon_threadsafe(woken.set)
+
+        async def disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        notifier = app_module.hold_notifier
+        await loop.run_in_executor(None, notifier.subscribe, student_id, wake)
+        gone = asyncio.ensure_future(disconnect())
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream; charset=utf-8'),
+                                    (b'cache-control', b'no-cache'), (b'x-accel-buffering', b'no')]})
+            await send({'type': 'http.response.body', 'body': f'retry: {holds.RETRY_MS}\n\n'.encode(),
+                        'more_body': True})
+            while True:
+                woken.clear()
+                for row in await self.database().read(holds.ready_holds, student_id, after):
+                    after = row['ready_seq']
+                    await send({'type': 'http.response.body', 'body': holds.format_event(row, pickup).encode(),
+                                'more_body': True})
+                while not woken.is_set():
+                    if gone.done():
+                        return
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        await send({'type': 'http.response.body', 'body': b''})
+                        return
+                    wait = asyncio.ensure_future(woken.wait())
+                    await asyncio.wait([wait, gone], timeout=min(config['HOLD_EVENTS_KEEPALIVE'], remaining),
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    wait.cancel()
+                    if not woken.is_set() and not gone.done():
+                        await send({'type': 'http.response.body', 'body': holds.KEEPALIVE.encode(),
+                                    'more_body': True})
+        finally:
+            gone.cancel()
+            notifier.unsubscribe(student_id, wake)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for db in (self.db, self.replica_db):
+                    if db is not None:
+                        await asyncio.get_running_loop().run_in_executor(None, db.close)
+                self.db = self.replica_db = None
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def header(scope, name):
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def respond(send, status, body, headers):
+    headers = headers + [(b'content-length', str(len(body)).encode())]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# thread and stream settings (see async_db.env_config / env_config for the LIB_ASYNC_DB_* / LIB_ASGI_* env vars)
+app_module.app.config.from_mapping(async_db.env_config())
+app_module.app.config.from_mapping(env_config())
+app = LibraryASGI(app_module.app)
@@ -0,0 +1,481 @@
+"""Catalogue questions for /api/ask, answered offline from a BM25 index.
+
+"do you have anything on compilers that's available?" is read as filters
+(availability, a department named by its name, years such as "after 2010")
+and search terms (the remaining words, less stop words and plural endings).
+Books are ranked by BM25 over their title and author words, title words
+counted twice.
+
+The index is a handful of flat NumPy arrays in a directory next to the
+database (ASK_DIR): the sorted vocabulary, each term's postings with their
+BM25 weight precomputed, and each book's id, year and department. Workers
+memory-map them, so starting one reads nothing up front, and a question
+scores every matching book with one scatter-add per query term.
+
+Catalogue changes reach the index without a rebuild: triggers on books note
+each changed book in ``ask_changes`` with a sequence number (see
+create_db.add_ask_changes). An index records the sequence it was built at;
+books changed after it are left out of the arrays and scored from their
+current rows instead. Questions never build an index: ``python ask.py``
+(from cron, or with --every to keep running) builds the first one and
+rebuilds it once more than ASK_MAX_CHANGES books have changed, and
+``--rebuild`` does so regardless, e.g. after a bulk import. Until the first
+build /api/ask answers 503. Live details such as copies always come from
+books.
+"""
+import argparse
+import bisect
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+import create_db
+import db as db_pool
+
+MANIFEST = 'manifest.json'
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# title words count this many times over author words
+TITLE_WEIGHT = 2
+# candidates fetched per answer, so some survive the availability check
+CANDIDATES = 200
+
+# the arrays of an index, each in a file of its own
+DTYPES = {
+    'terms': np.uint8,  # the sorted vocabulary, utf-8, back to back
+    'term_offsets': np.int64,
+    'df': np.int32,
+    'postings': np.int64,  # each term's slice of the two posting_* arrays
+    'posting_docs': np.int32,
+    'posting_weights': np.float32,
+    'books': np.int64,  # book id, year and department code of each indexed book
+    'years': np.int32,
+    'departments': np.int16,
+}
+
+STOP_WORDS = frozenset('''
+    a about an and any anything are as at be book books by can could do does find for from get got
+    have i in is it its looking me my need of on or please show some something that the there this
+    to want what which with you your
+'''.split())
+AVAILABLE_WORDS = frozenset(('available', 'availability', 'borrowable', 'shelf', 'stock'))
+YEAR = re.compile(r'\b(?:(after|since|from|before|until|in)\s+)?((?:19|20)\d\d)\b')
+
+
+def env_config():
+    """Default /api/ask settings, overridable through LIB_ASK_* environment variables."""
+    return {
+        # where the index lives; empty means <database file>.ask next to the database
+        'ASK_DIR': os.environ.get('LIB_ASK_DIR', ''),
+        # changed books scored from their rows before python ask.py rebuilds the index
+        'ASK_MAX_CHANGES': int(os.environ.get('LIB_ASK_MAX_CHANGES', 1000)),
+    }
+
+
+def directory(db_path, config):
+    return config['ASK_DIR'] or db_pool.beside(db_path, '.ask')
+
+
+def words(text):
+    """Lower-case words of ``text`` with plural endings taken off; initials
+    and the like are dropped."""
+    out = []
+    for w in re.findall(r'[a-z0-9]{2,}', (text or '').lower()):
+        if len(w) > 4 and w.endswith('ies'):
+            w = w[:-3] + 'y'
+        elif len(w) > 3 and w.endswith('s') and not w.endswith('ss'):
+            w = w[:-1]
+        out.append(w)
+    return out
+
+
+def book_terms(title, author):
+    """{term: frequency} of a book, title words counted TITLE_WEIGHT times."""
+    tf = Counter()
+    for w in words(title):
+        if w not in STOP_WORDS:
+            tf[w] += TITLE_WEIGHT
+    for w in words(author):
+        if w not in STOP_WORDS:
+            tf[w] += 1
+    return tf
+
+
+def parse_question(question, departments):
+    """(terms, the words they came from, filters) of a question;
+    ``departments`` are the names a word can pick."""
+    filters = {'available': False, 'department': None, 'min_year': None, 'max_year': None}
+    text = question.lower()
+    for word, year in YEAR.findall(text):
+        year = int(year)
+        if word in ('after', 'since', 'from'):
+            filters['min_year'] = year + (word == 'after')
+        elif word in ('before', 'until'):
+            filters['max_year'] = year - (word == 'before')
+        else:
+            filters['min_year'] = filters['max_year'] = year
+    text = YEAR.sub(' ', text)
+    by_name = {d.lower(): d for d in departments}
+    terms, topic = [], []
+    for w in re.findall(r'[a-z0-9]+', text):
+        if w in AVAILABLE_WORDS:
+            filters['available'] = True
+        elif w in by_name:
+            filters['department'] = by_name[w]
+        else:
+            found = [t for t in words(w) if t not in STOP_WORDS]
+            terms.extend(found)
+            topic.extend([w] if found else [])
+    return list(dict.fromkeys(terms)), topic, filters
+
+
+def load(path, dtype):
+    # np.memmap refuses empty files, and an empty catalogue makes some
+    if not os.path.getsize(path):
+        return np.zeros(0, dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def changes_seq(conn):
+    return conn.execute("SELECT value FROM meta WHERE key = 'ask_seq'").fetchone()[0]
+
+
+def build(conn, path):
+    """Write a new index of the books in ``path``; returns the number of books.
+
+    Several builders may run at once: each writes files of its own and the
+    manifest rename makes one of them current, every one a consistent index.
+    """
+    os.makedirs(path, exist_ok=True)
+    # one read transaction, so the books read are exactly those as of seq
+    conn.execute('BEGIN')
+    try:
+        seq = changes_seq(conn)
+        rows = conn.execute('SELECT id, title, author, year, department FROM books ORDER BY id').fetchall()
+    finally:
+        conn.execute('COMMIT')
+
+    vocabulary, departments = {}, {}
+    doc_ids, term_ids, tfs, lengths = [], [], [], []
+    for doc, r in enumerate(rows):
+        tf = book_terms(r['title'], r['author'])
+        lengths.append(sum(tf.values()))
+        for term, n in tf.items():
+            doc_ids.append(doc)
+            term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+            tfs.append(n)
+        departments.setdefault(r['department'] or '', len(departments))
+    terms = sorted(vocabulary)
+    # term ids in sorted order, so a term's position in the vocabulary is its row
+    rank = np.zeros(len(terms), np.int64)
+    rank[[vocabulary[t] for t in terms]] = np.arange(len(terms))
+    term_ids = rank[np.array(term_ids, np.int64)] if term_ids else np.zeros(0, np.int64)
+    doc_ids, tfs = np.array(doc_ids, np.int64), np.array(tfs, np.float64)
+    lengths = np.array(lengths, np.float64)
+    avgdl = float(lengths.mean()) if len(lengths) else 1.0
+
+    df = np.bincount(term_ids, minlength=len(terms))
+    idf = np.log(1 + (len(rows) - df + 0.5) / (df + 0.5))
+    weights = idf[term_ids] * tfs * (K1 + 1) / (tfs + K1 * (1 - B + B * lengths[doc_ids] / max(avgdl, 1e-9)))
+    order = np.lexsort((doc_ids, term_ids))
+
+    generation = (read_manifest(path) or {}).get('generation', 0) + 1
+    encoded = [t.encode() for t in terms]
+    arrays = {
+        'terms': np.frombuffer(b''.join(encoded), np.uint8),
+        'term_offsets': np.r_[0, np.cumsum([len(t) for t in encoded])],
+        'df': df,
+        'postings': np.r_[0, np.cumsum(df)],
+        'posting_docs': doc_ids[order],
+        'posting_weights': weights[order],
+        'books': [r['id'] for r in rows],
+        'years': [r['year'] or 0 for r in rows],
+        'departments': [departments[r['department'] or ''] for r in rows],
+    }
+    files = {}
+    for name, array in arrays.items():
+        # the pid keeps builders in other processes off each other's files
+        files[name] = f'{name}-{generation}.{os.getpid()}.bin'
+        np.asarray(array, DTYPES[name]).tofile(os.path.join(path, files[name]))
+    manifest = {'generation': generation, 'seq': seq, 'books': len(rows), 'terms': len(terms), 'avgdl': avgdl,
+                'departments': list(departments), 'files': files}
+    tmp = os.path.join(path, f'{MANIFEST}.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(path, MANIFEST))
+    # files of older builds; one still mapped by a reader goes on a later build
+    current = set(files.values()) | {MANIFEST}
+    for name in os.listdir(path):
+        if name.endswith('.bin') and name not in current and int(name.rsplit('-', 1)[1].split('.')[0]) < generation:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+    return len(rows)
+
+
+def run(conn, config, path, rebuild=False):
+    """Build the index in ``path`` when there is none yet, when more than
+    ASK_MAX_CHANGES books have changed since it was built, or when ``rebuild``.
+
+    Returns the number of books indexed, or None when the index was kept.
+    """
+    manifest = read_manifest(path)
+    if manifest is not None and not rebuild:
+        changed = conn.execute('SELECT COUNT(*) FROM ask_changes WHERE seq > ?', (manifest['seq'],)).fetchone()[0]
+        if changed <= config['ASK_MAX_CHANGES']:
+            return None
+    return build(conn, path)
+
+
+class NotIndexed(Exception):
+    pass
+
+
+class Vocabulary:
+    """The sorted term list as a sequence of str, read from the mapped bytes on demand."""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+    def find(self, term):
+        i = bisect.bisect_left(self, term)
+        return i if i < len(self) and self[i] == term else None
+
+
+class Index:
+    """One build, memory-mapped."""
+
+    def __init__(self, path, manifest):
+        self.manifest = manifest
+        arrays = {name: load(os.path.join(path, f), DTYPES[name]) for name, f in manifest['files'].items()}
+        self.vocabulary = Vocabulary(arrays['terms'], arrays['term_offsets'])
+        self.df = arrays['df']
+        self.postings = arrays['postings']
+        self.posting_docs = arrays['posting_docs']
+        self.posting_weights = arrays['posting_weights']
+        self.books = arrays['books']
+        self.years = arrays['years']
+        self.departments = arrays['departments']
+
+    def idf(self, term):
+        i = self.vocabulary.find(term)
+        df = int(self.df[i]) if i is not None else 0
+        return math.log(1 + (self.manifest['books'] - df + 0.5) / (df + 0.5))
+
+    def weight(self, tf, length, idf):
+        # the same BM25 weight build() stores, for a book scored from its row
+        return idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / max(self.manifest['avgdl'], 1e-9)))
+
+    def scores(self, terms):
+        """BM25 score of every book in the arrays."""
+        scores = np.zeros(len(self.books), np.float32)
+        for term in terms:
+            i = self.vocabulary.find(term)
+            if i is not None:
+                lo, hi = self.postings[i], self.postings[i + 1]
+                # a book has each term once in its postings, so there are no repeated indices
+                scores[self.posting_docs[lo:hi]] += self.posting_weights[lo:hi]
+        return scores
+
+    def mask(self, filters):
+        """Which books in the arrays pass the year and department filters."""
+        keep = np.ones(len(self.books), bool)
+        if filters['min_year'] is not None:
+            keep &= self.years >= filters['min_year']
+        if filters['max_year'] is not None:
+            keep &= self.years <= filters['max_year']
+        if filters['department'] is not None:
+            names = self.manifest['departments']
+            code = names.index(filters['department']) if filters['department'] in names else -1
+            keep &= self.departments == code
+        return keep
+
+
+class Assistant:
+    """The read side, one per worker and directory (see ``get_assistant``)."""
+
+    def __init__(self, path, config):
+        self.path = path
+        self.stamp = None
+        self.index = None
+        # ((index generation, ask_seq), [(row, term counts)] of the books changed
+        # since the index, mask of their positions in the index's arrays)
+        self.changes = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            st = os.stat(os.path.join(self.path, MANIFEST))
+        except FileNotFoundError:
+            return
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stamp != self.stamp:
+            try:
+                self.index = Index(self.path, read_manifest(self.path))
+            except FileNotFoundError:
+                # replaced again since the manifest was read; the next call maps the newest
+                return
+            self.stamp = stamp
+
+    def changed_books(self, conn):
+        return conn.execute('SELECT c.book_id, b.title, b.author, b.year, b.department FROM ask_changes c'
+                            ' LEFT JOIN books b ON b.id = c.book_id WHERE c.seq > ?',
+                            (self.index.manifest['seq'],)).fetchall()
+
+    def current(self, conn):
+        """The newest index and the rows of the books changed since it was
+        built. Raises NotIndexed before ``python ask.py`` has built one."""
+        with self.lock:
+            self.refresh()
+            if self.index is None:
+                raise NotIndexed('Questions can be answered once the catalogue has been indexed.')
+            key = (self.index.manifest['generation'], changes_seq(conn))
+            if self.changes is None or self.changes[0] != key:
+                rows = self.changed_books(conn)
+                # tokenized and masked out of the arrays once here rather than on every question
+                changed = [(r, book_terms(r['title'], r['author']) if r['title'] is not None else None)
+                           for r in rows]
+                stale = np.isin(self.index.books, [r['book_id'] for r in rows]) if rows else None
+                self.changes = (key, changed, stale)
+            return self.index, self.changes[1], self.changes[2]
+
+    def ask(self, conn, question, limit):
+        """{'answer': text, 'results': [book, ...], ...} for a question."""
+        index, changed, stale = self.current(conn)
+        departments = set(index.manifest['departments']) | {r['department'] for r, _ in changed}
+        terms, topic, filters = parse_question(question, departments - {'', None})
+
+        # books in the arrays, in one vectorized pass; without search terms the newest rank first
+        scores = index.scores(terms)
+        keep = index.mask(filters)
+        if terms:
+            keep &= scores > 0
+        if stale is not None:
+            keep &= ~stale
+        docs = np.flatnonzero(keep)
+        rank = scores[docs] if terms else index.years[docs].astype(np.float32)
+        if len(docs) > CANDIDATES:
+            best = np.argpartition(-rank, CANDIDATES)[:CANDIDATES]
+            docs, rank = docs[best], rank[best]
+        candidates = list(zip(rank.tolist(), index.books[docs].tolist()))
+
+        # and the books changed since the build, from their current rows
+        for r, tf in changed:
+            if tf is None or not passes(r, filters):
+                continue
+            length = sum(tf.values())
+            score = sum(index.weight(tf[t], length, index.idf(t)) for t in terms if t in tf)
+            if score or not terms:
+                candidates.append((score if terms else float(r['year'] or 0), r['book_id']))
+        candidates.sort(key=lambda c: (-c[0], c[1]))
+        candidates = candidates[:CANDIDATES]
+
+        ids = [book_id for _, book_id in candidates]
+        books = {r['id']: dict(r) for r in conn.execute(
+            'SELECT id, title, author, year, isbn, copies, department FROM books'
+            f" WHERE id IN ({','.join('?' * len(ids))})", ids)} if ids else {}
+        results, on_loan = [], []
+        for score, book_id in candidates:
+            book = books.get(book_id)
+            if book is None:
+                continue
+            if terms:
+                book['score'] = round(score, 4)
+            if filters['available'] and book['copies'] <= 0:
+                on_loan.append(book)
+            else:
+                results.append(book)
+            if len(results) >= limit:
+                break
+        return {'question': question, 'answer': answer_text(topic, filters, results, on_loan[:limit]),
+                'terms': terms, 'filters': filters, 'results': results, 'on_loan': on_loan[:limit]}
+
+
+def passes(row, filters):
+    if filters['min_year'] is not None and (row['year'] or 0) < filters['min_year']:
+        return False
+    if filters['max_year'] is not None and (row['year'] or 0) > filters['max_year']:
+        return False
+    return filters['department'] is None or row['department'] == filters['department']
+
+
+def answer_text(topic, filters, results, on_loan):
+    about = ''.join([
+        f" on {' '.join(topic)}" if topic else '',
+        f" in {filters['department']}" if filters['department'] else '',
+        f" from {filters['min_year']}" if filters['min_year'] is not None else '',
+        f" up to {filters['max_year']}" if filters['max_year'] is not None else '',
+    ])
+    listed = '; '.join(f"{b['title']} by {b['author']} ({b['year']}, " + (
+        f"{b['copies']} {'copy' if b['copies'] == 1 else 'copies'} on the shelf)" if b['copies'] > 0 else 'all copies out)')
+        for b in results)
+    if results:
+        found = f"{len(results)} {'book' if len(results) == 1 else 'books'}"
+        return f"Yes, {found}{about}{' available now' if filters['available'] else ''}: {listed}."
+    if on_loan:
+        return (f"Nothing{about} is on the shelf right now. All copies of "
+                f"{'; '.join(b['title'] for b in on_loan)} are out, and you can place a hold.")
+    return f"Sorry, I could not find anything{about} in the catalogue."
+
+
+_assistants = {}
+_assistants_lock = threading.Lock()
+
+
+def get_assistant(path, config):
+    assistant = _assistants.get(path)
+    if assistant is None:
+        with _assistants_lock:
+            assistant = _assistants.setdefault(path, Assistant(path, config))
+    return assistant
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build the /api/ask index of the catalogue when it is missing or too many books have changed.')
+    parser.add_argument('--every', type=float, help='keep running, starting a run this many seconds after the last')
+    parser.add_argument('--rebuild', action='store_true', help='build the index however few books have changed')
+    args = parser.parse_args(argv)
+
+    config = dict(db_pool.env_config(), **env_config())
+    db_path = os.environ.get('LIB_DB_PATH') or create_db.DB_PATH
+    conn = db_pool.connect(db_path, config, readonly=True)
+    conn.isolation_level = None
+    rebuild = args.rebuild
+    while True:
+        started = time.monotonic()
+        books = run(conn, config, directory(db_path, config), rebuild)
+        if books is not None:
+            print(f'ask: indexed {books} books ({time.monotonic() - started:.1f}s)')
+        if args.every is None:
+            return 0
+        rebuild = False
+        time.sleep(max(0.0, args.every - (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
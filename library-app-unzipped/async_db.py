@@ -0,0 +1,103 @@
+"""SQLite access for the ASGI app without blocking the event loop.
+
+sqlite3 calls block, so ``AsyncDatabase`` runs them on threads and hands the
+results back to the loop. Reads go to a small pool of reader threads, each
+holding one read-only connection for its lifetime; with WAL they run
+concurrently with each other and with writers. The ASGI app only reads
+through it: routes that write are the Flask views, on the sync pool.
+
+Connections are opened with ``db.connect`` and the same DB_* pragmas.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db as db_pool
+
+
+def env_config():
+    """Default async DB settings, overridable through LIB_ASYNC_DB_* environment variables."""
+    return {
+        # reader threads (and read-only connections) per ASGI worker process
+        'ASYNC_DB_READERS': int(os.environ.get('LIB_ASYNC_DB_READERS', 4)),
+        # rows fetched per step of a streamed query
+        'ASYNC_DB_STREAM_CHUNK': int(os.environ.get('LIB_ASYNC_DB_STREAM_CHUNK', 500)),
+    }
+
+
+class AsyncDatabase:
+    def __init__(self, path, config, readers=4, stream_chunk=500):
+        self.path = str(path)
+        self.config = config
+        self.stream_chunk = stream_chunk
+        self._readers = ThreadPoolExecutor(max(readers, 1), thread_name_prefix='db-read')
+        self._local = threading.local()
+        self._conns = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, path, config):
+        return cls(path, config, config['ASYNC_DB_READERS'], config['ASYNC_DB_STREAM_CHUNK'])
+
+    def _connection(self):
+        # one connection per thread, opened on first use and kept until close()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = db_pool.connect(self.path, self.config, readonly=True)
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def _read(self, fn, args):
+        return fn(self._connection(), *args)
+
+    async def read(self, fn, *args):
+        """``fn(conn, *args)`` on a reader thread with a read-only connection."""
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._read, fn, args)
+
+    async def stream(self, sql, params=(), wrap=None):
+        """Yield the rows of a query in lists of up to ``stream_chunk`` rows.
+
+        The query runs on one reader thread, which stays a chunk or two ahead
+        of the consumer and gives up as soon as the consumer stops iterating.
+        ``wrap``, if given, is applied to the connection first (metrics.track).
+        """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        credit = threading.Semaphore(2)
+        stop = threading.Event()
+
+        def produce(conn):
+            try:
+                cursor = (wrap(conn) if wrap else conn).execute(sql, params)
+                while not stop.is_set():
+                    rows = cursor.fetchmany(self.stream_chunk)
+                    while not credit.acquire(timeout=0.1):
+                        if stop.is_set():
+                            return
+                    loop.call_soon_threadsafe(chunks.put_nowait, rows)
+                    if not rows:
+                        return
+            except Exception as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, e)
+
+        loop.run_in_executor(self._readers, self._read, produce, ())
+        try:
+            while True:
+                rows = await chunks.get()
+                credit.release()
+                if isinstance(rows, Exception):
+                    raise rows
+                if not rows:
+                    return
+                yield rows
+        finally:
+            stop.set()
+
+    def close(self):
+        self._readers.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns.clear()
@@ -0,0 +1,91 @@
+"""The checkpointed chunk loop shared by the batch jobs over the borrow
+history (fines.py, analytics.py).
+
+A job has sources: each is the borrows matching some condition, read in
+(key, id) order along a partial index, e.g. new returns along
+``idx_borrows_returned``. The ``checkpoints`` table holds how far each
+source has been read. ``run_chunk`` handles the next chunk of one source in
+a single write transaction, moving the checkpoint in the same commit, so a
+killed job resumes after its last committed chunk and other writers never
+wait on the lock longer than one chunk takes. ``catch_up`` alternates
+between the sources until they are all done, pausing between rounds.
+"""
+import sqlite3
+import sys
+import time
+
+# only borrows returned this many seconds ago or longer are read, so a return
+# committing while a chunk runs can never land behind the checkpoint
+SETTLE_SECONDS = 60
+# past every borrow id: a checkpoint of (ts, END_ID) covers all of second ts
+END_ID = 2 ** 63 - 1
+
+
+def checkpoint(conn, name):
+    row = conn.execute('SELECT ts, id FROM checkpoints WHERE name = ?', (name,)).fetchone()
+    return tuple(row) if row else (0, 0)
+
+
+def run_chunk(conn, name, key, covers, size, bound, write):
+    """Handle the next ``size`` borrows ``br`` matching ``covers`` after
+    checkpoint ``name``, in (br.key, br.id) order up to keys in second
+    ``bound``, and move the checkpoint past them, in one transaction.
+
+    ``write(where, params)`` gets the condition selecting the chunk from
+    borrows br and its parameters, and returns how many rows it wrote.
+    Returns (rows written, whether the source is done up to ``bound``).
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        start = checkpoint(conn, name)
+        # the key of the chunk's last borrow, or the end of the range when fewer are left
+        end = conn.execute(f'SELECT br.{key}, br.id FROM borrows br WHERE {covers}'
+                           f' AND (br.{key}, br.id) > (?, ?) AND br.{key} <= ?'
+                           f' ORDER BY br.{key}, br.id LIMIT 1 OFFSET ?', start + (bound, size - 1)).fetchone()
+        end = tuple(end) if end else (bound, END_ID)
+        written = 0
+        if end > start:
+            where = f'{covers} AND (br.{key}, br.id) > (:from_ts, :from_id) AND (br.{key}, br.id) <= (:to_ts, :to_id)'
+            written = write(where, {'from_ts': start[0], 'from_id': start[1], 'to_ts': end[0], 'to_id': end[1]})
+            conn.execute('INSERT INTO checkpoints (name, ts, id) VALUES (?, ?, ?)'
+                         ' ON CONFLICT (name) DO UPDATE SET ts = excluded.ts, id = excluded.id', (name,) + end)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return written, end[1] == END_ID
+
+
+def catch_up(names, chunk, pause):
+    """Call ``chunk(name)``, which returns (rows written, done), for each
+    source in turn until every one is done, sleeping ``pause`` seconds
+    between rounds; returns {name: rows written}."""
+    totals = dict.fromkeys(names, 0)
+    pending = list(names)
+    while pending:
+        for name in list(pending):
+            written, done = chunk(name)
+            totals[name] += written
+            if done:
+                pending.remove(name)
+        if pending:
+            time.sleep(pause)
+    return totals
+
+
+def repeat(job, every, run):
+    """The main loop of a job's command line: ``run()`` once, or every
+    ``every`` seconds when given, printing what it returns. Returns the exit
+    status."""
+    while True:
+        started = time.monotonic()
+        try:
+            print(f'{job}: {run()} ({time.monotonic() - started:.1f}s)')
+        except sqlite3.OperationalError as e:
+            # the lock stayed busy past the timeout; the next run resumes from the checkpoints
+            print(f'{job}: {e}', file=sys.stderr)
+            if every is None:
+                return 1
+        if every is None:
+            return 0
+        time.sleep(max(0.0, every - (time.monotonic() - started)))
@@ -0,0 +1,91 @@
+"""Result cache for /api/search.
+
+Entries are the serialized JSON response bodies, keyed on the normalized search
+arguments plus the catalog version stamp from the ``meta`` table. Every write to
+``books`` bumps that stamp (see create_db.add_catalog_version), so a cached body
+is never served for an older catalog; stale entries simply stop being asked for
+and age out of the backend.
+
+A backend is any object with ``get(key)``, ``set(key, value)``, ``clear()`` and
+``stats()``. ``MemoryBackend`` is per worker process; a backend shared between
+workers only needs the same four methods.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+def env_config():
+    return {
+        'SEARCH_CACHE_SIZE': int(os.environ.get('LIB_SEARCH_CACHE_SIZE', 1024)),
+        # seconds; the version stamp already handles invalidation, the TTL only
+        # bounds how long unpopular entries hold memory
+        'SEARCH_CACHE_TTL': float(os.environ.get('LIB_SEARCH_CACHE_TTL', 300)),
+    }
+
+
+class MemoryBackend:
+    """In-process LRU with a per-entry time to live."""
+
+    def __init__(self, maxsize=1024, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.evictions += 1
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'maxsize': self.maxsize, 'evictions': self.evictions}
+
+
+class SearchCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return dict(self.backend.stats(), hits=self.hits, misses=self.misses)
@@ -0,0 +1,267 @@
+"""Bulk catalog import and export (CSV or JSON lines).
+
+Imports are read incrementally and written in executemany batches inside one
+transaction; rows that carry an ISBN already in the catalog update that book
+instead of adding a duplicate. Exports stream one row at a time.
+
+Command line:
+    python catalog_io.py import books.csv [--batch-size 5000]
+    python catalog_io.py export books.jsonl
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+
+import create_db
+
+BOOK_FIELDS = ('title', 'author', 'year', 'isbn', 'copies', 'department')
+BATCH_SIZE = 5000
+# how many per-row validation errors an import keeps for its report
+MAX_REPORTED_ERRORS = 20
+
+
+def validate_book(fields):
+    """Apply the admin form rules to a mapping of raw values.
+
+    Returns ``(row, errors)`` where ``row`` is the tuple to store in
+    BOOK_FIELDS order, or None when there are errors.
+    """
+    def text(name, default=''):
+        value = fields.get(name)
+        return default if value is None else str(value).strip()
+
+    title = text('title')
+    author = text('author')
+    year = text('year')
+    isbn = text('isbn')
+    copies = text('copies', '1')
+    department = text('department')
+    errors = []
+    if not title:
+        errors.append('Title is required')
+    if copies and not copies.isdigit():
+        errors.append('Copies must be a number')
+    if year and not year.isdigit():
+        errors.append('Year must be a number')
+    if errors:
+        return None, errors
+    return (title, author, int(year) if year.isdigit() else None, isbn,
+            int(copies) if copies.isdigit() else 1, department), []
+
+
+def detect_format(filename, default='csv'):
+    name = (filename or '').lower()
+    if name.endswith(('.jsonl', '.ndjson', '.json')):
+        return 'jsonl'
+    if name.endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def read_records(stream, fmt):
+    """Yield ``(line_number, mapping)`` from a text stream, one record at a time.
+
+    The mapping is None for a JSON line that does not hold an object.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == 'jsonl':
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            # anything but a JSON object is reported as an invalid row
+            yield line_number, record if isinstance(record, dict) else None
+    else:
+        raise ValueError(f'Unknown format: {fmt}')
+
+
+class ImportReport:
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.errors = []
+        self.seconds = 0.0
+
+    @property
+    def rows(self):
+        return self.inserted + self.updated
+
+    def summary(self):
+        return (f'Imported {self.inserted} new and updated {self.updated} existing books'
+                f', skipped {self.skipped} invalid rows')
+
+
+# Per-row triggers on books that an import suspends for the length of its
+# transaction. Their work (FTS maintenance, facet counts, search terms, copies
+# per department for analytics, the catalog version bump) is done once per batch with set-based statements
+# instead, which is several times faster; other triggers on books keep firing
+# row by row.
+SUSPENDED_TRIGGERS = ('books_fts_ai', 'books_fts_au', 'books_version_insert', 'books_version_update',
+                      'books_facets_insert', 'books_facets_update', 'books_terms_insert', 'books_terms_update',
+                      'books_analytics_insert', 'books_analytics_update')
+
+
+def suspend_triggers(conn):
+    """Drop SUSPENDED_TRIGGERS and return their SQL for restore_triggers.
+
+    Must run inside the import transaction: the drop is invisible to other
+    connections and no other writer can touch books until the commit.
+    """
+    saved = conn.execute(
+        f"SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name IN ({','.join('?' * len(SUSPENDED_TRIGGERS))})",
+        SUSPENDED_TRIGGERS).fetchall()
+    for name in SUSPENDED_TRIGGERS:
+        conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+    return [row[0] for row in saved]
+
+
+def restore_triggers(conn, saved):
+    for sql in saved:
+        conn.execute(sql)
+
+
+def write_batch(conn, batch, report):
+    # the last row for an ISBN in a batch wins, as it would row by row
+    by_isbn = {}
+    rows = []
+    for row in batch:
+        if row[3]:
+            by_isbn[row[3]] = row
+        else:
+            rows.append(row)
+    existing = {}
+    isbns = list(by_isbn)
+    # SQLite allows 32766 host parameters per statement; batches stay far below it
+    if isbns:
+        placeholders = ','.join('?' * len(isbns))
+        existing = dict(conn.execute(
+            f'SELECT isbn, MIN(id) FROM books WHERE isbn IN ({placeholders}) GROUP BY isbn', isbns))
+    updates = [row + (existing[isbn],) for isbn, row in by_isbn.items() if isbn in existing]
+    rows.extend(row for isbn, row in by_isbn.items() if isbn not in existing)
+    if updates:
+        ids = [u[-1] for u in updates]
+        in_ids = f"IN ({','.join('?' * len(ids))})"
+        conn.execute("INSERT INTO books_fts(books_fts, rowid, title, author, isbn)"
+                     f" SELECT 'delete', id, title, author, isbn FROM books WHERE id {in_ids}", ids)
+        create_db.adjust_facet_counts(conn, f'books.id {in_ids}', ids, -1)
+        create_db.adjust_search_terms(conn, f'books.id {in_ids}', ids, -1)
+        create_db.adjust_analytics_departments(conn, f'books.id {in_ids}', ids, -1)
+        conn.executemany('UPDATE books SET title=?,author=?,year=?,isbn=?,copies=?,department=? WHERE id=?', updates)
+        conn.execute(f'INSERT INTO books_fts(rowid, title, author, isbn) SELECT id, title, author, isbn FROM books WHERE id {in_ids}', ids)
+        create_db.adjust_facet_counts(conn, f'books.id {in_ids}', ids)
+        create_db.adjust_search_terms(conn, f'books.id {in_ids}', ids)
+        create_db.adjust_analytics_departments(conn, f'books.id {in_ids}', ids)
+    if rows:
+        last_id = conn.execute('SELECT MAX(id) FROM books').fetchone()[0] or 0
+        conn.executemany('INSERT INTO books (title,author,year,isbn,copies,department) VALUES (?,?,?,?,?,?)', rows)
+        conn.execute('INSERT INTO books_fts(rowid, title, author, isbn) SELECT id, title, author, isbn FROM books WHERE id > ?',
+                     (last_id,))
+        create_db.adjust_facet_counts(conn, 'books.id > ?', (last_id,))
+        create_db.adjust_search_terms(conn, 'books.id > ?', (last_id,))
+        create_db.adjust_analytics_departments(conn, 'books.id > ?', (last_id,))
+    report.updated += len(updates)
+    report.inserted += len(rows)
+
+
+def import_books(conn, records, batch_size=BATCH_SIZE):
+    """Validate and upsert ``(line_number, mapping)`` records in one transaction.
+
+    Invalid rows are skipped and listed in the report; anything else going
+    wrong rolls the whole import back.
+    """
+    report = ImportReport()
+    started = time.perf_counter()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        saved = suspend_triggers(conn)
+        batch = []
+        for line_number, record in records:
+            row, errors = validate_book(record) if record is not None else (None, ['Not a JSON object'])
+            if errors:
+                report.skipped += 1
+                if len(report.errors) < MAX_REPORTED_ERRORS:
+                    report.errors.append(f"Line {line_number}: {', '.join(errors)}")
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                write_batch(conn, batch, report)
+                batch = []
+        if batch:
+            write_batch(conn, batch, report)
+        if report.rows:
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'catalog_version'")
+        restore_triggers(conn, saved)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    report.seconds = time.perf_counter() - started
+    return report
+
+
+def export_books(conn, fmt):
+    """Yield the catalog as CSV or JSON-lines text chunks, one book per chunk."""
+    cur = conn.execute('SELECT id, title, author, year, isbn, copies, department FROM books ORDER BY id')
+    columns = [d[0] for d in cur.description]
+    if fmt == 'jsonl':
+        for r in cur:
+            yield json.dumps(dict(zip(columns, r))) + '\n'
+        return
+    if fmt != 'csv':
+        raise ValueError(f'Unknown format: {fmt}')
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for r in cur:
+        writer.writerow(tuple(r))
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk import or export the book catalog.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    imp = sub.add_parser('import', help='upsert books from a CSV or JSONL file')
+    imp.add_argument('path')
+    imp.add_argument('--format', choices=('csv', 'jsonl'))
+    imp.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    exp = sub.add_parser('export', help='write the catalog to a CSV or JSONL file ("-" for stdout)')
+    exp.add_argument('path')
+    exp.add_argument('--format', choices=('csv', 'jsonl'))
+    args = parser.parse_args(argv)
+
+    conn = create_db.connect()
+    create_db.migrate(conn)
+    fmt = args.format or detect_format(args.path)
+    if args.command == 'import':
+        with open(args.path, newline='', encoding='utf-8') as f:
+            report = import_books(conn, read_records(f, fmt), args.batch_size)
+        print(report.summary())
+        for error in report.errors:
+            print('  ' + error)
+        print(f'{report.rows / report.seconds if report.seconds else 0:.0f} rows/s')
+    else:
+        out = sys.stdout if args.path == '-' else open(args.path, 'w', newline='', encoding='utf-8')
+        try:
+            for chunk in export_books(conn, fmt):
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
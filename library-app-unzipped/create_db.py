@@ -1,45 +1,77 @@
+import argparse
 import sqlite3
+import threading
 from pathlib import Path
 from werkzeug.security import generate_password_hash
 
 BASE = Path(__file__).parent
 DB_PATH = BASE / 'instance' / 'library.db'
-DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-
-conn = sqlite3.connect(DB_PATH)
-cur = conn.cursor()
-cur.execute('''
-CREATE TABLE IF NOT EXISTS books (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    title TEXT NOT NULL,
-    author TEXT,
-    year INTEGER,
-    isbn TEXT,
-    copies INTEGER DEFAULT 1,
-    department TEXT
-)
-''')
-
-cur.execute('''
-CREATE TABLE IF NOT EXISTS students (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    name TEXT NOT NULL,
-    email TEXT UNIQUE NOT NULL,
-    password_hash TEXT NOT NULL
-)
-''')
-
-cur.execute('''
-CREATE TABLE IF NOT EXISTS borrows (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    student_id INTEGER NOT NULL,
-    book_id INTEGER NOT NULL,
-    borrowed_at TEXT NOT NULL,
-    returned_at TEXT,
-    FOREIGN KEY(student_id) REFERENCES students(id),
-    FOREIGN KEY(book_id) REFERENCES books(id)
-)
-''')
+
+
+def create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS books (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT NOT NULL,
+        author TEXT,
+        year INTEGER,
+        isbn TEXT,
+        copies INTEGER DEFAULT 1,
+        department TEXT
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS students (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL
+    )
+    ''')
+
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS borrows (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER NOT NULL,
+        book_id INTEGER NOT NULL,
+        borrowed_at TEXT NOT NULL,
+        returned_at TEXT,
+        FOREIGN KEY(student_id) REFERENCES students(id),
+        FOREIGN KEY(book_id) REFERENCES books(id)
+    )
+    ''')
+
+
+def create_search_index(conn):
+    # full-text index over the searchable book columns; it is an external
+    # content table, so the triggers below are what keep it in sync with books
+    conn.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        title, author, isbn,
+        content='books', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, title, author, isbn) VALUES (new.id, new.title, new.author, new.isbn);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, isbn) VALUES ('delete', old.id, old.title, old.author, old.isbn);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE OF title, author, isbn ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author, isbn) VALUES ('delete', old.id, old.title, old.author, old.isbn);
+        INSERT INTO books_fts(rowid, title, author, isbn) VALUES (new.id, new.title, new.author, new.isbn);
+    END
+    ''')
+    # databases created before the index existed already have books in them
+    conn.execute("INSERT INTO books_fts(books_fts) VALUES ('rebuild')")
+
 
 sample = [
     ('Introduction to Algorithms','Cormen, Leiserson, Rivest',2009,'0262033844',3,'CSE'),
@@ -54,16 +86,611 @@ sample = [
     ('Modern Database Management','Jeffrey A. Hoffer',2012,'0136086203',1,'CSE')
 ]
 
-cur.executemany('INSERT INTO books (title,author,year,isbn,copies,department) VALUES (?,?,?,?,?,?)', sample)
 
-# sample student
-pwd = generate_password_hash('student123')
-try:
-    cur.execute('INSERT INTO students (name,email,password_hash) VALUES (?,?,?)', ('Sample Student', 'student@example.com', pwd))
-except Exception:
-    pass
+def seed(conn):
+    """Add the sample books and the sample student (student@example.com,
+    password student123) for development and tests: ``create_db.py --seed``.
+    Never part of the migrations, so a production database has no login with
+    a published password."""
+    # databases created by older versions of this script already hold the sample
+    # rows (often several times over), so only fill an empty catalog
+    if conn.execute('SELECT 1 FROM books LIMIT 1').fetchone() is None:
+        conn.executemany('INSERT INTO books (title,author,year,isbn,copies,department) VALUES (?,?,?,?,?,?)', sample)
+
+    # sample student
+    pwd = generate_password_hash('student123')
+    conn.execute('INSERT OR IGNORE INTO students (name,email,password_hash) VALUES (?,?,?)',
+                 ('Sample Student', 'student@example.com', pwd))
+
+
+def create_indexes(conn):
+    # catalog browsing and keyset paging: ORDER BY title, id, optionally per department
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_title ON books(title, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_department ON books(department, title, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_year ON books(year)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_available ON books(title, id) WHERE copies > 0')
+    # active borrows per student (the borrow limit check) only touch open loans
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrows_active ON borrows(student_id) WHERE returned_at IS NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrows_student ON borrows(student_id, borrowed_at DESC)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrows_borrowed_at ON borrows(borrowed_at DESC)')
+
+
+def add_active_borrow_counter(conn):
+    # students.active_borrows mirrors the number of open borrows rows so the
+    # borrow limit is a primary-key read instead of a COUNT(*) over borrows
+    conn.execute('ALTER TABLE students ADD COLUMN active_borrows INTEGER NOT NULL DEFAULT 0')
+    repair_active_borrows(conn)
+
+
+ACTIVE_BORROWS_SQL = '(SELECT COUNT(*) FROM borrows WHERE borrows.student_id = students.id AND borrows.returned_at IS NULL)'
+
+
+def check_active_borrows(conn):
+    """Return ``(student_id, stored, actual)`` for every student whose counter is wrong."""
+    return conn.execute(f'''
+        SELECT id, active_borrows, {ACTIVE_BORROWS_SQL} AS actual FROM students
+        WHERE active_borrows IS NOT {ACTIVE_BORROWS_SQL}
+    ''').fetchall()
+
+
+def repair_active_borrows(conn):
+    """Rebuild students.active_borrows from borrows; returns the number of rows fixed."""
+    cur = conn.execute(f'''
+        UPDATE students SET active_borrows = {ACTIVE_BORROWS_SQL}
+        WHERE active_borrows IS NOT {ACTIVE_BORROWS_SQL}
+    ''')
+    return cur.rowcount
+
+
+def add_catalog_version(conn):
+    # meta.catalog_version changes on every write to books (including copies
+    # changing on borrow/return); caches key on it to know they are current
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('catalog_version', 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_version_{event.lower()} AFTER {event} ON books BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'catalog_version';
+        END
+        ''')
+
+
+def add_borrow_version(conn):
+    # meta.borrow_version does for borrows what catalog_version does for books
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('borrow_version', 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS borrows_version_{event.lower()} AFTER {event} ON borrows BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'borrow_version';
+        END
+        ''')
+
+
+def add_isbn_index(conn):
+    # bulk imports upsert by ISBN
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_books_isbn ON books(isbn)')
+
+
+def add_borrow_timestamps(conn):
+    # epoch-second copies of borrowed_at/returned_at: the borrow history pages,
+    # filters and computes durations on integers instead of parsing ISO strings
+    conn.execute('ALTER TABLE borrows ADD COLUMN borrowed_ts INTEGER')
+    conn.execute('ALTER TABLE borrows ADD COLUMN returned_ts INTEGER')
+    conn.execute('''
+        UPDATE borrows SET borrowed_ts = CAST(strftime('%s', borrowed_at) AS INTEGER),
+                           returned_ts = CAST(strftime('%s', returned_at) AS INTEGER)
+    ''')
+    # one index per way /admin/borrows narrows the history, each ending in the
+    # (borrowed_ts, id) keyset order; the old borrowed_at index had no other user
+    conn.execute('DROP INDEX IF EXISTS idx_borrows_borrowed_at')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrows_ts ON borrows(borrowed_ts, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrows_open_ts ON borrows(borrowed_ts, id) WHERE returned_ts IS NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrows_student_ts ON borrows(student_id, borrowed_ts, id)')
+
+
+# facet name -> its value for a books row; {row} is NEW, OLD or books. A NULL
+# value (no department, no year) is left out of that facet.
+FACETS = (
+    ('department', '{row}.department'),
+    ('decade', '{row}.year / 10 * 10'),
+    ('available', '{row}.copies > 0'),
+)
+
+
+def facet_values(row, unless_equal_to=None):
+    """A SELECT of (facet, value) pairs for ``row``; with ``unless_equal_to``,
+    only the facets whose value differs between the two rows."""
+    parts = []
+    for facet, expr in FACETS:
+        value = expr.format(row=row)
+        where = f'{value} IS NOT NULL'
+        if unless_equal_to:
+            where += f' AND {value} IS NOT {expr.format(row=unless_equal_to)}'
+        parts.append(f"SELECT '{facet}', {value} WHERE {where}")
+    return ' UNION ALL '.join(parts)
+
+
+def add_facet_counts(conn):
+    # books per department, per decade and available or not, kept current by
+    # triggers so the search filters can show counts without a GROUP BY over books
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS facet_counts (
+            facet TEXT NOT NULL,
+            value NOT NULL,
+            books INTEGER NOT NULL,
+            PRIMARY KEY (facet, value)
+        ) WITHOUT ROWID
+    ''')
+    add = ('INSERT INTO facet_counts (facet, value, books) SELECT *, 1 FROM ({}) WHERE true'
+           ' ON CONFLICT DO UPDATE SET books = books + 1;')
+    remove = 'UPDATE facet_counts SET books = books - 1 WHERE (facet, value) IN ({});'
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_facets_insert AFTER INSERT ON books BEGIN
+            {add.format(facet_values('NEW'))}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_facets_delete AFTER DELETE ON books BEGIN
+            {remove.format(facet_values('OLD'))}
+        END
+    ''')
+    # most updates are borrow/return changing copies; only facets whose value
+    # changed are touched, so those usually write nothing here
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_facets_update AFTER UPDATE OF department, year, copies ON books BEGIN
+            {remove.format(facet_values('OLD', 'NEW'))}
+            {add.format(facet_values('NEW', 'OLD'))}
+        END
+    ''')
+    repair_facet_counts(conn)
+
+
+def repair_facet_counts(conn):
+    """Recount facet_counts from books, e.g. after a bulk load with the triggers suspended."""
+    conn.execute('DELETE FROM facet_counts')
+    for facet, expr in FACETS:
+        value = expr.format(row='books')
+        conn.execute(f"INSERT INTO facet_counts (facet, value, books) SELECT '{facet}', {value}, COUNT(*)"
+                     f" FROM books WHERE {value} IS NOT NULL GROUP BY {value}")
+
+
+def adjust_facet_counts(conn, where, params=(), sign=1):
+    """Add (``sign`` 1) or take away (-1) the facets of the books matching ``where``,
+    for bulk writes that run with the facet triggers suspended."""
+    for facet, expr in FACETS:
+        value = expr.format(row='books')
+        conn.execute(f"INSERT INTO facet_counts (facet, value, books) SELECT '{facet}', {value}, {sign} * COUNT(*)"
+                     f" FROM books WHERE ({where}) AND {value} IS NOT NULL GROUP BY {value}"
+                     " ON CONFLICT DO UPDATE SET books = books + excluded.books", params)
+
+
+# characters that separate the words of a title or author in search_terms
+# (one nested replace() each, and SQLite's parser allows only so much nesting);
+# lower() folds ASCII only, the full-text index still matches the rest
+TERM_SEPARATORS = ' \t\n,.:;()/&!?"\\\'-'
+# words shorter than this are left out: trigrams say little about them
+MIN_TERM_LENGTH = 3
+
+
+def term_values(row):
+    """A json_each() call yielding the words of ``row``'s title and author."""
+    text = f"lower({row}.title || ' ' || COALESCE({row}.author, ''))"
+    for ch in TERM_SEPARATORS:
+        text = f"replace({text}, '{ch.replace(chr(39), chr(39) * 2)}', ' ')"
+    words = f"""'["' || replace({text}, ' ', '","') || '"]'"""
+    # quotes and backslashes are gone, but other control characters would still
+    # make invalid JSON; such a row contributes no words rather than failing
+    return f"json_each(CASE WHEN json_valid({words}) THEN {words} ELSE '[]' END)"
+
+
+def add_search_terms(conn):
+    # every word of every title and author with the number of books using it,
+    # and a trigram index over those words for typo-tolerant search (fuzzy.py);
+    # the vocabulary stays small as the catalogue grows, so lookups stay cheap
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS search_terms (
+            id INTEGER PRIMARY KEY,
+            term TEXT NOT NULL UNIQUE,
+            books INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS search_terms_trigram USING fts5(
+            term, content='search_terms', content_rowid='id', tokenize='trigram'
+        )
+    ''')
+    # trigram document frequencies, to look candidates up by their rarest trigrams
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS search_terms_trigram_vocab USING fts5vocab(search_terms_trigram, 'row')")
+    # words are never removed, one no book uses any more just has a count of 0
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS search_terms_ai AFTER INSERT ON search_terms BEGIN
+            INSERT INTO search_terms_trigram(rowid, term) VALUES (new.id, new.term);
+        END
+    ''')
+    add = ('INSERT INTO search_terms (term, books) SELECT DISTINCT value, 1 FROM {}'
+           f' WHERE length(value) >= {MIN_TERM_LENGTH} ON CONFLICT (term) DO UPDATE SET books = books + 1;')
+    remove = 'UPDATE search_terms SET books = books - 1 WHERE term IN (SELECT value FROM {});'
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_terms_insert AFTER INSERT ON books BEGIN
+            {add.format(term_values('NEW'))}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_terms_delete AFTER DELETE ON books BEGIN
+            {remove.format(term_values('OLD'))}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_terms_update AFTER UPDATE OF title, author ON books BEGIN
+            {remove.format(term_values('OLD'))}
+            {add.format(term_values('NEW'))}
+        END
+    ''')
+    adjust_search_terms(conn, 'true')
+
+
+def adjust_search_terms(conn, where, params=(), sign=1):
+    """Count in (``sign`` 1) or out (-1) the words of the books matching ``where``
+    (which names columns as books.*), for bulk writes with the term triggers suspended."""
+    conn.execute(f'''
+        INSERT INTO search_terms (term, books)
+        SELECT value, {sign} * COUNT(*) FROM (
+            SELECT DISTINCT books.id, words.value FROM books, {term_values('books')} AS words
+            WHERE ({where}) AND length(words.value) >= {MIN_TERM_LENGTH}
+        ) WHERE true GROUP BY value
+        ON CONFLICT (term) DO UPDATE SET books = books + excluded.books
+    ''', params)
+
+
+def repair_search_terms(conn):
+    """Recount search_terms from books."""
+    conn.execute('UPDATE search_terms SET books = 0')
+    adjust_search_terms(conn, 'true')
+
+
+def add_change_log(conn):
+    # ids of the books written, in commit order, for replica.py to publish to
+    # read replicas. Nothing is logged until a publisher sets
+    # meta.replication_log, and the publisher deletes what it has published.
+    conn.execute('CREATE TABLE IF NOT EXISTS catalog_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, book_id INTEGER NOT NULL)')
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('replication_log', 0)")
+    for event, ids in (('INSERT', 'SELECT NEW.id'), ('UPDATE', 'SELECT NEW.id UNION SELECT OLD.id'),
+                       ('DELETE', 'SELECT OLD.id')):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_changes_{event.lower()} AFTER {event} ON books
+        WHEN (SELECT value FROM meta WHERE key = 'replication_log') = 1 BEGIN
+            INSERT INTO catalog_changes (book_id) {ids};
+        END
+        ''')
+
+
+def add_holds(conn):
+    # per-book first-come, first-served queues of students waiting for a copy
+    # (see holds.py). ready_ts and ready_seq are set when a copy is set aside
+    # for the hold; a hold is deleted once borrowed, cancelled or expired.
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS holds (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER NOT NULL,
+        book_id INTEGER NOT NULL,
+        placed_ts INTEGER NOT NULL,
+        ready_ts INTEGER,
+        ready_seq INTEGER,
+        FOREIGN KEY(student_id) REFERENCES students(id),
+        FOREIGN KEY(book_id) REFERENCES books(id)
+    )
+    ''')
+    # the head of a book's queue: book_id = ? AND ready_ts IS NULL ORDER BY id
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_holds_queue ON holds(book_id, ready_ts, id)')
+    # one hold per student and book, and a student's own holds
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_holds_student ON holds(student_id, book_id)')
+    # ready holds in the order they became ready (the notifier) and by age (expiry)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_holds_ready_seq ON holds(ready_seq) WHERE ready_seq IS NOT NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_holds_ready_ts ON holds(ready_ts) WHERE ready_ts IS NOT NULL')
+    # meta.hold_version does for holds what borrow_version does for borrows
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('hold_version', 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS holds_version_{event.lower()} AFTER {event} ON holds BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'hold_version';
+        END
+        ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS books_holds_delete AFTER DELETE ON books BEGIN
+        DELETE FROM holds WHERE book_id = OLD.id;
+    END
+    ''')
+
+
+# loan period at the time due dates were added; the app sets due_ts itself
+# (app.LOAN_PERIOD_DAYS), this only dates older borrows and rows written by
+# tools that leave due_ts out
+DEFAULT_LOAN_SECONDS = 14 * 86400
+
+
+def add_fines(conn):
+    # borrows.due_ts, and the tables the fines batch job (fines.py) fills
+    conn.execute('ALTER TABLE borrows ADD COLUMN due_ts INTEGER')
+    conn.execute('UPDATE borrows SET due_ts = borrowed_ts + ? WHERE borrowed_ts IS NOT NULL', (DEFAULT_LOAN_SECONDS,))
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS borrows_due_default AFTER INSERT ON borrows
+    WHEN NEW.due_ts IS NULL AND NEW.borrowed_ts IS NOT NULL BEGIN
+        UPDATE borrows SET due_ts = NEW.borrowed_ts + {DEFAULT_LOAN_SECONDS} WHERE id = NEW.id;
+    END
+    ''')
+    # open borrows by due date, for loans that have become overdue, and late
+    # returns by return time; each is a small slice of the borrow history
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrows_due ON borrows(due_ts, id) WHERE returned_ts IS NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrows_late ON borrows(returned_ts, id) WHERE returned_ts > due_ts')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS fines (
+        borrow_id INTEGER PRIMARY KEY,
+        student_id INTEGER NOT NULL,
+        due_ts INTEGER NOT NULL,
+        returned_ts INTEGER,
+        amount_cents INTEGER,
+        assessed_ts INTEGER NOT NULL,
+        FOREIGN KEY(borrow_id) REFERENCES borrows(id),
+        FOREIGN KEY(student_id) REFERENCES students(id)
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_fines_student ON fines(student_id)')
+    # how far each incremental batch job has got, as a (ts, id) keyset position
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS checkpoints (
+        name TEXT PRIMARY KEY,
+        ts INTEGER NOT NULL,
+        id INTEGER NOT NULL
+    )
+    ''')
+    # bumped by fines.py with every chunk it writes, as borrow_version is by triggers
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('fine_version', 0)")
+
+
+def add_ask_changes(conn):
+    # the books written since the /api/ask index was built (see ask.py): each
+    # write gives the book the next meta.ask_seq, and an index built at seq n
+    # scores books changed after n from their rows. One row per book, kept
+    # after rebuilds too, so builders never have to agree on what to delete.
+    conn.execute('CREATE TABLE IF NOT EXISTS ask_changes (book_id INTEGER PRIMARY KEY, seq INTEGER NOT NULL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_ask_changes_seq ON ask_changes(seq)')
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('ask_seq', 0)")
+    for event, book, when in (('INSERT', 'NEW.id', ''), ('DELETE', 'OLD.id', ''),
+                              ('UPDATE', 'NEW.id', 'OF title, author, year, department ')):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS books_ask_{event.lower()} AFTER {event} {when}ON books BEGIN
+            UPDATE meta SET value = value + 1 WHERE key = 'ask_seq';
+            INSERT INTO ask_changes (book_id, seq) VALUES ({book}, (SELECT value FROM meta WHERE key = 'ask_seq'))
+            ON CONFLICT (book_id) DO UPDATE SET seq = excluded.seq;
+        END
+        ''')
+
+
+def add_analytics(conn):
+    # circulation rollups kept by the analytics batch job (analytics.py): per
+    # day and department, per month and book, and per book, so the analytics
+    # page reads a few hundred rollup rows however long the history grows
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS analytics_days (
+        day TEXT NOT NULL,
+        department TEXT NOT NULL,
+        borrows INTEGER NOT NULL DEFAULT 0,
+        returns INTEGER NOT NULL DEFAULT 0,
+        loan_seconds INTEGER NOT NULL DEFAULT 0,
+        late_returns INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, department)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS analytics_book_months (
+        month TEXT NOT NULL,
+        book_id INTEGER NOT NULL,
+        borrows INTEGER NOT NULL,
+        PRIMARY KEY (month, book_id)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_analytics_book_months_top'
+                 ' ON analytics_book_months(month, borrows DESC, book_id)')
+    conn.execute('CREATE TABLE IF NOT EXISTS analytics_books (book_id INTEGER PRIMARY KEY, borrows INTEGER NOT NULL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_analytics_books_top ON analytics_books(borrows DESC, book_id)')
+    # copies owned (on the shelf or out) and on loan per department, as of the last run
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS analytics_departments (
+        department TEXT PRIMARY KEY,
+        copies INTEGER NOT NULL,
+        on_loan INTEGER NOT NULL
+    )
+    ''')
+    # returns in (returned_ts, id) order, for the job to pick up the new ones
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_borrows_returned ON borrows(returned_ts, id) WHERE returned_ts IS NOT NULL')
+    # the time the rollups are complete up to; analytics.py sets it with every run
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('analytics_ts', 0)")
+
+
+def add_analytics_department_copies(conn):
+    # analytics_departments.copies follows the catalogue through triggers:
+    # each book's copies on the shelf count for its department. analytics.py
+    # adds the borrows it counts out to copies and on_loan and takes the
+    # returns away again, so copies is every copy owned, the ones on loan
+    # included, without a pass over books or open borrows per run.
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_analytics_insert AFTER INSERT ON books BEGIN
+            INSERT INTO analytics_departments (department, copies, on_loan)
+            VALUES (COALESCE(NEW.department, ''), COALESCE(NEW.copies, 0), 0)
+            ON CONFLICT (department) DO UPDATE SET copies = copies + excluded.copies;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_analytics_delete AFTER DELETE ON books BEGIN
+            UPDATE analytics_departments SET copies = copies - COALESCE(OLD.copies, 0)
+            WHERE department = COALESCE(OLD.department, '');
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS books_analytics_update AFTER UPDATE OF copies, department ON books BEGIN
+            UPDATE analytics_departments SET copies = copies - COALESCE(OLD.copies, 0)
+            WHERE department = COALESCE(OLD.department, '');
+            INSERT INTO analytics_departments (department, copies, on_loan)
+            VALUES (COALESCE(NEW.department, ''), COALESCE(NEW.copies, 0), 0)
+            ON CONFLICT (department) DO UPDATE SET copies = copies + excluded.copies;
+        END
+    ''')
+    repair_analytics_departments(conn)
+
+
+def repair_analytics_departments(conn):
+    """Recount analytics_departments from books and the borrows analytics.py
+    has counted out and not yet back, e.g. after books moved department while
+    on loan, or a bulk load with the triggers suspended."""
+    conn.execute('DELETE FROM analytics_departments')
+    conn.execute('''
+        INSERT INTO analytics_departments (department, copies, on_loan)
+        SELECT department, SUM(copies), SUM(on_loan) FROM (
+            SELECT COALESCE(department, '') AS department, COALESCE(copies, 0) AS copies, 0 AS on_loan FROM books
+            UNION ALL
+            SELECT COALESCE(b.department, ''), 1, 1 FROM borrows br LEFT JOIN books b ON b.id = br.book_id
+            WHERE (br.borrowed_ts, br.id) <= (SELECT ts, id FROM checkpoints WHERE name = 'analytics_borrowed')
+              AND NOT COALESCE((br.returned_ts, br.id) <= (SELECT ts, id FROM checkpoints WHERE name = 'analytics_returned'), 0)
+        ) GROUP BY department
+    ''')
+
+
+def adjust_analytics_departments(conn, where, params=(), sign=1):
+    """Add (``sign`` 1) or take away (-1) the copies of the books matching
+    ``where``, for bulk writes that run with the analytics triggers suspended."""
+    conn.execute(f"INSERT INTO analytics_departments (department, copies, on_loan)"
+                 f" SELECT COALESCE(department, ''), {sign} * SUM(COALESCE(copies, 0)), 0 FROM books"
+                 f" WHERE ({where}) GROUP BY 1"
+                 " ON CONFLICT (department) DO UPDATE SET copies = copies + excluded.copies", params)
+
+
+# Schema history. A database records how many of these it has applied in
+# PRAGMA user_version; append new steps, never edit or reorder existing ones.
+MIGRATIONS = [
+    create_tables,
+    create_search_index,
+    create_indexes,
+    add_active_borrow_counter,
+    add_catalog_version,
+    add_borrow_version,
+    add_isbn_index,
+    add_borrow_timestamps,
+    add_facet_counts,
+    add_search_terms,
+    add_change_log,
+    add_holds,
+    add_fines,
+    add_ask_changes,
+    add_analytics,
+    add_analytics_department_copies,
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Apply the pending migrations, each in its own transaction.
+
+    Returns the list of step numbers that were applied. ``conn`` must be in
+    autocommit mode (``isolation_level=None``) so the runner controls the
+    transactions itself.
+    """
+    applied = []
+    version = schema_version(conn)
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            step(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        applied.append(number)
+    return applied
+
+
+def connect(path=DB_PATH):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    return sqlite3.connect(path, isolation_level=None)
+
+
+# sample -> in-memory database with every migration applied, and seed() too
+# when sample is true
+_templates = {}
+_template_lock = threading.Lock()
+
+
+def template(sample=False):
+    """An in-memory database with every migration applied, and the sample data
+    in it when ``sample`` is true, built once per process for copy_template."""
+    with _template_lock:
+        if sample not in _templates:
+            conn = sqlite3.connect(':memory:', isolation_level=None, check_same_thread=False)
+            migrate(conn)
+            if sample:
+                conn.execute('BEGIN IMMEDIATE')
+                seed(conn)
+                conn.execute('COMMIT')
+            _templates[sample] = conn
+    return _templates[sample]
+
+
+def copy_template(conn, sample=False):
+    """Make the database behind ``conn`` a copy of template(sample). The backup
+    API copies it page by page, which is much quicker than running the
+    migrations again and hashing the sample student's password."""
+    source = template(sample)
+    with _template_lock:
+        source.backup(conn)
+
+
+def init_database(conn):
+    """Fill a database that has nothing in it yet (a new file, or an in-memory
+    one) with the schema from the template, without the sample data; one that
+    has tables is left alone."""
+    if conn.execute('SELECT 1 FROM sqlite_master LIMIT 1').fetchone() is None:
+        copy_template(conn)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create or migrate the library database.')
+    parser.add_argument('--seed', action='store_true',
+                        help='add the sample books and the sample student (for development only)')
+    parser.add_argument('--check-counters', action='store_true',
+                        help='report students whose active_borrows counter disagrees with borrows')
+    parser.add_argument('--repair-counters', action='store_true',
+                        help='rebuild every active_borrows counter from borrows, and the search facet and term counts')
+    args = parser.parse_args(argv)
+
+    conn = connect()
+    applied = migrate(conn)
+    if applied:
+        print(f'Migrated database at {DB_PATH} to version {applied[-1]}')
+    else:
+        print(f'Database at {DB_PATH} is up to date (version {len(MIGRATIONS)})')
+    if args.seed:
+        conn.execute('BEGIN IMMEDIATE')
+        seed(conn)
+        conn.execute('COMMIT')
+        print('Added the sample books and student@example.com (password student123)')
+    if args.check_counters:
+        bad = check_active_borrows(conn)
+        for student_id, stored, actual in bad:
+            print(f'student {student_id}: active_borrows={stored}, open borrows={actual}')
+        print(f'{len(bad)} inconsistent counter(s)')
+    if args.repair_counters:
+        conn.execute('BEGIN IMMEDIATE')
+        fixed = repair_active_borrows(conn)
+        repair_facet_counts(conn)
+        repair_search_terms(conn)
+        repair_analytics_departments(conn)
+        conn.execute('COMMIT')
+        print(f'Repaired {fixed} counter(s)')
+    conn.close()
 
-conn.commit()
-conn.close()
 
-print('Created database at', DB_PATH)
+if __name__ == '__main__':
+    main()
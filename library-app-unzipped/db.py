@@ -0,0 +1,159 @@
+"""SQLite connection pooling for the app.
+
+Each worker process keeps a small pool of open connections per database file:
+one pool of read-write connections and one of read-only connections. Opening a
+connection and applying the pragmas happens once per pooled connection instead
+of once per request.
+
+A database is a file path or an in-memory target from ``memory_path``; the
+latter lives in the process, for tests and benchmarks that should not touch
+the disk.
+"""
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+
+
+def env_config():
+    """Default DB settings, overridable through LIB_DB_* environment variables."""
+    return {
+        'DB_POOL_SIZE': int(os.environ.get('LIB_DB_POOL_SIZE', 8)),
+        'DB_JOURNAL_MODE': os.environ.get('LIB_DB_JOURNAL_MODE', 'WAL'),
+        'DB_SYNCHRONOUS': os.environ.get('LIB_DB_SYNCHRONOUS', 'NORMAL'),
+        # milliseconds a connection waits for a lock before SQLITE_BUSY
+        'DB_BUSY_TIMEOUT': int(os.environ.get('LIB_DB_BUSY_TIMEOUT', 5000)),
+        'DB_MMAP_SIZE': int(os.environ.get('LIB_DB_MMAP_SIZE', 256 * 1024 * 1024)),
+        # negative values are KiB, as in PRAGMA cache_size
+        'DB_CACHE_SIZE': int(os.environ.get('LIB_DB_CACHE_SIZE', -64000)),
+    }
+
+
+def memory_path(name):
+    """A database that lives in this process's memory, shared by every
+    connection that opens the same ``name``.
+
+    It uses the memdb VFS rather than a shared-cache ``mode=memory`` database:
+    shared-cache connections lock whole tables and fail at once on a lock,
+    while memdb locks like a file, so a reader waits out a write within
+    busy_timeout.
+    """
+    return f'file:/{name}?vfs=memdb'
+
+
+def is_memory(path):
+    return str(path).startswith('file:') and 'vfs=memdb' in str(path)
+
+
+def beside(path, suffix):
+    """Where files kept alongside database ``path`` go: next to a file, or in
+    the temp directory for an in-memory database."""
+    if is_memory(path):
+        return os.path.join(tempfile.gettempdir(), str(path)[len('file:'):].split('?')[0].lstrip('/') + suffix)
+    return str(path) + suffix
+
+
+def connect(path, config, readonly=False):
+    if is_memory(path):
+        conn = sqlite3.connect(path, uri=True, check_same_thread=False, timeout=config['DB_BUSY_TIMEOUT'] / 1000)
+        if readonly:
+            conn.execute('PRAGMA query_only = 1')
+    elif readonly:
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False,
+                               timeout=config['DB_BUSY_TIMEOUT'] / 1000)
+        conn.execute('PRAGMA query_only = 1')
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False, timeout=config['DB_BUSY_TIMEOUT'] / 1000)
+        # the journal mode is stored in the database file, so only writers set it
+        conn.execute(f"PRAGMA journal_mode = {config['DB_JOURNAL_MODE']}")
+    conn.execute(f"PRAGMA synchronous = {config['DB_SYNCHRONOUS']}")
+    conn.execute(f"PRAGMA busy_timeout = {int(config['DB_BUSY_TIMEOUT'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(config['DB_MMAP_SIZE'])}")
+    conn.execute(f"PRAGMA cache_size = {int(config['DB_CACHE_SIZE'])}")
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+class ConnectionPool:
+    """Keeps up to ``size`` idle connections to one database file.
+
+    ``acquire`` never blocks: when no idle connection is left a new one is
+    opened, and ``release`` closes connections beyond ``size``.
+    """
+
+    def __init__(self, path, config, readonly=False):
+        self.path = path
+        self.config = config
+        self.readonly = readonly
+        self.size = config['DB_POOL_SIZE']
+        self.idle = queue.LifoQueue(maxsize=max(self.size, 1))
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return connect(self.path, self.config, self.readonly)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self.size <= 0:
+            conn.close()
+            return
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools = {}
+# (pid, path) -> the connection keeping an in-memory database alive, or None
+# for a file, once the database has been opened in this process
+_opened = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path, config, readonly=False, init=None):
+    """The pool for ``path``. When ``init`` is given, the first time a process
+    asks for the database ``init(conn)`` runs on a read-write connection
+    before any pool hands one out, and an in-memory database keeps that
+    connection, so it lasts until close_pools() rather than until its last
+    pooled connection closes. Without ``init`` nothing is opened here, and a
+    read-only pool never creates a missing file."""
+    # keyed on the pid too: connections must not be shared across a fork, so a
+    # forked gunicorn worker starts with pools of its own
+    key = (os.getpid(), str(path), readonly)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                if init is not None and key[:2] not in _opened:
+                    conn = connect(str(path), config)
+                    if init is not None:
+                        init(conn)
+                    if not is_memory(path):
+                        conn.close()
+                        conn = None
+                    _opened[key[:2]] = conn
+                pool = _pools[key] = ConnectionPool(str(path), config, readonly)
+    return pool
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+        for conn in _opened.values():
+            if conn is not None:
+                conn.close()
+        _opened.clear()
@@ -0,0 +1,116 @@
+"""Overdue fines, assessed by a batch job: ``python fines.py`` (from cron, or
+with --every to keep running).
+
+A borrow earns a fine in one of two ways, and the job finds each through an
+index of its own (see create_db.add_fines), picking up after the checkpoint
+the previous run left in the ``checkpoints`` table (see batch.py):
+
+- still out past its due date: ``idx_borrows_due`` holds only open borrows,
+  by (due_ts, id); these get a fine row that keeps growing until the return;
+- returned after its due date: ``idx_borrows_late`` holds only late returns,
+  by (returned_ts, id); these get their fine settled into amount_cents.
+
+A run therefore reads what changed since the last one, not the whole borrow
+history. It works in chunks of FINES_CHUNK borrows. Each chunk is one short
+write transaction: a single INSERT ... SELECT writes its fines, and the
+checkpoint moves in the same commit. The job can be killed at any point and
+resumes after the last committed chunk, and borrow and return requests never
+wait for the lock longer than one chunk takes. It sleeps FINES_PAUSE seconds
+between chunks so they get it.
+
+A fine is FINE_PER_DAY cents for every started day late, up to FINE_MAX.
+While the book is still out its amount is worked out from due_ts whenever it
+is read (``amount_sql``).
+"""
+import argparse
+import os
+import sys
+import time
+
+import batch
+import create_db
+import db as db_pool
+
+
+def env_config():
+    """Default fine settings, overridable through LIB_FINE_* / LIB_FINES_* environment variables."""
+    return {
+        # cents per started day a book is late, and the most one borrow can cost
+        'FINE_PER_DAY': int(os.environ.get('LIB_FINE_PER_DAY', 25)),
+        'FINE_MAX': int(os.environ.get('LIB_FINE_MAX', 1000)),
+        # borrows per write transaction, and seconds between transactions
+        'FINES_CHUNK': int(os.environ.get('LIB_FINES_CHUNK', 2000)),
+        'FINES_PAUSE': float(os.environ.get('LIB_FINES_PAUSE', 0.05)),
+    }
+
+
+def amount_sql(config, due, end):
+    """SQL for the fine, in cents, on a book due at ``due`` and back (or
+    still out) at ``end``; both are SQL expressions."""
+    return f"MIN(({end} - {due} + 86399) / 86400 * {int(config['FINE_PER_DAY'])}, {int(config['FINE_MAX'])})"
+
+
+# name -> (key column, the borrows the source covers, the fines written for
+# them). Each source is read in (key, id) order along its partial index.
+SOURCES = {
+    'fines_overdue': ('due_ts', 'br.returned_ts IS NULL', '''
+        INSERT INTO fines (borrow_id, student_id, due_ts, assessed_ts)
+        SELECT br.id, br.student_id, br.due_ts, :now FROM borrows br WHERE {where}
+        ON CONFLICT (borrow_id) DO NOTHING'''),
+    'fines_returned': ('returned_ts', 'br.returned_ts > br.due_ts', '''
+        INSERT INTO fines (borrow_id, student_id, due_ts, returned_ts, amount_cents, assessed_ts)
+        SELECT br.id, br.student_id, br.due_ts, br.returned_ts, {amount}, :now FROM borrows br WHERE {where}
+        ON CONFLICT (borrow_id) DO UPDATE SET returned_ts = excluded.returned_ts, amount_cents = excluded.amount_cents'''),
+}
+
+
+def run_chunk(conn, config, name, bound, now):
+    """Write the fines for the next chunk of source ``name``, up to keys in
+    second ``bound``, and move its checkpoint past it, in one transaction.
+
+    Returns (fines written, whether the source is done up to ``bound``).
+    """
+    key, covers, insert = SOURCES[name]
+
+    def write(where, params):
+        written = conn.execute(insert.format(where=where, amount=amount_sql(config, 'br.due_ts', 'br.returned_ts')),
+                               dict(params, now=now)).rowcount
+        if written:
+            conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'fine_version'")
+        return written
+    return batch.run_chunk(conn, name, key, covers, config['FINES_CHUNK'], bound, write)
+
+
+def run(conn, config, now=None):
+    """Catch up with every source; returns {source name: fines written}.
+
+    ``conn`` must be in autocommit mode (``isolation_level=None``).
+    """
+    now = int(time.time()) if now is None else now
+    bound = now - batch.SETTLE_SECONDS
+    return batch.catch_up(SOURCES, lambda name: run_chunk(conn, config, name, bound, now), config['FINES_PAUSE'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Assess overdue fines for the borrows changed since the last run.')
+    parser.add_argument('--every', type=float, help='keep running, starting a run this many seconds after the last')
+    parser.add_argument('--chunk', type=int, help='borrows per write transaction (LIB_FINES_CHUNK)')
+    parser.add_argument('--pause', type=float, help='seconds between transactions (LIB_FINES_PAUSE)')
+    args = parser.parse_args(argv)
+
+    config = dict(db_pool.env_config(), **env_config())
+    if args.chunk:
+        config['FINES_CHUNK'] = args.chunk
+    if args.pause is not None:
+        config['FINES_PAUSE'] = args.pause
+    conn = db_pool.connect(os.environ.get('LIB_DB_PATH') or create_db.DB_PATH, config)
+    conn.isolation_level = None
+
+    def once():
+        totals = run(conn, config)
+        return f"{totals['fines_overdue']} newly overdue, {totals['fines_returned']} returned late"
+    return batch.repeat('fines', args.every, once)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""Typo-tolerant matching for /api/search.
+
+Every word of every title and author is counted in ``search_terms`` and
+indexed by trigram in ``search_terms_trigram``; triggers on books keep both
+current (create_db.add_search_terms). A misspelt query word ("tanenbum") is
+looked up in that vocabulary: the words sharing two of its rarest trigrams
+are the candidates, and those similar enough become its corrections. Books
+containing a correction of every query word are then found through the
+regular full-text index and ordered by how close their words are.
+
+The vocabulary grows with the number of distinct words rather than books, so
+finding corrections costs about the same for 500k books as for 500.
+"""
+import itertools
+import re
+
+# Jaccard similarity of padded trigram sets below which a word is no match
+# (pg_trgm's default; a swap of two letters in an 8-letter word scores 0.38)
+MIN_SIMILARITY = 0.3
+# one typo changes at most four of a word's trigrams (a swap of two letters),
+# so of the query word's six rarest trigrams the intended word has at least
+# two, and candidates are the words sharing a pair of them
+PROBE_TRIGRAMS = 6
+BROKEN_TRIGRAMS = 4
+# vocabulary words scored per query word, and corrections kept of those
+CANDIDATE_TERMS = 1000
+CORRECTIONS_PER_WORD = 3
+# books fetched (in index order) to rank by similarity
+CANDIDATE_BOOKS = 200
+
+TERMS_SQL = ("SELECT t.term FROM search_terms_trigram JOIN search_terms t ON t.id = search_terms_trigram.rowid"
+             " WHERE search_terms_trigram MATCH ? AND t.books > 0 AND length(t.term) BETWEEN ? AND ? LIMIT ?")
+
+
+def trigrams(word):
+    # padded as pg_trgm does, so short words and the start of a word count
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def corrections(db, word):
+    """[(term, similarity)] for the vocabulary words closest to ``word``, best first."""
+    # a word the catalogue has is taken as spelt right
+    if db.execute('SELECT 1 FROM search_terms WHERE term = ? AND books > 0', (word,)).fetchone():
+        return [(word, 1.0)]
+    grams = sorted({word[i:i + 3] for i in range(len(word) - 2)})
+    if not grams:
+        return []
+    present = [r[0] for r in db.execute('SELECT term FROM search_terms_trigram_vocab'
+                                        f" WHERE term IN ({','.join('?' * len(grams))}) ORDER BY doc", grams)]
+    probes = present[:PROBE_TRIGRAMS]
+    if not probes:
+        return []
+    # trigrams no word has are among those the typo changed
+    broken = max(0, BROKEN_TRIGRAMS - (len(grams) - len(present)))
+    if len(probes) - broken >= 2:
+        match = ' OR '.join('("%s" AND "%s")' % pair for pair in itertools.combinations(probes, 2))
+    else:
+        match = ' OR '.join('"%s"' % g for g in probes)
+    # one typo changes the length by at most one
+    terms = [r[0] for r in db.execute(TERMS_SQL, (match, len(word) - 1, len(word) + 1, CANDIDATE_TERMS))]
+    wanted = trigrams(word)
+    scored = []
+    for t in terms:
+        have = trigrams(t)
+        scored.append((len(wanted & have) / len(wanted | have), t))
+    scored.sort(reverse=True)
+    return [(t, s) for s, t in scored[:CORRECTIONS_PER_WORD] if s >= MIN_SIMILARITY]
+
+
+def fuzzy_match(db, words):
+    """(FTS5 query, {word: corrections}) for books with a close spelling of each word.
+
+    Words with no close spelling anywhere in the catalogue are left out of the
+    query rather than ruling everything out; the query is None when that
+    leaves nothing to match.
+    """
+    found = {}
+    for word in dict.fromkeys(w.lower() for w in words):
+        close = corrections(db, word)
+        if close:
+            found[word] = close
+    if not found:
+        return None, {}
+    groups = ['(' + ' OR '.join('"%s"' % t.replace('"', '""') for t, _ in close) + ')' for close in found.values()]
+    return ' AND '.join(groups), found
+
+
+def score(row, found):
+    """Mean over the query words of the closest correction present in ``row``."""
+    words = set(re.findall(r'\w+', f"{row['title']} {row['author'] or ''}".lower()))
+    return sum(max((s for t, s in close if t in words), default=0.0) for close in found.values()) / len(found)
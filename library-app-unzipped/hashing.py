@@ -0,0 +1,128 @@
+"""Password hashing off the request threads.
+
+Key derivation is deliberately slow, and a burst of logins (semester start)
+used to keep every worker busy hashing while searches queued behind them.
+``Hasher`` runs the KDF in a small process pool at a lower CPU priority and
+admits only a bounded number of hashes at a time; past that it raises
+``HashingBusy`` straight away, which the app answers with a 503, instead of
+letting the backlog grow. The pool and the limit belong to the process, so
+they bound the host when one process serves requests on threads, as the
+Procfile runs gunicorn.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+def env_config():
+    """Default hashing settings, overridable through LIB_HASH_* environment variables."""
+    return {
+        # any werkzeug method string; stored hashes made with other parameters
+        # are upgraded on the next successful login
+        'HASH_METHOD': os.environ.get('LIB_HASH_METHOD', 'scrypt:32768:8:1'),
+        # hashing processes per app process; 0 hashes inline on the request thread
+        'HASH_WORKERS': int(os.environ.get('LIB_HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2))),
+        # hashes allowed to wait for a process before new ones are refused
+        'HASH_QUEUE_SIZE': int(os.environ.get('LIB_HASH_QUEUE_SIZE', 8)),
+        # seconds a request waits for its hash before giving up
+        'HASH_TIMEOUT': float(os.environ.get('LIB_HASH_TIMEOUT', 5)),
+        # added to the hashing processes' nice value so request handling wins the CPU
+        'HASH_NICE': int(os.environ.get('LIB_HASH_NICE', 5)),
+    }
+
+
+def _mp_context():
+    # the app serves requests on threads (gunicorn gthread as in the Procfile, the
+    # dev server, uvicorn's sync threads), and forking a threaded process can copy
+    # a lock some other thread holds; start hashing processes from a clean server instead
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _lower_priority(nice):
+    # os.nice only exists on Unix; elsewhere the hashing processes keep the
+    # normal priority and the bounded queue alone protects request handling
+    if hasattr(os, 'nice'):
+        os.nice(nice)
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class Hasher:
+    def __init__(self, method='scrypt:32768:8:1', workers=1, queue_size=8, timeout=5.0, nice=5):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self.nice = nice
+        self.slots = threading.BoundedSemaphore(workers + queue_size) if workers > 0 else None
+        self.refused = 0
+        self._prefix = None
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['HASH_METHOD'], config['HASH_WORKERS'], config['HASH_QUEUE_SIZE'],
+                   config['HASH_TIMEOUT'], config['HASH_NICE'])
+
+    def executor(self):
+        # a pool must not be shared across a fork, so each worker process starts its own
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=_mp_context(),
+                                                     initializer=_lower_priority, initargs=(self.nice,))
+                self._pid = os.getpid()
+            return self._executor
+
+    def run(self, fn, *args):
+        if self.slots is None:
+            return fn(*args)
+        if not self.slots.acquire(blocking=False):
+            self.refused += 1
+            raise HashingBusy('Too many sign-ins right now, please try again in a moment.')
+        try:
+            future = self.executor().submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            future.cancel()
+            self.refused += 1
+            raise HashingBusy('Sign-in is taking too long right now, please try again in a moment.') from None
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """True when ``pwhash`` was made with other KDF parameters than ``method``.
+
+        The first call hashes once through the pool to learn the stored form,
+        so it can raise HashingBusy like hash().
+        """
+        if self._prefix is None:
+            # werkzeug spells out default parameters in the stored hash ("scrypt"
+            # is stored as "scrypt:32768:8:1"), so learn the stored form once
+            self._prefix = self.hash('').split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def stats(self):
+        return {'method': self.method, 'workers': self.workers, 'refused': self.refused}
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+            self._pid = None
@@ -0,0 +1,210 @@
+"""Hold queues for books with no copy on the shelf, and the notifier that
+tells students their copy is ready.
+
+Each book has a first-come, first-served queue of ``holds`` rows. A copy
+that comes back (a return, or a ready hold that is cancelled or not
+collected in time) goes through ``pass_on``: it is set aside for the oldest
+waiting hold of its book instead of going back on the shelf, and only that
+student can borrow it for the next HOLD_PICKUP_DAYS. Every step is a lookup
+on one of the indexes create_db.add_holds puts on ``holds``, so it costs
+O(log n) in the number of holds whatever the length of a queue.
+
+Students hear about a ready copy from /student/events, a Server-Sent Events
+stream, instead of polling searches. Each process runs one ``Notifier``: a
+thread that looks for holds past the last ``ready_seq`` it saw, one index
+probe every HOLD_EVENTS_POLL seconds however many streams are open, and
+wakes only the streams of the students concerned. The same thread also
+expires copies nobody collected, so the next in line is readied and told
+even when no borrow, return or hold request comes along to do it.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def env_config():
+    """Default hold settings, overridable through LIB_HOLD_* environment variables."""
+    return {
+        # days a copy set aside for a hold waits to be borrowed before it goes to the next in line
+        'HOLD_PICKUP_DAYS': float(os.environ.get('LIB_HOLD_PICKUP_DAYS', 3)),
+        # seconds between the notifier's checks for newly ready holds
+        'HOLD_EVENTS_POLL': float(os.environ.get('LIB_HOLD_EVENTS_POLL', 1)),
+        # seconds between keep-alive comments on an idle event stream
+        'HOLD_EVENTS_KEEPALIVE': float(os.environ.get('LIB_HOLD_EVENTS_KEEPALIVE', 15)),
+        # seconds before the server ends an event stream; browsers reconnect by themselves
+        'HOLD_EVENTS_TIMEOUT': float(os.environ.get('LIB_HOLD_EVENTS_TIMEOUT', 300)),
+    }
+
+
+# milliseconds a browser waits before reconnecting a closed event stream
+RETRY_MS = 3000
+
+
+def place(db, student_id, book_id, now):
+    """Join the queue for ``book_id``; False when the student already holds it."""
+    try:
+        db.execute('INSERT INTO holds (student_id, book_id, placed_ts) VALUES (?, ?, ?)', (student_id, book_id, now))
+    except sqlite3.IntegrityError:
+        return False
+    return True
+
+
+def pass_on(db, book_id, now):
+    """Give a copy of ``book_id`` that came back to the oldest waiting hold,
+    or put it back on the shelf when nobody is waiting. Returns the id of the
+    hold it went to, or None."""
+    head = db.execute('SELECT id FROM holds WHERE book_id = ? AND ready_ts IS NULL ORDER BY id LIMIT 1',
+                      (book_id,)).fetchone()
+    if head is None:
+        db.execute('UPDATE books SET copies = copies + 1 WHERE id = ?', (book_id,))
+        return None
+    # the holds_version_update trigger then bumps hold_version to this same
+    # value, so ready_seq numbers ready holds in commit order without repeats
+    db.execute("UPDATE holds SET ready_ts = ?, ready_seq = (SELECT value + 1 FROM meta WHERE key = 'hold_version')"
+               ' WHERE id = ?', (now, head[0]))
+    return head[0]
+
+
+def take(db, student_id, book_id):
+    """Drop the student's hold on ``book_id`` as they borrow it. True when a
+    copy was set aside for them, False when the borrow comes off the shelf."""
+    row = db.execute('SELECT id, ready_ts FROM holds WHERE student_id = ? AND book_id = ?',
+                     (student_id, book_id)).fetchone()
+    if row is None:
+        return False
+    db.execute('DELETE FROM holds WHERE id = ?', (row[0],))
+    return row[1] is not None
+
+
+def cancel(db, hold_id, student_id, now):
+    """Withdraw one of the student's holds, passing on its copy if one was set
+    aside. False when the student has no such hold."""
+    row = db.execute('SELECT book_id, ready_ts FROM holds WHERE id = ? AND student_id = ?',
+                     (hold_id, student_id)).fetchone()
+    if row is None:
+        return False
+    db.execute('DELETE FROM holds WHERE id = ?', (hold_id,))
+    if row[1] is not None:
+        pass_on(db, row[0], now)
+    return True
+
+
+def expire(db, now, pickup_seconds):
+    """Pass on the copies of ready holds not borrowed within ``pickup_seconds``;
+    returns how many expired. Usually a single probe that finds nothing."""
+    expired = db.execute('SELECT id, book_id FROM holds WHERE ready_ts < ?', (now - pickup_seconds,)).fetchall()
+    for hold_id, book_id in expired:
+        db.execute('DELETE FROM holds WHERE id = ?', (hold_id,))
+        pass_on(db, book_id, now)
+    return len(expired)
+
+
+def lapsed(conn, now, pickup_seconds):
+    """True when some ready hold is past its pickup window; one probe of
+    idx_holds_ready_ts, so a read-only connection can check before writing."""
+    return conn.execute('SELECT 1 FROM holds WHERE ready_ts < ? LIMIT 1',
+                        (now - pickup_seconds,)).fetchone() is not None
+
+
+def ready_holds(conn, student_id, after):
+    """The student's ready holds with a ready_seq past ``after``, oldest first."""
+    return conn.execute('''
+        SELECT h.id AS hold_id, h.book_id, b.title, h.ready_ts, h.ready_seq
+        FROM holds h JOIN books b ON b.id = h.book_id
+        WHERE h.student_id = ? AND h.ready_seq > ?
+        ORDER BY h.ready_seq
+    ''', (student_id, after)).fetchall()
+
+
+def last_event_id(value):
+    # sent back by a reconnecting EventSource; anything unparsable starts over
+    try:
+        return int(value or 0)
+    except ValueError:
+        return 0
+
+
+def format_event(row, pickup_seconds):
+    """One ``ready`` event of the /student/events stream, as text."""
+    data = {'hold_id': row['hold_id'], 'book_id': row['book_id'], 'title': row['title'],
+            'ready_ts': row['ready_ts'], 'expires_ts': int(row['ready_ts'] + pickup_seconds)}
+    return f"id: {row['ready_seq']}\nevent: ready\ndata: {json.dumps(data)}\n\n"
+
+
+KEEPALIVE = ': keep-alive\n\n'
+
+
+class Notifier:
+    """Wakes the event streams of students whose holds became ready.
+
+    ``subscribe`` registers a callable to run when one of the student's holds
+    becomes ready; it is called on the notifier's thread, so it should only
+    hand the news over (set an Event, schedule a callback on a loop). The
+    thread runs while anyone is subscribed and reads through the connection
+    pool ``get_pool()`` returns. When given, ``expire()`` runs before each
+    check to pass on uncollected copies, so their next holders are found by
+    the same check.
+    """
+
+    def __init__(self, get_pool, poll=1.0, expire=None):
+        self.get_pool = get_pool
+        self.poll = poll
+        self.expire = expire
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.seq = 0
+        self.thread = None
+
+    def subscribe(self, student_id, wake):
+        with self.lock:
+            self.subscribers.setdefault(student_id, set()).add(wake)
+            if self.thread is None:
+                # start from the current version before the subscriber reads
+                # its own holds, so nothing readied in between is missed
+                self.seq = self.read(lambda conn: conn.execute(
+                    "SELECT value FROM meta WHERE key = 'hold_version'").fetchone()[0])
+                self.thread = threading.Thread(target=self.run, name='hold-notifier', daemon=True)
+                self.thread.start()
+
+    def unsubscribe(self, student_id, wake):
+        with self.lock:
+            wakes = self.subscribers.get(student_id)
+            if wakes is not None:
+                wakes.discard(wake)
+                if not wakes:
+                    del self.subscribers[student_id]
+
+    def read(self, fn):
+        pool = self.get_pool()
+        conn = pool.acquire()
+        try:
+            return fn(conn)
+        finally:
+            pool.release(conn)
+
+    def run(self):
+        while True:
+            time.sleep(self.poll)
+            with self.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    return
+            try:
+                self.check()
+            except sqlite3.Error:
+                # locked or mid-migration; the next round tries again
+                pass
+
+    def check(self):
+        if self.expire is not None:
+            self.expire()
+        rows = self.read(lambda conn: conn.execute(
+            'SELECT student_id, ready_seq FROM holds WHERE ready_seq > ? ORDER BY ready_seq', (self.seq,)).fetchall())
+        for student_id, seq in rows:
+            self.seq = seq
+            with self.lock:
+                wakes = list(self.subscribers.get(student_id, ()))
+            for wake in wakes:
+                wake()
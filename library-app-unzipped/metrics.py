@@ -0,0 +1,297 @@
+"""Request, SQL and template timing, exposed in the Prometheus text format.
+
+``init_app`` registers request hooks and template signals that feed
+per-endpoint histograms: request latency, queries and SQL time per request,
+and template render time. SQL is timed by ``track``, which wraps the
+connections the app hands out for the current request. Values are kept per
+worker process, like the search cache; a scraper sums the workers.
+
+With METRICS_ENABLED off nothing is registered and ``track`` returns the
+connection itself, so the cost is one attribute lookup per ``get_db`` call.
+
+The sampling profiler is opt-in: with PROFILE_SAMPLE_RATE above zero that
+share of requests runs under cProfile, and those that take at least
+PROFILE_SLOW_MS are written to PROFILE_DIR as ``.prof`` files (open them
+with ``python -m pstats``).
+"""
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+
+from flask import g, request, template_rendered, before_render_template
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def env_config():
+    """Default metrics settings, overridable through LIB_METRICS_* / LIB_PROFILE_* environment variables."""
+    return {
+        'METRICS_ENABLED': os.environ.get('LIB_METRICS_ENABLED', '1') not in ('0', 'false', 'no', ''),
+        # when set, /metrics requires "Authorization: Bearer <token>"
+        'METRICS_TOKEN': os.environ.get('LIB_METRICS_TOKEN', ''),
+        # share of requests (0..1) run under cProfile; 0 turns the profiler off
+        'PROFILE_SAMPLE_RATE': float(os.environ.get('LIB_PROFILE_SAMPLE_RATE', 0)),
+        'PROFILE_SLOW_MS': float(os.environ.get('LIB_PROFILE_SLOW_MS', 500)),
+        'PROFILE_DIR': os.environ.get('LIB_PROFILE_DIR', ''),
+    }
+
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per label value."""
+
+    def __init__(self, name, help_text, label, buckets):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for label_value, (counts, count, total) in sorted(self.series.items()):
+                label = f'{self.label}="{escape(label_value)}"'
+                for bound, n in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound:g}"}} {n}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f'{self.name}_sum{{{label}}} {total:.6f}')
+                lines.append(f'{self.name}_count{{{label}}} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                labels = ','.join(f'{k}="{escape(v)}"' for k, v in zip(self.labels, label_values))
+                lines.append(f'{self.name}{{{labels}}} {value}')
+        return lines
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def gauge_lines(prefix, stats):
+    """Render the numeric values of a ``stats()`` dict as gauges."""
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            name = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', key)}"
+            lines += [f'# TYPE {name} gauge', f'{name} {value}']
+    return lines
+
+
+class RequestStats:
+    """Per-request SQL totals; ``track`` wraps connections so they add to one."""
+
+    __slots__ = ('queries', 'sql_seconds', 'started', 'profiler', 'wrappers')
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.started = time.perf_counter()
+        self.profiler = None
+        self.wrappers = {}
+
+
+class TimedCursor:
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _timed(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._stats.sql_seconds += time.perf_counter() - start
+
+    def fetchone(self):
+        return self._timed(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(self._cursor.fetchall)
+
+    def __iter__(self):
+        # SQLite produces rows as they are fetched, so time each step
+        cursor, stats = self._cursor, self._stats
+        while True:
+            start = time.perf_counter()
+            row = next(cursor, None)
+            stats.sql_seconds += time.perf_counter() - start
+            if row is None:
+                return
+            yield row
+
+
+class TimedConnection:
+    """Counts and times the statements run through a pooled connection."""
+
+    def __init__(self, conn, stats):
+        self._conn = conn
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def execute(self, sql, params=()):
+        stats = self._stats
+        stats.queries += 1
+        start = time.perf_counter()
+        try:
+            cursor = self._conn.execute(sql, params)
+        finally:
+            stats.sql_seconds += time.perf_counter() - start
+        return TimedCursor(cursor, stats)
+
+    def executemany(self, sql, seq):
+        stats = self._stats
+        stats.queries += 1
+        start = time.perf_counter()
+        try:
+            return self._conn.executemany(sql, seq)
+        finally:
+            stats.sql_seconds += time.perf_counter() - start
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            self._conn.commit()
+        finally:
+            self._stats.sql_seconds += time.perf_counter() - start
+
+
+def track(conn):
+    """``conn`` wrapped to report into the current request's stats, if any."""
+    stats = g.get('_request_metrics')
+    if stats is None:
+        return conn
+    wrapper = stats.wrappers.get(id(conn))
+    if wrapper is None:
+        wrapper = stats.wrappers[id(conn)] = TimedConnection(conn, stats)
+    return wrapper
+
+
+class Metrics:
+    def __init__(self):
+        self.latency = Histogram('library_request_duration_seconds', 'Time to serve a request, including streamed bodies.',
+                                 'endpoint', LATENCY_BUCKETS)
+        self.requests = Counter('library_requests_total', 'Requests served.', ('endpoint', 'status'))
+        self.sql_queries = Histogram('library_request_sql_queries', 'SQL statements executed per request.',
+                                     'endpoint', QUERY_COUNT_BUCKETS)
+        self.sql_seconds = Histogram('library_request_sql_seconds', 'Time spent in SQLite per request.',
+                                     'endpoint', LATENCY_BUCKETS)
+        self.templates = Histogram('library_template_render_seconds', 'Template render time.',
+                                   'template', LATENCY_BUCKETS)
+        self.profiles = Counter('library_profiles_saved_total', 'Slow sampled requests written to PROFILE_DIR.',
+                                ('endpoint',))
+        # name -> callable returning a stats() dict, rendered as gauges on scrape
+        self.collectors = {}
+
+    def observe(self, endpoint, status, stats):
+        elapsed = time.perf_counter() - stats.started
+        self.latency.observe(endpoint, elapsed)
+        self.requests.inc((endpoint, str(status)))
+        self.sql_queries.observe(endpoint, stats.queries)
+        self.sql_seconds.observe(endpoint, stats.sql_seconds)
+        return elapsed
+
+    def render(self):
+        lines = []
+        for metric in (self.latency, self.requests, self.sql_queries, self.sql_seconds, self.templates, self.profiles):
+            lines += metric.render()
+        for prefix, collect in self.collectors.items():
+            lines += gauge_lines(prefix, collect())
+        return '\n'.join(lines) + '\n'
+
+
+def init_app(app, registry):
+    """Register the hooks and signals feeding ``registry``; a no-op unless METRICS_ENABLED."""
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    @app.before_request
+    def start_request_metrics():
+        stats = g._request_metrics = RequestStats()
+        rate = app.config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another profiler is already running in this process
+                return
+            stats.profiler = profiler
+
+    @app.after_request
+    def finish_request_metrics(response):
+        stats = g.get('_request_metrics')
+        if stats is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        status = response.status_code
+
+        # on close rather than now, so that streamed bodies are included
+        def observe():
+            elapsed = registry.observe(endpoint, status, stats)
+            if stats.profiler is not None:
+                stats.profiler.disable()
+                if elapsed * 1000 >= app.config['PROFILE_SLOW_MS']:
+                    save_profile(app, stats.profiler, endpoint)
+                    registry.profiles.inc((endpoint,))
+        response.call_on_close(observe)
+        return response
+
+    def template_started(sender, template, context, **extra):
+        g.setdefault('_template_starts', []).append(time.perf_counter())
+
+    def template_finished(sender, template, context, **extra):
+        starts = g.get('_template_starts')
+        if starts:
+            registry.templates.observe(template.name or 'string', time.perf_counter() - starts.pop())
+
+    before_render_template.connect(template_started, app, weak=False)
+    template_rendered.connect(template_finished, app, weak=False)
+
+
+def save_profile(app, profiler, endpoint):
+    directory = app.config['PROFILE_DIR'] or os.path.join(app.instance_path, 'profiles')
+    os.makedirs(directory, exist_ok=True)
+    name = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{endpoint}.prof'
+    profiler.dump_stats(os.path.join(directory, name))
@@ -0,0 +1,422 @@
+"""“Students who borrowed this also borrowed”: book-to-book recommendations
+from the borrow history, built by a batch job: ``python recs.py`` (from cron,
+or with --every to keep running).
+
+Two books are co-borrowed by a student who borrowed both. The job keeps the
+whole sparse book-by-book matrix of co-borrow counts on disk, in CSR form
+(row pointers, column book ids and counts, one file each), and next to it a
+dense top-k table: for every book, the RECS_TOP_K books most often borrowed
+with it. The web workers memory-map only the top-k table, so a lookup reads
+one fixed-size row, O(k), however long the history is (``Recommendations``).
+
+Counting is vectorized with NumPy. A student's books are taken in the order
+of their first borrow, and each one pairs with the RECS_WINDOW books before
+it: the books a student borrows around the same time are the ones that say
+something about each other, and the number of pairs stays linear in the
+number of borrows instead of quadratic per student.
+
+The files record the highest borrow id they include. A run reads only the
+borrows after it plus the earlier history of the students who made them,
+adds their pairs to a small delta matrix and updates the top-k rows of the
+books they touch from the entries that grew. When the delta grows past COMPACT_RATIO of the base matrix
+it is merged into it. Every run writes new files and then switches the
+manifest over in one rename, so readers never see a half-written build.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import create_db
+import db as db_pool
+
+MANIFEST = 'manifest.json'
+# entries (book pairs, counted both ways) sorted at once; bounds the job's memory
+PAIRS_PER_PASS = 25_000_000
+# the delta matrix is merged into the base one when it holds this share of its entries
+COMPACT_RATIO = 0.2
+
+
+def env_config():
+    """Default recommendation settings, overridable through LIB_RECS_* environment variables."""
+    return {
+        # where the matrices live; empty means <database file>.recs next to the database
+        'RECS_DIR': os.environ.get('LIB_RECS_DIR', ''),
+        # books kept per book in the served table
+        'RECS_TOP_K': int(os.environ.get('LIB_RECS_TOP_K', 10)),
+        # how many of a student's previous books each borrowed book is paired with
+        'RECS_WINDOW': int(os.environ.get('LIB_RECS_WINDOW', 10)),
+    }
+
+
+def directory(db_path, config):
+    return config['RECS_DIR'] or db_pool.beside(db_path, '.recs')
+
+
+def load(path, dtype, shape=None):
+    # np.memmap refuses empty files, and an empty matrix is a valid one
+    if not os.path.getsize(path):
+        return np.zeros(shape or 0, dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+def read_manifest(path):
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+class Recommendations:
+    """The read side, one per worker and directory (see ``get_reader``).
+
+    Holds the newest build's top-k table memory-mapped, and maps the next one
+    when the job has replaced the manifest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.generation = 0
+        self.table = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Pick up a new build if there is one; returns its generation (0 for none)."""
+        try:
+            st = os.stat(os.path.join(self.path, MANIFEST))
+        except FileNotFoundError:
+            self.stamp, self.generation, self.table = None, 0, None
+            return 0
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stamp != self.stamp:
+            with self.lock:
+                if stamp != self.stamp:
+                    manifest = read_manifest(self.path)
+                    try:
+                        self.table = load(os.path.join(self.path, manifest['topk']), np.int32,
+                                          (manifest['books'], manifest['top_k'], 2))
+                    except FileNotFoundError:
+                        # replaced again since the manifest was read; the next call maps the newest
+                        return self.generation
+                    self.generation = manifest['generation']
+                    self.stamp = stamp
+        return self.generation
+
+    def also_borrowed(self, book_id, n):
+        """Up to ``n`` (book id, students) pairs: the books borrowed by most of
+        the students who borrowed ``book_id``, most first."""
+        table = self.table
+        if table is None or not 0 <= book_id < len(table):
+            return []
+        return [(other, students) for other, students in table[book_id, :n].tolist() if students]
+
+
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def get_reader(path):
+    reader = _readers.get(path)
+    if reader is None:
+        with _readers_lock:
+            reader = _readers.setdefault(path, Recommendations(path))
+    return reader
+
+
+def first_borrows(ids, students, books):
+    """Each student's first borrow of each book, as (student, book, borrow id)
+    arrays sorted by student, then borrow id."""
+    order = np.lexsort((ids, books, students))
+    students, books, ids = students[order], books[order], ids[order]
+    first = np.ones(len(ids), bool)
+    first[1:] = (students[1:] != students[:-1]) | (books[1:] != books[:-1])
+    students, books, ids = students[first], books[first], ids[first]
+    order = np.lexsort((ids, students))
+    return students[order], books[order], ids[order]
+
+
+def pairs(students, books, counted, window):
+    """Yield (a, b) arrays of co-borrowed books: each first borrow marked in
+    ``counted`` with the ``window`` first borrows before it by the same student."""
+    for lag in range(1, window + 1):
+        if lag >= len(students):
+            break
+        mask = (students[lag:] == students[:-lag]) & counted[lag:]
+        yield books[lag:][mask], books[:-lag][mask]
+
+
+def count_pairs(students, books, counted, window, nbooks, rows=None):
+    """The co-borrow counts of the pairs as (row, column, count) arrays sorted
+    by row and column, both ways round; only rows in range ``rows`` if given."""
+    keys = []
+    for a, b in pairs(students, books, counted, window):
+        for row, col in ((a, b), (b, a)):
+            if rows is not None:
+                inside = (row >= rows[0]) & (row < rows[1])
+                row, col = row[inside], col[inside]
+            keys.append(row.astype(np.int64) * nbooks + col)
+    keys, counts = np.unique(np.concatenate(keys) if keys else np.zeros(0, np.int64), return_counts=True)
+    return keys // nbooks, keys % nbooks, counts
+
+
+def add_counts(rows, cols, counts, nbooks):
+    """Sum (row, column, count) triples that name the same pair."""
+    keys, inverse = np.unique(rows.astype(np.int64) * nbooks + cols, return_inverse=True)
+    return keys // nbooks, keys % nbooks, np.bincount(inverse.ravel(), weights=counts, minlength=len(keys)).astype(np.int64)
+
+
+def top_k(table, rows, cols, counts):
+    """Fill ``table`` rows with their highest counts, ties to the lower book id.
+    The triples must include every entry that can make its row's top k."""
+    k = table.shape[1]
+    order = np.lexsort((cols, -counts, rows))
+    rows, cols, counts = rows[order], cols[order], counts[order]
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    rank = np.arange(len(rows)) - np.repeat(starts, np.diff(np.r_[starts, len(rows)]))
+    keep = rank < k
+    table[rows[keep], rank[keep], 0] = cols[keep]
+    table[rows[keep], rank[keep], 1] = counts[keep]
+
+
+def lookup(indptr, indices, counts, rows, cols):
+    """The counts at (``rows``, ``cols``) of a CSR matrix, 0 where it has none;
+    one binary search per entry within its row, run for all of them at once."""
+    known = rows < len(indptr) - 1
+    start, end = np.zeros(len(rows), np.int64), np.zeros(len(rows), np.int64)
+    start[known], end[known] = indptr[rows[known]], indptr[rows[known] + 1]
+    lo, hi = start, end.copy()
+    while True:
+        active = np.flatnonzero(lo < hi)
+        if not len(active):
+            break
+        mid = (lo[active] + hi[active]) // 2
+        right = np.asarray(indices[mid]) < cols[active]
+        lo[active[right]] = mid[right] + 1
+        hi[active[~right]] = mid[~right]
+    found = np.flatnonzero(lo < end)
+    found = found[np.asarray(indices[lo[found]]) == cols[found]]
+    out = np.zeros(len(rows), np.int64)
+    out[found] = counts[lo[found]]
+    return out
+
+
+def read_borrows(conn, sql, params=()):
+    """(ids, students, books) arrays from a ``SELECT id, student_id, book_id``."""
+    cur = conn.cursor()
+    cur.row_factory = None
+    cur.execute(sql, params)
+    chunks = []
+    while True:
+        rows = cur.fetchmany(100000)
+        if not rows:
+            break
+        chunks.append(np.array(rows, np.int64))
+    table = np.concatenate(chunks) if chunks else np.zeros((0, 3), np.int64)
+    return table[:, 0], table[:, 1], table[:, 2]
+
+
+def csr_rows(indptr, lo, hi):
+    """The row of every entry of CSR rows [lo, hi)."""
+    hi = max(lo, min(hi, len(indptr) - 1))
+    return np.repeat(np.arange(lo, hi), np.diff(indptr[lo:hi + 1]))
+
+
+class Build:
+    """The matrices in one directory; written by the job only."""
+
+    def __init__(self, path, config):
+        self.path = path
+        self.top_k = config['RECS_TOP_K']
+        self.window = config['RECS_WINDOW']
+        self.manifest = read_manifest(path)
+
+    def file(self, kind, generation):
+        return f'{kind}-{generation}.bin'
+
+    def load(self, name, dtype, shape=None):
+        return load(os.path.join(self.path, name), dtype, shape)
+
+    def matrix(self, name):
+        """CSR arrays (indptr, indices, counts) of matrix ``name``, memory-mapped."""
+        g = self.manifest[name]
+        return (self.load(self.file(f'{name}-indptr', g), np.int64),
+                self.load(self.file(f'{name}-indices', g), np.int32),
+                self.load(self.file(f'{name}-counts', g), np.int32))
+
+    def table(self):
+        m = self.manifest
+        return self.load(m['topk'], np.int32, (m['books'], m['top_k'], 2))
+
+    def write_matrix(self, name, generation, parts, nbooks):
+        """Write (rows, cols, counts) parts, in row order, as CSR matrix
+        ``name``; returns the number of entries."""
+        lengths = np.zeros(nbooks, np.int64)
+        with open(os.path.join(self.path, self.file(f'{name}-indices', generation)), 'wb') as indices, \
+                open(os.path.join(self.path, self.file(f'{name}-counts', generation)), 'wb') as counts:
+            for rows, cols, n in parts:
+                lengths += np.bincount(rows, minlength=nbooks)
+                cols.astype(np.int32).tofile(indices)
+                n.astype(np.int32).tofile(counts)
+        np.r_[0, np.cumsum(lengths)].astype(np.int64).tofile(
+            os.path.join(self.path, self.file(f'{name}-indptr', generation)))
+        return int(lengths.sum())
+
+    def write_table(self, table, generation):
+        name = self.file('topk', generation)
+        table.tofile(os.path.join(self.path, name))
+        return name
+
+    def commit(self, manifest):
+        """Switch readers over to ``manifest``, then delete the files it no longer names."""
+        tmp = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+        self.manifest = manifest
+        keep = {MANIFEST, manifest['topk']} | {self.file(f'{name}-{part}', manifest[name])
+                                               for name in ('base', 'delta') for part in ('indptr', 'indices', 'counts')}
+        for name in os.listdir(self.path):
+            if name not in keep:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    # still mapped by a reader on Windows; a later run gets it
+                    pass
+
+    def passes(self, entries, nbooks):
+        """Row ranges splitting ``entries`` matrix entries into passes of PAIRS_PER_PASS."""
+        bounds = np.linspace(0, nbooks, max(1, -(-entries // PAIRS_PER_PASS)) + 1).astype(np.int64)
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    def rebuild(self, conn):
+        """Count the whole borrow history afresh; returns the number of borrows."""
+        os.makedirs(self.path, exist_ok=True)
+        generation = (self.manifest['generation'] if self.manifest else 0) + 1
+        ids, students, books = read_borrows(conn, 'SELECT id, student_id, book_id FROM borrows')
+        nbooks = max(int(books.max()) if len(books) else 0,
+                     conn.execute('SELECT MAX(id) FROM books').fetchone()[0] or 0) + 1
+        last = int(ids.max()) if len(ids) else 0
+        total = len(ids)
+        students, books, ids = first_borrows(ids, students, books)
+        counted = np.ones(len(ids), bool)
+
+        entries = 2 * sum(int((students[lag:] == students[:-lag]).sum())
+                          for lag in range(1, min(self.window + 1, len(students))))
+        table = np.zeros((nbooks, self.top_k, 2), np.int32)
+
+        def parts():
+            for rows in self.passes(entries, nbooks):
+                part = count_pairs(students, books, counted, self.window, nbooks, rows)
+                top_k(table, *part)
+                yield part
+        base = self.write_matrix('base', generation, parts(), nbooks)
+        self.write_matrix('delta', generation, [], nbooks)
+        self.commit({'generation': generation, 'borrow_id': last, 'books': nbooks,
+                     'top_k': self.top_k, 'window': self.window,
+                     'base': generation, 'base_entries': base, 'delta': generation, 'delta_entries': 0,
+                     'topk': self.write_table(table, generation)})
+        return total
+
+    def update(self, conn):
+        """Add the borrows made since the last run; returns how many there were."""
+        m = self.manifest
+        ids, students, books = read_borrows(conn, 'SELECT id, student_id, book_id FROM borrows WHERE id > ?',
+                                            (m['borrow_id'],))
+        if not len(ids):
+            return 0
+        # the earlier borrows of the same students: what the new ones pair with,
+        # and which books they had already borrowed
+        # as one JSON array, since a placeholder per student would pass SQLite's
+        # host parameter limit once enough students borrow between runs
+        who = json.dumps(np.unique(students).tolist())
+        history = read_borrows(conn, 'SELECT id, student_id, book_id FROM borrows WHERE student_id IN'
+                               ' (SELECT value FROM json_each(?)) AND id <= ?', (who, m['borrow_id']))
+        total, last = len(ids), int(ids.max())
+        ids, students, books = (np.concatenate(a) for a in zip(history, (ids, students, books)))
+        students, books, ids = first_borrows(ids, students, books)
+        nbooks = max(m['books'], int(books.max()) + 1)
+        added = count_pairs(students, books, ids > m['borrow_id'], self.window, nbooks)
+
+        generation = m['generation'] + 1
+        indptr, indices, counts = self.matrix('delta')
+        delta = add_counts(*(np.concatenate(a) for a in zip(
+            (csr_rows(indptr, 0, nbooks), np.asarray(indices), np.asarray(counts)), added)), nbooks)
+
+        # counts only grow, so a book's new top k is among its old top k and the
+        # entries that just grew; only those are looked up, never whole rows
+        keys = delta[0] * nbooks + delta[1]
+        grown = added[0] * nbooks + added[1]
+        totals = lookup(*self.matrix('base'), added[0], added[1]) + delta[2][np.searchsorted(keys, grown)]
+        touched = np.unique(added[0])
+        table = np.zeros((nbooks, self.top_k, 2), np.int32)
+        table[:m['books']] = self.table()
+        rows = np.repeat(touched, self.top_k)
+        cols, counts = (table[touched][:, :, i].ravel().astype(np.int64) for i in (0, 1))
+        kept = (counts > 0) & ~np.isin(rows * nbooks + cols, grown)
+        table[touched] = 0
+        top_k(table, *(np.concatenate(a) for a in zip((rows[kept], cols[kept], counts[kept]),
+                                                      (added[0], added[1], totals))))
+
+        manifest = dict(m, generation=generation, borrow_id=last, books=nbooks,
+                        topk=self.write_table(table, generation))
+        if len(delta[0]) > COMPACT_RATIO * m['base_entries']:
+            manifest.update(base=generation, base_entries=self.compact(generation, delta, nbooks),
+                            delta=generation, delta_entries=0)
+            self.write_matrix('delta', generation, [], nbooks)
+        else:
+            manifest.update(delta=generation, delta_entries=self.write_matrix('delta', generation, [delta], nbooks))
+        self.commit(manifest)
+        return total
+
+    def compact(self, generation, delta, nbooks):
+        """Write base + ``delta`` as the base matrix of ``generation``."""
+        indptr, indices, counts = self.matrix('base')
+
+        def parts():
+            for lo, hi in self.passes(self.manifest['base_entries'] + len(delta[0]), nbooks):
+                inside = (delta[0] >= lo) & (delta[0] < hi)
+                start, end = indptr[min(lo, len(indptr) - 1)], indptr[min(hi, len(indptr) - 1)]
+                yield add_counts(*(np.concatenate(a) for a in zip(
+                    (csr_rows(indptr, lo, hi), np.asarray(indices[start:end]), np.asarray(counts[start:end])),
+                    (d[inside] for d in delta))), nbooks)
+        return self.write_matrix('base', generation, parts(), nbooks)
+
+
+def run(conn, config, path, rebuild=False):
+    """Bring the matrices in ``path`` up to date with the borrows; returns
+    (borrows read, whether it was a full rebuild)."""
+    build = Build(path, config)
+    m = build.manifest
+    if rebuild or m is None or (m['top_k'], m['window']) != (config['RECS_TOP_K'], config['RECS_WINDOW']):
+        return build.rebuild(conn), True
+    return build.update(conn), False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Update the "also borrowed" recommendations with the borrows since the last run.')
+    parser.add_argument('--every', type=float, help='keep running, starting a run this many seconds after the last')
+    parser.add_argument('--rebuild', action='store_true', help='count the whole history again')
+    args = parser.parse_args(argv)
+
+    config = dict(db_pool.env_config(), **env_config())
+    db_path = os.environ.get('LIB_DB_PATH') or create_db.DB_PATH
+    conn = db_pool.connect(db_path, config, readonly=True)
+    rebuild = args.rebuild
+    while True:
+        started = time.monotonic()
+        borrows, rebuilt = run(conn, config, directory(db_path, config), rebuild)
+        print(f"recs: {'rebuilt from' if rebuilt else 'added'} {borrows} borrows ({time.monotonic() - started:.1f}s)")
+        if args.every is None:
+            return 0
+        rebuild = False
+        time.sleep(max(0.0, args.every - (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,320 @@
+"""Read replicas of the catalogue, so /api/search can scale past one host.
+
+The primary database stays the only one written to. ``python replica.py
+publish DIR`` runs next to it and publishes the catalogue into DIR:
+
+- a snapshot, copied with the SQLite backup API and emptied of everything
+  but the catalogue (books, its full-text index, facet and search term
+  counts), so no password hash or borrow history leaves the primary;
+- a change segment per round (every --interval seconds, when anything
+  changed): the current rows of the books written since the last round,
+  found through ``catalog_changes``, which triggers on books append to;
+- manifest.json, naming the snapshot and the segments since the one before
+  it, and when the primary was last read.
+
+DIR holds plain files, so it can be a shared volume or be synced to other
+hosts. On each host ``python replica.py follow DIR`` keeps the database at
+LIB_REPLICA_PATH current: it restores the snapshot into it with the backup
+API, then applies new segments, one transaction per round, through the same
+triggers that keep the primary's indexes and counts in step. Workers started
+with LIB_REPLICA_PATH answer /api/search from that file while it is no more
+than REPLICA_MAX_LAG seconds behind the primary, and from the primary
+otherwise; everything else, and every write, still goes to the primary.
+
+Staleness is measured with the clocks of the publishing and the serving
+host, which are assumed to agree to well under REPLICA_MAX_LAG.
+"""
+import argparse
+import json
+import os
+import secrets
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import create_db
+import db as db_pool
+
+# tables a replica keeps rows of; the shadow tables of the full-text ones go with them
+CATALOG_TABLES = ('books', 'books_fts', 'meta', 'facet_counts', 'search_terms', 'search_terms_trigram')
+MANIFEST = 'manifest.json'
+
+
+def env_config():
+    """Default replica settings, overridable through LIB_REPLICA_* environment variables."""
+    return {
+        # local replica database to search instead of the primary; '' searches the primary
+        'REPLICA_PATH': os.environ.get('LIB_REPLICA_PATH', ''),
+        # seconds a replica may trail the primary before searches go to the primary instead
+        'REPLICA_MAX_LAG': float(os.environ.get('LIB_REPLICA_MAX_LAG', 5)),
+    }
+
+
+def fresh(conn, max_lag):
+    """Whether the replica behind ``conn`` matched the primary at most ``max_lag`` seconds ago."""
+    try:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'replica_synced_at'").fetchone()
+    except sqlite3.OperationalError:
+        # nothing restored into it yet
+        return False
+    return row is not None and time.time() - row[0] <= max_lag
+
+
+def get_meta(conn, key):
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_meta(conn, **values):
+    conn.executemany('INSERT INTO meta (key, value) VALUES (?, ?)'
+                     ' ON CONFLICT (key) DO UPDATE SET value = excluded.value', values.items())
+
+
+def read_manifest(directory):
+    try:
+        return json.loads((Path(directory) / MANIFEST).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def replace_file(path, write):
+    # readers see the old file or the new one, never half of it
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w') as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def logged_seq(conn):
+    """The last seq ever given to a catalog_changes row."""
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'catalog_changes'").fetchone()[0]
+
+
+def strip_private(conn):
+    """Empty every table of ``conn`` that is not part of the catalogue and stop
+    it logging changes, leaving a database fit to hand to replicas."""
+    tables = {r[0]: r[1] for r in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'")}
+    keep = set(CATALOG_TABLES) | {'sqlite_sequence'}
+    keep |= {name for name in tables if any(name.startswith(t + '_') for t in CATALOG_TABLES
+                                             if tables.get(t, '').upper().startswith('CREATE VIRTUAL'))}
+    for name, sql in tables.items():
+        if name not in keep and not sql.upper().startswith('CREATE VIRTUAL'):
+            conn.execute(f'DELETE FROM "{name}"')
+    set_meta(conn, replication_log=0)
+
+
+class Publisher:
+    """Publishes the catalogue of the primary database behind ``conn`` into ``directory``.
+
+    A new snapshot is taken once ``snapshot_every`` changed books have been
+    published since the last one, and files the manifest stopped naming are
+    deleted ``retain`` seconds later, once followers are done reading them.
+    """
+
+    def __init__(self, conn, directory, snapshot_every=100000, retain=300):
+        self.conn = conn
+        self.directory = Path(directory)
+        self.snapshot_every = snapshot_every
+        self.retain = retain
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.manifest = read_manifest(self.directory)
+        # books writes are logged from here on; a snapshot taken after this
+        # misses none of them
+        with conn:
+            set_meta(conn, replication_log=1)
+
+    def step(self):
+        """Publish one round; returns the number of books it carried."""
+        if (self.manifest is None or self.manifest['schema_version'] != create_db.schema_version(self.conn)
+                or logged_seq(self.conn) < self.manifest['seq']):
+            # a new chain (first run, migrated or replaced primary): followers
+            # restore the new snapshot whatever they hold
+            self.snapshot(epoch=secrets.randbits(62))
+        after = self.manifest['seq']
+        published_at = time.time()
+        self.conn.execute('BEGIN')
+        try:
+            last = self.conn.execute('SELECT COALESCE(MAX(seq), ?) FROM catalog_changes', (after,)).fetchone()[0]
+            cursor = self.conn.execute(
+                'SELECT c.book_id, b.* FROM (SELECT DISTINCT book_id FROM catalog_changes WHERE seq > ? AND seq <= ?) c'
+                ' LEFT JOIN books b ON b.id = c.book_id ORDER BY c.book_id', (after, last))
+            columns = [d[0] for d in cursor.description[1:]]
+            rows = [list(r[1:]) if r[1] is not None else [r[0]] for r in cursor]
+            version = get_meta(self.conn, 'catalog_version')
+        finally:
+            self.conn.commit()
+
+        if rows:
+            name = f"changes-{self.manifest['epoch']:x}-{last:012d}.jsonl"
+            replace_file(self.directory / name, lambda f: f.writelines(
+                json.dumps(line) + '\n' for line in [columns] + rows))
+            self.manifest['segments'].append({'name': name, 'after': after, 'last': last})
+            self.manifest['changes_since_snapshot'] += len(rows)
+        self.manifest.update(seq=last, catalog_version=version, published_at=published_at)
+        self.write_manifest()
+        if rows:
+            with self.conn:
+                self.conn.execute('DELETE FROM catalog_changes WHERE seq <= ?', (last,))
+        if self.manifest['changes_since_snapshot'] >= self.snapshot_every:
+            self.snapshot(self.manifest['epoch'])
+        self.remove_unnamed()
+        return len(rows)
+
+    def snapshot(self, epoch):
+        """Publish a snapshot of the catalogue."""
+        tmp = self.directory / 'snapshot.tmp'
+        tmp.unlink(missing_ok=True)
+        taken_at = time.time()
+        copy = sqlite3.connect(tmp, isolation_level=None)
+        try:
+            self.conn.backup(copy)
+            seq = logged_seq(copy)
+            version = get_meta(copy, 'catalog_version')
+            copy.execute('BEGIN')
+            strip_private(copy)
+            set_meta(copy, replica_epoch=epoch, replica_seq=seq, replica_synced_at=taken_at)
+            copy.execute('COMMIT')
+            # followers open it read-only, which a WAL database without its -shm file refuses
+            copy.execute('PRAGMA journal_mode = DELETE')
+            copy.execute('VACUUM')
+        finally:
+            copy.close()
+        name = f'snapshot-{epoch:x}-{seq:012d}.db'
+        os.replace(tmp, self.directory / name)
+
+        if self.manifest is None or self.manifest['epoch'] != epoch:
+            self.manifest = {'epoch': epoch, 'schema_version': create_db.schema_version(self.conn),
+                             'seq': seq, 'catalog_version': version, 'published_at': taken_at,
+                             'snapshot_seq': seq, 'segments': []}
+        # segments are kept back to the previous snapshot, so a replica less than
+        # a snapshot's worth of changes behind never has to restore
+        previous = self.manifest['snapshot_seq']
+        self.manifest.update(snapshot=name, snapshot_seq=seq, changes_since_snapshot=0,
+                             segments=[s for s in self.manifest['segments'] if s['last'] > previous])
+        self.write_manifest()
+        with self.conn:
+            self.conn.execute('DELETE FROM catalog_changes WHERE seq <= ?', (min(seq, self.manifest['seq']),))
+
+    def write_manifest(self):
+        replace_file(self.directory / MANIFEST, lambda f: json.dump(self.manifest, f))
+
+    def remove_unnamed(self):
+        named = {MANIFEST, self.manifest['snapshot']} | {s['name'] for s in self.manifest['segments']}
+        cutoff = time.time() - self.retain
+        for path in self.directory.iterdir():
+            if path.name not in named and not path.name.endswith('.tmp') and path.stat().st_mtime < cutoff:
+                path.unlink(missing_ok=True)
+
+
+class Follower:
+    """Keeps the replica database behind ``conn`` up to date with what is
+    published in ``directory``."""
+
+    def __init__(self, conn, directory):
+        self.conn = conn
+        self.directory = Path(directory)
+
+    def position(self):
+        """(epoch, seq) of the published changes the replica holds, or (None, None)."""
+        try:
+            return get_meta(self.conn, 'replica_epoch'), get_meta(self.conn, 'replica_seq')
+        except sqlite3.OperationalError:
+            return None, None
+
+    def step(self):
+        """Catch up with the manifest; returns the number of books applied."""
+        manifest = read_manifest(self.directory)
+        if manifest is None:
+            return 0
+        epoch, seq = self.position()
+        segments = manifest['segments']
+        if (epoch != manifest['epoch'] or seq is None
+                or seq < manifest['snapshot_seq'] and not (segments and segments[0]['after'] <= seq)):
+            self.restore(self.directory / manifest['snapshot'])
+            epoch, seq = self.position()
+        pending = [s for s in segments if s['last'] > seq]
+        applied = 0
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            for segment in pending:
+                applied += self.apply(self.directory / segment['name'])
+            if pending:
+                seq = pending[-1]['last']
+                set_meta(self.conn, replica_seq=seq)
+            # a snapshot newer than the last round already carries its own version
+            if seq == manifest['seq']:
+                set_meta(self.conn, catalog_version=manifest['catalog_version'],
+                         replica_synced_at=manifest['published_at'])
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        return applied
+
+    def restore(self, snapshot):
+        mode = self.conn.execute('PRAGMA journal_mode').fetchone()[0]
+        source = sqlite3.connect(f'file:{snapshot}?mode=ro', uri=True)
+        try:
+            source.backup(self.conn)
+        finally:
+            source.close()
+        # the copy brought the snapshot's rollback journal mode along
+        self.conn.execute(f'PRAGMA journal_mode = {mode}')
+
+    def apply(self, path):
+        applied = 0
+        with open(path) as f:
+            columns = json.loads(next(f))
+            select = f"SELECT {', '.join(columns)} FROM books WHERE id = ?"
+            for line in f:
+                row = json.loads(line)
+                current = self.conn.execute(select, (row[0],)).fetchone()
+                if len(row) == 1:
+                    if current is not None:
+                        self.conn.execute('DELETE FROM books WHERE id = ?', (row[0],))
+                elif current is None:
+                    self.conn.execute(f"INSERT INTO books ({', '.join(columns)}) VALUES ({', '.join('?' * len(row))})", row)
+                else:
+                    # only the columns that changed, so a borrow does not reindex the title
+                    changed = [(c, v) for c, old, v in zip(columns, current, row) if old != v]
+                    if changed:
+                        self.conn.execute(f"UPDATE books SET {', '.join(c + ' = ?' for c, _ in changed)} WHERE id = ?",
+                                          [v for _, v in changed] + [row[0]])
+                applied += 1
+        return applied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Publish the catalogue for read replicas, or keep a replica up to date.')
+    parser.add_argument('role', choices=('publish', 'follow'),
+                        help='publish next to the primary (LIB_DB_PATH), or follow into LIB_REPLICA_PATH')
+    parser.add_argument('directory', help='where snapshots, change segments and the manifest are published')
+    parser.add_argument('--interval', type=float, default=1.0, help='seconds between rounds')
+    parser.add_argument('--snapshot-every', type=int, default=100000,
+                        help='publish a new snapshot after this many changed books (publish)')
+    parser.add_argument('--retain', type=float, default=300,
+                        help='seconds to keep files the manifest no longer names (publish)')
+    args = parser.parse_args(argv)
+
+    config = db_pool.env_config()
+    if args.role == 'publish':
+        conn = db_pool.connect(os.environ.get('LIB_DB_PATH') or create_db.DB_PATH, config)
+        worker = Publisher(conn, args.directory, args.snapshot_every, args.retain)
+    else:
+        path = env_config()['REPLICA_PATH']
+        if not path:
+            parser.error('LIB_REPLICA_PATH must name the replica database')
+        worker = Follower(db_pool.connect(path, config), args.directory)
+    while True:
+        started = time.monotonic()
+        try:
+            worker.step()
+        except (sqlite3.OperationalError, OSError) as e:
+            # a busy primary or a half-synced directory; the next round retries
+            print(f'replica {args.role}: {e}', file=sys.stderr)
+        time.sleep(max(0.0, args.interval - (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+// Catalogue questions: /api/ask answers from the local index (ask.py), so
+// this only sends the question and shows the answer with the books behind it.
+;(function(){
+  const input = document.getElementById('ask-q')
+  const button = document.getElementById('ask-go')
+  const out = document.getElementById('ask-answer')
+  if(!input || !button || !out) return
+
+  async function ask(){
+    const q = input.value.trim()
+    if(!q) return
+    const res = await fetch(`/api/ask?q=${encodeURIComponent(q)}`)
+    const data = await res.json()
+    out.innerHTML = ''
+    const answer = document.createElement('p')
+    answer.textContent = data.answer || data.error || ''
+    out.appendChild(answer)
+    const list = document.createElement('ul')
+    for(const book of (data.results || []).concat(data.on_loan || [])){
+      const li = document.createElement('li')
+      li.textContent = `${book.title} — ${book.author} (${book.year}, ${book.department})`
+      list.appendChild(li)
+    }
+    out.appendChild(list)
+  }
+
+  button.addEventListener('click', ask)
+  input.addEventListener('keydown', function(e){ if(e.key === 'Enter') ask() })
+})()
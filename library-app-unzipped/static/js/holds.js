@@ -0,0 +1,34 @@
+// Hold notifications: the server pushes a "ready" event down /student/events
+// when a copy is set aside for one of the student's holds, so nothing here
+// polls. EventSource reconnects by itself and sends the last event id back,
+// so an event is shown once per page.
+;(function(){
+  if(typeof EventSource === 'undefined') return
+  const csrf = document.currentScript.dataset.csrf
+  const alerts = document.getElementById('hold-alerts')
+  const shown = new Set()
+  const source = new EventSource('/student/events')
+
+  source.addEventListener('ready', function(e){
+    const hold = JSON.parse(e.data)
+    if(!alerts || shown.has(hold.hold_id)) return
+    shown.add(hold.hold_id)
+    alerts.appendChild(readyAlert(hold))
+  })
+
+  function readyAlert(hold){
+    const div = document.createElement('div')
+    div.className = 'alert alert-success d-flex justify-content-between align-items-center'
+    const until = new Date(hold.expires_ts * 1000).toLocaleString()
+    const text = document.createElement('span')
+    text.textContent = `A copy of "${hold.title}" is set aside for you until ${until}.`
+    const form = document.createElement('form')
+    form.method = 'POST'
+    form.action = `/student/borrow/${hold.book_id}`
+    form.innerHTML = '<input type="hidden" name="csrf_token"><button class="btn btn-sm btn-primary" type="submit">Borrow</button>'
+    form.elements.csrf_token.value = csrf || ''
+    div.appendChild(text)
+    div.appendChild(form)
+    return div
+  }
+})()
@@ -1,37 +1,168 @@
+// Type-ahead search: input is debounced, a newer search aborts the one in
+// flight, responses are cached per URL for a short while and results are
+// added to the page in chunks, one animation frame at a time.
+const SEARCH_DEBOUNCE_MS = 250
+const CACHE_TTL_MS = 30000
+const CACHE_MAX_ENTRIES = 50
+const RENDER_CHUNK = 25
+
+const responseCache = new Map()
+let debounceTimer = null
+let inFlight = null
+let renderToken = 0
+
 document.getElementById('go').addEventListener('click', doSearch)
 document.getElementById('q').addEventListener('keydown', function(e){ if(e.key === 'Enter') doSearch() })
+document.getElementById('q').addEventListener('input', scheduleSearch)
+;['dept', 'min_year', 'max_year', 'available'].forEach(function(id){
+  const el = document.getElementById(id)
+  if(el) el.addEventListener(el.tagName === 'SELECT' || el.type === 'checkbox' ? 'change' : 'input', scheduleSearch)
+})
 
-function doSearch(){
-  const q = document.getElementById('q').value
+loadFacets()
+
+// Department options with their book counts, e.g. "CSE (1,204)"; the counts
+// are kept up to date by the server, so this is one small request per page.
+function loadFacets(){
+  fetch('/api/search?facets=1&limit=1')
+    .then(r => r.json())
+    .then(function(data){
+      const counts = (data.facets && data.facets.department) || {}
+      const select = document.getElementById('dept')
+      const selected = select.value
+      let total = 0
+      select.textContent = ''
+      select.appendChild(new Option('All Departments', ''))
+      Object.keys(counts).sort().forEach(function(dept){
+        total += counts[dept]
+        select.appendChild(new Option(`${dept} (${counts[dept].toLocaleString()})`, dept))
+      })
+      select.options[0].text = `All Departments (${total.toLocaleString()})`
+      select.value = selected
+    })
+    .catch(function(){ /* keep the options from the page */ })
+}
+
+function scheduleSearch(){
+  clearTimeout(debounceTimer)
+  debounceTimer = setTimeout(doSearch, SEARCH_DEBOUNCE_MS)
+}
+
+function searchUrl(cursor){
+  const q = document.getElementById('q').value.trim()
   const dept = document.getElementById('dept').value
   const min_year = document.getElementById('min_year') ? document.getElementById('min_year').value : ''
   const max_year = document.getElementById('max_year') ? document.getElementById('max_year').value : ''
   const available = document.getElementById('available') && document.getElementById('available').checked ? '1' : ''
-  const url = `/api/search?q=${encodeURIComponent(q)}&dept=${encodeURIComponent(dept)}&min_year=${encodeURIComponent(min_year)}&max_year=${encodeURIComponent(max_year)}&available=${encodeURIComponent(available)}`
-  fetch(url).then(r=>r.json()).then(render)
+  let url = `/api/search?q=${encodeURIComponent(q)}&dept=${encodeURIComponent(dept)}&min_year=${encodeURIComponent(min_year)}&max_year=${encodeURIComponent(max_year)}&available=${encodeURIComponent(available)}`
+  if(cursor) url += `&cursor=${encodeURIComponent(cursor)}`
+  return url
+}
+
+function doSearch(){
+  clearTimeout(debounceTimer)
+  fetchPage(searchUrl()).then(function(data){
+    if(data) render(data, false)
+  })
 }
 
-function render(data){
+function loadMore(cursor){
+  fetchPage(searchUrl(cursor)).then(function(data){
+    if(data) render(data, true)
+  })
+}
+
+// Resolves with the parsed page, or null when a newer search superseded it.
+function fetchPage(url){
+  if(inFlight) inFlight.abort()
+  const hit = responseCache.get(url)
+  if(hit && Date.now() - hit.time < CACHE_TTL_MS){
+    inFlight = null
+    return Promise.resolve(hit.data)
+  }
+  const controller = new AbortController()
+  inFlight = controller
+  return fetch(url, {signal: controller.signal})
+    .then(r => r.json())
+    .then(function(data){
+      if(inFlight === controller) inFlight = null
+      remember(url, data)
+      return data
+    })
+    .catch(function(err){
+      if(err.name === 'AbortError') return null
+      throw err
+    })
+}
+
+function remember(url, data){
+  responseCache.delete(url)
+  responseCache.set(url, {time: Date.now(), data: data})
+  // Map keeps insertion order, so the first key is the least recently stored
+  while(responseCache.size > CACHE_MAX_ENTRIES) responseCache.delete(responseCache.keys().next().value)
+}
+
+function render(data, append){
   const out = document.getElementById('results')
-  if(!data || data.length === 0){ out.innerHTML = '<p>No books found.</p>'; return }
-  out.innerHTML = data.map(b => {
-    const loggedIn = (typeof STUDENT_LOGGED_IN !== 'undefined' && (STUDENT_LOGGED_IN === true || STUDENT_LOGGED_IN === 'true'))
-    let borrowBtn = ''
-    if(loggedIn){
-      if(typeof STUDENT_BORROW_COUNT !== 'undefined' && STUDENT_BORROW_COUNT >= 3){
-        borrowBtn = `<button class="btn btn-sm btn-secondary" disabled>Borrow (limit reached)</button>`
-      } else {
-        // use JS helper to create POST form so CSRF token is always included
-        borrowBtn = `<button class="btn btn-sm btn-primary" type="button" onclick="submitPost('/student/borrow/${b.id}')">Borrow</button>`
-      }
+  const books = data.results || []
+  const token = ++renderToken
+  const more = document.getElementById('load-more')
+  if(more) more.remove()
+  if(!append){
+    out.textContent = ''
+    if(books.length === 0){ out.innerHTML = '<p>No books found.</p>'; return }
+  }
+  let i = 0
+  function step(){
+    // a newer render owns the list now
+    if(token !== renderToken) return
+    const frag = document.createDocumentFragment()
+    for(const end = Math.min(i + RENDER_CHUNK, books.length); i < end; i++) frag.appendChild(bookCard(books[i]))
+    out.appendChild(frag)
+    if(i < books.length) requestAnimationFrame(step)
+    else if(data.next_cursor) out.after(loadMoreButton(data.next_cursor))
+  }
+  step()
+}
+
+function bookCard(b){
+  const loggedIn = (typeof STUDENT_LOGGED_IN !== 'undefined' && (STUDENT_LOGGED_IN === true || STUDENT_LOGGED_IN === 'true'))
+  let borrowBtn = ''
+  if(loggedIn){
+    if(b.copies <= 0){
+      // no copy on the shelf: join the queue and get told when one is set aside
+      borrowBtn = `<button class="btn btn-sm btn-outline-primary" type="button" onclick="submitPost('/student/hold/${b.id}')">Place hold</button>`
+    } else if(typeof STUDENT_BORROW_COUNT !== 'undefined' && STUDENT_BORROW_COUNT >= 3){
+      borrowBtn = `<button class="btn btn-sm btn-secondary" disabled>Borrow (limit reached)</button>`
+    } else {
+      // use JS helper to create POST form so CSRF token is always included
+      borrowBtn = `<button class="btn btn-sm btn-primary" type="button" onclick="submitPost('/student/borrow/${b.id}')">Borrow</button>`
     }
-    return `
-    <div class="book p-3 mb-2 border rounded">
+  }
+  const div = document.createElement('div')
+  div.className = 'book p-3 mb-2 border rounded'
+  div.innerHTML = `
       <div class="title"><strong>${escapeHtml(b.title)}</strong></div>
       <div class="meta text-muted">${escapeHtml(b.author)} — ${b.year || ''} — ${escapeHtml(b.department)} — ISBN: ${escapeHtml(b.isbn || '')} — Copies: ${b.copies}</div>
-      <div style="margin-top:8px">${borrowBtn}</div>
-    </div>`
-  }).join('')
+      ${alsoBorrowed(b.also_borrowed)}
+      <div style="margin-top:8px">${borrowBtn}</div>`
+  return div
+}
+
+function alsoBorrowed(books){
+  // streamed results (stream=1) come without recommendations
+  if(!books || books.length === 0) return ''
+  return `<div class="meta small">Students who borrowed this also borrowed: ${books.map(function(o){ return escapeHtml(o.title) }).join(', ')}</div>`
+}
+
+function loadMoreButton(cursor){
+  const btn = document.createElement('button')
+  btn.id = 'load-more'
+  btn.type = 'button'
+  btn.className = 'btn btn-outline-primary mt-2'
+  btn.textContent = 'Load more'
+  btn.addEventListener('click', function(){ btn.disabled = true; loadMore(cursor) })
+  return btn
 }
 
 function submitPost(path){
@@ -0,0 +1,45 @@
+import sqlite3
+import uuid
+
+import pytest
+
+import app as app_module
+import cache
+import create_db
+import db as db_pool
+
+
+@pytest.fixture
+def fresh_db(tmp_path, monkeypatch):
+    """Point the app at a new database in a temp dir, copied from the migrated
+    template, and return its path."""
+    db_path = tmp_path / 'library.db'
+    conn = create_db.connect(db_path)
+    create_db.copy_template(conn, sample=True)
+    conn.close()
+    monkeypatch.setitem(app_module.app.config, 'DB_PATH', str(db_path))
+    monkeypatch.setattr(app_module, 'search_cache', cache.SearchCache(cache.MemoryBackend()))
+    return db_path
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    """Point the app at an in-memory database of its own, copied
+    from the template with the sample data; nothing is written to disk."""
+    path = db_pool.memory_path(f'library-{uuid.uuid4().hex}')
+    # the database lasts as long as a connection to it is open
+    anchor = sqlite3.connect(path, uri=True, check_same_thread=False)
+    create_db.copy_template(anchor, sample=True)
+    monkeypatch.setitem(app_module.app.config, 'DB_PATH', path)
+    monkeypatch.setattr(app_module, 'search_cache', cache.SearchCache(cache.MemoryBackend()))
+    yield path
+    db_pool.close_pools()
+    anchor.close()
+
+
+@pytest.fixture
+def fresh_client(fresh_db):
+    app_module.app.config['TESTING'] = True
+    app_module.app.config['WTF_CSRF_ENABLED'] = False
+    with app_module.app.test_client() as c:
+        yield c
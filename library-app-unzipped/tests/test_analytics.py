@@ -0,0 +1,121 @@
+import random
+import sqlite3
+from collections import Counter
+
+import analytics
+import create_db
+
+DAY = 86400
+NOW = 1_700_000_000  # 2023-11-14
+CONFIG = dict(analytics.env_config(), ANALYTICS_CHUNK=3, ANALYTICS_PAUSE=0)
+
+
+def add_borrows(conn, rnd, n, since, now):
+    for _ in range(n):
+        borrowed = rnd.randint(since, now)
+        returned = borrowed + rnd.randint(DAY, 30 * DAY)
+        if returned > now:
+            returned = None
+        conn.execute('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts, returned_at, returned_ts)'
+                     ' VALUES (1, ?, ?, ?, ?, ?)',
+                     (rnd.randint(1, 10), 'then', borrowed, returned and 'then', returned))
+
+
+def rollups(conn):
+    days = {r[0:2]: r[2:] for r in conn.execute(
+        'SELECT day, department, borrows, returns, loan_seconds, late_returns FROM analytics_days')}
+    months = dict(((r[0], r[1]), r[2]) for r in conn.execute('SELECT month, book_id, borrows FROM analytics_book_months'))
+    return days, months, dict(conn.execute('SELECT book_id, borrows FROM analytics_books').fetchall())
+
+
+def recount(conn):
+    # the same rollups, straight from the borrows rows
+    days, months, books = Counter(), Counter(), Counter()
+    departments = dict(conn.execute('SELECT id, department FROM books').fetchall())
+    for book_id, borrowed, returned, due in conn.execute('SELECT book_id, borrowed_ts, returned_ts, due_ts FROM borrows'):
+        day = analytics.datetime.fromtimestamp(borrowed, analytics.timezone.utc)
+        days[day.strftime('%Y-%m-%d'), departments[book_id], 'borrows'] += 1
+        months[day.strftime('%Y-%m'), book_id] += 1
+        books[book_id] += 1
+        if returned is not None:
+            day = analytics.datetime.fromtimestamp(returned, analytics.timezone.utc).strftime('%Y-%m-%d')
+            days[day, departments[book_id], 'returns'] += 1
+            days[day, departments[book_id], 'loan_seconds'] += returned - borrowed
+            days[day, departments[book_id], 'late_returns'] += returned > due
+    keys = {k[:2] for k in days}
+    return ({k: tuple(days[k + (c,)] for c in ('borrows', 'returns', 'loan_seconds', 'late_returns')) for k in keys},
+            dict(months), dict(books))
+
+
+def test_incremental_runs_match_a_recount(fresh_db):
+    conn = create_db.connect(fresh_db)
+    rnd = random.Random(5)
+    add_borrows(conn, rnd, 40, NOW - 90 * DAY, NOW - 60)
+    # ANALYTICS_CHUNK=3: many transactions, each moving its checkpoint
+    assert analytics.run(conn, CONFIG, NOW) == {
+        'analytics_borrowed': 40,
+        'analytics_returned': conn.execute('SELECT COUNT(*) FROM borrows WHERE returned_ts IS NOT NULL').fetchone()[0]}
+    assert rollups(conn) == recount(conn)
+
+    # the next runs add only what happened since: new borrows, and returns of old ones
+    later = NOW + 10 * DAY
+    add_borrows(conn, rnd, 15, NOW, later - 60)
+    returning = [r[0] for r in conn.execute('SELECT id FROM borrows WHERE returned_ts IS NULL LIMIT 5')]
+    conn.executemany('UPDATE borrows SET returned_ts = ?, returned_at = ? WHERE id = ?',
+                     [(later - 120, 'now', i) for i in returning])
+    totals = analytics.run(conn, CONFIG, later)
+    assert totals['analytics_borrowed'] == 15 and totals['analytics_returned'] >= 5
+    assert analytics.run(conn, CONFIG, later) == {'analytics_borrowed': 0, 'analytics_returned': 0}
+    assert rollups(conn) == recount(conn)
+
+    # copies per department follow catalogue edits without a pass over books
+    conn.execute('UPDATE books SET copies = copies + 2 WHERE id = 1')
+    conn.execute("INSERT INTO books (title, copies, department) VALUES ('Optics', 3, 'Physics')")
+    conn.execute("UPDATE books SET department = 'Math' WHERE title = 'Optics'")
+    departments = ('SELECT department, copies, on_loan FROM analytics_departments'
+                   ' WHERE copies != 0 OR on_loan != 0 ORDER BY department')
+    kept = conn.execute(departments).fetchall()
+    create_db.repair_analytics_departments(conn)
+    assert kept == conn.execute(departments).fetchall()
+    conn.execute('UPDATE books SET copies = copies - 2 WHERE id = 1')
+    conn.execute("DELETE FROM books WHERE title = 'Optics'")
+
+    conn.row_factory = sqlite3.Row
+    report = analytics.report(conn, '2023-11', 3)
+    on_loan = conn.execute('SELECT COUNT(*) FROM borrows WHERE returned_ts IS NULL').fetchone()[0]
+    assert sum(d['on_loan'] for d in report['departments']) == on_loan
+    assert sum(d['copies'] for d in report['departments']) == 16 + on_loan
+    top = sorted(recount(conn)[2].items(), key=lambda t: (-t[1], t[0]))
+    assert [(b['book_id'], b['borrows']) for b in report['top_books']] == top[:10]
+    assert {m['month'] for m in report['by_month']} <= {'2023-09', '2023-10', '2023-11'}
+    assert sum(m['borrows'] for m in report['by_month']) == sum(
+        n for (month, _), n in recount(conn)[1].items() if '2023-09' <= month <= '2023-11')
+
+
+def test_analytics_page_and_json(fresh_client, fresh_db):
+    conn = create_db.connect(fresh_db)
+    fresh_client.post('/admin/login', data={'password': 'rahul@123'})
+    empty = fresh_client.get('/admin/analytics')
+    assert 'run <code>python analytics.py</code>' in empty.data.decode()
+
+    conn.executemany('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts, returned_at, returned_ts)'
+                     ' VALUES (1, ?, ?, ?, ?, ?)',
+                     [(8, 'then', NOW - 20 * DAY, 'then', NOW - 10 * DAY), (8, 'then', NOW - 5 * DAY, None, None),
+                      (3, 'then', NOW - 40 * DAY, 'then', NOW - 20 * DAY)])
+    conn.execute('UPDATE books SET copies = copies - 1 WHERE id = 8')
+    analytics.run(conn, CONFIG, NOW)
+    # a run changes the page, so the old ETag no longer matches
+    page = fresh_client.get('/admin/analytics?month=2023-11', headers={'If-None-Match': empty.headers['ETag']})
+    assert page.status_code == 200
+    assert '<li>Computer Networks (2)</li>' in page.data.decode()
+
+    data = fresh_client.get('/admin/analytics?month=2023-11&months=2&format=json').get_json()
+    assert data['top_books_month'] == [{'book_id': 8, 'title': 'Computer Networks', 'borrows': 1}]
+    assert data['top_books'][0] == {'book_id': 8, 'title': 'Computer Networks', 'borrows': 2}
+    assert [(m['month'], m['department'], m['borrows'], m['returns'], m['average_loan_days'])
+            for m in data['by_month']] == [('2023-11', 'CSE', 1, 1, 10.0), ('2023-10', 'CSE', 1, 0, None),
+                                           ('2023-10', 'Math', 1, 1, 20.0)]
+    cse = next(d for d in data['departments'] if d['department'] == 'CSE')
+    assert (cse['copies'], cse['on_loan']) == (14, 1)
+    assert fresh_client.get('/admin/analytics?month=nope&format=json').status_code == 400
+    assert fresh_client.get('/admin/analytics?months=0').status_code == 400
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import re
+import sqlite3
+
+import pytest
+
+import app as app_module
+import async_db
+import asgi
+import db as db_pool
+import holds
+
+
+def call(asgi_app, method, path, query=b'', headers=()):
+    """Run one request through an ASGI app; returns (status, headers, body)."""
+    messages = []
+    received = []
+
+    async def receive():
+        # the request body, then nothing until the client goes away (it never does)
+        if received:
+            await asyncio.Event().wait()
+        received.append(True)
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+             'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query,
+             'root_path': '', 'headers': list(headers), 'client': ('127.0.0.1', 5000),
+             'server': ('127.0.0.1', 8000)}
+    asyncio.run(asgi_app(scope, receive, send))
+    start = messages[0]
+    body = b''.join(m.get('body', b'') for m in messages[1:])
+    return start['status'], dict(start['headers']), body
+
+
+@pytest.fixture
+def asgi_app(fresh_db):
+    served = asgi.LibraryASGI(app_module.app)
+    yield served
+    if served.db is not None:
+        served.db.close()
+
+
+def test_native_search_matches_the_flask_view(asgi_app, fresh_client):
+    for query in [b'', b'q=data', b'q=operating&available=1', b'limit=3', b'stream=1', b'q=zzzz&stream=1']:
+        status, headers, body = call(asgi_app, 'GET', '/api/search', query)
+        expected = fresh_client.get('/api/search?' + query.decode())
+        assert status == 200
+        assert json.loads(body) == expected.get_json()
+        assert headers.get(b'etag', b'').decode() == (expected.headers.get('ETag') or '')
+
+    _, headers, _ = call(asgi_app, 'GET', '/api/search', b'q=data')
+    status, _, body = call(asgi_app, 'GET', '/api/search', b'q=data', [(b'if-none-match', headers[b'etag'])])
+    assert (status, body) == (304, b'')
+    status, _, body = call(asgi_app, 'GET', '/api/search', b'cursor=!!')
+    assert status == 400 and json.loads(body) == {'error': 'Invalid cursor'}
+
+
+def test_other_routes_go_through_flask(asgi_app, fresh_client):
+    status, _, body = call(asgi_app, 'GET', '/')
+    assert status == 200 and b'Department Library' in body
+    assert call(asgi_app, 'GET', '/admin')[0] == 302
+
+    # native searches are counted under the Flask endpoint name
+    def served():
+        text = call(asgi_app, 'GET', '/metrics')[2].decode()
+        match = re.search(r'^library_requests_total{endpoint="api_search",status="200"} (\d+)$', text, re.M)
+        return int(match.group(1)) if match else 0
+
+    before = served()
+    call(asgi_app, 'GET', '/api/search', b'q=data')
+    assert served() == before + 1
+
+
+def test_async_database_reads_and_streams(fresh_db):
+    adb = async_db.AsyncDatabase(fresh_db, app_module.app.config, readers=2, stream_chunk=4)
+
+    def add(conn, i):
+        conn.execute('INSERT INTO books (title, author, year, isbn, copies, department)'
+                     ' VALUES (?, ?, 2000, ?, 1, ?)', (f'Async {i}', 'A', f'async-{i}', 'CSE'))
+
+    conn = db_pool.connect(fresh_db, app_module.app.config)
+    with conn:
+        for i in range(20):
+            add(conn, i)
+    conn.close()
+
+    async def scenario():
+        count = await adb.read(lambda conn: conn.execute(
+            "SELECT COUNT(*) FROM books WHERE department = 'CSE' AND isbn LIKE 'async-%'").fetchone()[0])
+        with pytest.raises(sqlite3.OperationalError):
+            await adb.read(add, 'ro')
+        streamed = [len(rows) async for rows in adb.stream("SELECT id FROM books WHERE isbn LIKE 'async-%'")]
+        # stopping early leaves the reader free for the next query
+        async for _ in adb.stream('SELECT id FROM books'):
+            break
+        again = await adb.read(lambda conn: conn.execute('SELECT 1').fetchone()[0])
+        return count, streamed, again
+
+    try:
+        assert asyncio.run(scenario()) == (20, [4, 4, 4, 4, 4], 1)
+    finally:
+        adb.close()
+
+
+def test_hold_events_stream_on_the_loop(asgi_app, fresh_client, fresh_db, monkeypatch):
+    # with no time left the stream ends after the events already due
+    monkeypatch.setitem(app_module.app.config, 'HOLD_EVENTS_TIMEOUT', 0)
+    conn = db_pool.connect(fresh_db, app_module.app.config)
+    with conn:
+        conn.execute('UPDATE books SET copies = 0 WHERE id = 5')
+        holds.place(conn, 1, 5, 1000)
+        holds.pass_on(conn, 5, 1000)
+    conn.close()
+    # without a student session the Flask view redirects to the login
+    assert call(asgi_app, 'GET', '/student/events')[0] == 302
+
+    fresh_client.post('/student/login', data={'email': 'student@example.com', 'password': 'student123'})
+    cookie = f"session={fresh_client.get_cookie('session').value}".encode()
+    status, headers, body = call(asgi_app, 'GET', '/student/events', headers=[(b'cookie', cookie)])
+    assert status == 200 and headers[b'content-type'].startswith(b'text/event-stream')
+    assert b'event: ready' in body
+    assert body == fresh_client.get('/student/events').data
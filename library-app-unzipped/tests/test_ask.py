@@ -0,0 +1,85 @@
+import sqlite3
+
+import pytest
+
+import app as app_module
+import ask
+import create_db
+import db as db_pool
+
+
+def titles(answer):
+    return [b['title'] for b in answer['results']]
+
+
+def test_questions_are_answered_from_the_index(fresh_db, tmp_path):
+    conn = create_db.connect(fresh_db)
+    conn.isolation_level = None
+    conn.row_factory = sqlite3.Row
+    assistant = ask.Assistant(str(tmp_path / 'ask'), ask.env_config())
+    # questions never build the index themselves
+    with pytest.raises(ask.NotIndexed):
+        assistant.ask(conn, 'compilers', 5)
+    assert ask.run(conn, ask.env_config(), str(tmp_path / 'ask')) == len(create_db.sample)
+
+    answer = assistant.ask(conn, "do you have anything on compilers that's available?", 5)
+    assert titles(answer) == ['Principles of Compiler Design']
+    assert answer['filters']['available']
+    assert answer['answer'].startswith('Yes, 1 book on compilers available now: Principles of Compiler Design')
+
+    # plurals match, filters narrow, and of two title matches the shorter entry ranks first
+    answer = assistant.ask(conn, 'database books in CSE after 2011', 5)
+    assert answer['terms'] == ['database']
+    assert answer['filters']['department'] == 'CSE' and answer['filters']['min_year'] == 2012
+    assert titles(answer) == ['Modern Database Management']
+    assert titles(assistant.ask(conn, 'databases', 5)) == ['Modern Database Management', 'Database System Concepts']
+
+    # a borrowed-out book is listed apart when the question asks for available ones
+    conn.execute('UPDATE books SET copies = 0 WHERE id = 9')
+    answer = assistant.ask(conn, 'any compilers available?', 5)
+    assert answer['results'] == [] and [b['id'] for b in answer['on_loan']] == [9]
+    assert answer['answer'].startswith('Nothing on compilers is on the shelf right now.')
+    assert assistant.ask(conn, 'quantum chromodynamics', 5)['results'] == []
+
+
+def test_catalogue_changes_reach_answers_without_a_rebuild(fresh_client, fresh_db, monkeypatch):
+    config = app_module.app.config
+    path = ask.directory(str(fresh_db), config)
+    conn = db_pool.connect(fresh_db, config, readonly=True)
+    conn.isolation_level = None
+    rv = fresh_client.get('/api/ask?q=compilers')
+    assert rv.status_code == 503 and rv.headers['Retry-After'] == '60'
+    ask.run(conn, config, path)
+    fresh_client.post('/admin/login', data={'password': 'rahul@123'})
+    first = fresh_client.get('/api/ask?q=compilers')
+    assert titles(first.get_json()) == ['Principles of Compiler Design']
+    assert fresh_client.get('/api/ask?q=compilers', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+    assert fresh_client.get('/api/ask?q=').status_code == 400
+    generation = ask.read_manifest(path)['generation']
+
+    # added, edited and deleted books are answered from their rows until the next build
+    fresh_client.post('/admin/add', data={'title': 'Engineering a Compiler', 'author': 'Cooper, Torczon',
+                                          'year': '2011', 'copies': '1', 'department': 'CSE'})
+    fresh_client.post('/admin/edit/9', data={'title': 'Compilers: Principles, Techniques, and Tools',
+                                             'author': 'Aho, Lam, Sethi, Ullman', 'year': '2006', 'copies': '1',
+                                             'department': 'CSE'})
+    again = fresh_client.get('/api/ask?q=compilers', headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 200
+    assert titles(again.get_json()) == ['Engineering a Compiler', 'Compilers: Principles, Techniques, and Tools']
+    assert titles(fresh_client.get('/api/ask?q=compilers+after+2010').get_json()) == ['Engineering a Compiler']
+    fresh_client.post('/admin/delete/9')
+    assert titles(fresh_client.get('/api/ask?q=compilers').get_json()) == ['Engineering a Compiler']
+    assert ask.run(conn, config, path) is None
+    assert ask.read_manifest(path)['generation'] == generation
+
+    # past ASK_MAX_CHANGES changed books questions still read the rows, and the
+    # job rebuilds the index with them in it
+    monkeypatch.setitem(config, 'ASK_MAX_CHANGES', 2)
+    fresh_client.post('/admin/edit/8', data={'title': 'Computer Networks', 'author': 'Andrew S. Tanenbaum',
+                                             'year': '2011', 'copies': '1', 'department': 'CSE'})
+    assert titles(fresh_client.get('/api/ask?q=compiler&limit=1').get_json()) == ['Engineering a Compiler']
+    assert ask.read_manifest(path)['generation'] == generation
+    assert ask.run(conn, config, path) == len(create_db.sample)
+    assert titles(fresh_client.get('/api/ask?q=compiler&limit=1').get_json()) == ['Engineering a Compiler']
+    assert ask.read_manifest(path)['generation'] == generation + 1
+    conn.close()
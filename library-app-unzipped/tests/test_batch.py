@@ -0,0 +1,49 @@
+import create_db
+
+
+def test_availability_of_many_books_at_once(fresh_client):
+    res = fresh_client.get('/api/availability?ids=1,99&ids=9&isbns=0132350882,nope')
+    assert res.status_code == 200
+    assert res.get_json()['results'] == [
+        {'id': 1, 'found': True, 'book_id': 1, 'isbn': '0262033844', 'title': 'Introduction to Algorithms',
+         'copies': 3, 'available': True},
+        {'id': 99, 'found': False},
+        {'id': 9, 'found': True, 'book_id': 9, 'isbn': '0201003003', 'title': 'Principles of Compiler Design',
+         'copies': 1, 'available': True},
+        {'isbn': '0132350882', 'found': True, 'book_id': 2, 'title': 'Clean Code',
+         'copies': 2, 'available': True},
+        {'isbn': 'nope', 'found': False},
+    ]
+    assert fresh_client.get('/api/availability?ids=1,99&ids=9&isbns=0132350882,nope',
+                            headers={'If-None-Match': res.headers['ETag']}).status_code == 304
+    assert fresh_client.get('/api/availability').status_code == 400
+    assert fresh_client.get('/api/availability?ids=x').status_code == 400
+    assert fresh_client.get('/api/availability?ids=' + ','.join(['1'] * 101)).status_code == 400
+
+
+def test_bulk_borrow_is_one_transaction_within_the_limits(fresh_client, fresh_db):
+    assert fresh_client.post('/api/borrow', json={'ids': [1]}).status_code == 401
+    fresh_client.post('/student/login', data={'email': 'student@example.com', 'password': 'student123'})
+    fresh_client.post('/student/borrow/10')
+
+    # one borrow left under the limit of 3 after two new ones; book 8 has one copy
+    conn = create_db.connect(fresh_db)
+    conn.execute('UPDATE books SET copies = 0 WHERE id = 8')
+    res = fresh_client.post('/api/borrow', json={'ids': [1, 1, 99, 8], 'isbns': ['0132350882', '0201003003']})
+    assert res.status_code == 200
+    body = res.get_json()
+    assert [(r.get('id', r.get('isbn')), r['borrowed'], r.get('error')) for r in body['results']] == [
+        (1, True, None), (1, False, 'Already borrowed in this request'), (99, False, 'Book not found'),
+        (8, False, 'Book not available'), ('0132350882', True, None),
+        ('0201003003', False, 'Borrow limit reached (3 books)')]
+    assert body['active_borrows'] == 3
+    assert conn.execute('SELECT active_borrows FROM students WHERE id = 1').fetchone()[0] == 3
+    assert conn.execute('SELECT book_id FROM borrows WHERE student_id = 1 ORDER BY id').fetchall() == [(10,), (1,), (2,)]
+    assert conn.execute('SELECT copies FROM books WHERE id IN (1, 2, 9) ORDER BY id').fetchall() == [(2,), (1,), (1,)]
+    assert conn.execute("SELECT value FROM meta WHERE key = 'borrow_version'").fetchone()[0] >= 3
+
+    # the dashboard's return form still works on a bulk borrow
+    borrow_id = body['results'][0]['borrow_id']
+    fresh_client.post(f'/student/return/{borrow_id}')
+    assert fresh_client.post('/api/borrow', json={'isbns': ['0201003003']}).get_json()['results'][0]['borrowed']
+    assert fresh_client.post('/api/borrow', json=['not', 'an', 'object']).status_code == 400
@@ -0,0 +1,67 @@
+"""Many processes borrowing the same book at once must never oversell it.
+
+Sizes can be raised through LIB_STRESS_PROCS / LIB_STRESS_BORROWS.
+"""
+import multiprocessing
+import os
+import time
+
+import app as app_module
+import create_db
+
+PROCS = int(os.environ.get('LIB_STRESS_PROCS', 8))
+BORROWS = int(os.environ.get('LIB_STRESS_BORROWS', 2000))
+COPIES = BORROWS // 4
+
+
+def borrow_worker(db_path, student_ids, book_id, start, results):
+    app = app_module.create_app({'DB_PATH': db_path, 'TESTING': True, 'WTF_CSRF_ENABLED': False})
+    start.wait()
+    ok = errors = 0
+    with app.test_client() as client:
+        for sid in student_ids:
+            with client.session_transaction() as sess:
+                # drop the previous student's unread flashes along with the login
+                sess.clear()
+                sess['student_id'] = sid
+            rv = client.post(f'/student/borrow/{book_id}')
+            if rv.status_code != 302:
+                errors += 1
+            elif rv.headers['Location'].endswith('/student/dashboard'):
+                ok += 1
+    results.put((ok, errors))
+
+
+def test_concurrent_borrows_never_oversell(tmp_path):
+    db_path = str(tmp_path / 'library.db')
+    conn = create_db.connect(db_path)
+    create_db.copy_template(conn)
+    conn.execute('BEGIN')
+    book_id = conn.execute("INSERT INTO books (title, copies) VALUES ('Contended', ?)", (COPIES,)).lastrowid
+    # each student asks once, so the borrow limit never comes into play
+    conn.executemany('INSERT INTO students (name, email, password_hash) VALUES (?,?,?)',
+                     ((f's{i}', f's{i}@example.com', 'x') for i in range(BORROWS)))
+    conn.execute('COMMIT')
+    student_ids = [r[0] for r in conn.execute("SELECT id FROM students WHERE email LIKE 's%@example.com' ORDER BY id")]
+    conn.close()
+
+    ctx = multiprocessing.get_context('fork')
+    start, results = ctx.Event(), ctx.Queue()
+    procs = [ctx.Process(target=borrow_worker, args=(db_path, student_ids[i::PROCS], book_id, start, results))
+             for i in range(PROCS)]
+    for p in procs:
+        p.start()
+    began = time.perf_counter()
+    start.set()
+    outcomes = [results.get(timeout=300) for _ in procs]
+    elapsed = time.perf_counter() - began
+    for p in procs:
+        p.join()
+    print(f'\n{BORROWS} borrows from {PROCS} processes in {elapsed:.2f}s ({BORROWS / elapsed:.0f} req/s)')
+
+    assert sum(e for _, e in outcomes) == 0
+    assert sum(ok for ok, _ in outcomes) == COPIES
+    conn = create_db.connect(db_path)
+    assert conn.execute('SELECT copies FROM books WHERE id = ?', (book_id,)).fetchone()[0] == 0
+    assert conn.execute('SELECT COUNT(*) FROM borrows WHERE book_id = ?', (book_id,)).fetchone()[0] == COPIES
+    assert create_db.check_active_borrows(conn) == []
@@ -0,0 +1,33 @@
+import app as app_module
+import cache
+
+
+def test_memory_backend_lru_and_ttl(monkeypatch):
+    backend = cache.MemoryBackend(maxsize=2, ttl=10)
+    backend.set('a', b'1')
+    backend.set('b', b'2')
+    assert backend.get('a') == b'1'
+    backend.set('c', b'3')  # 'b' is now the least recently used
+    assert backend.get('b') is None
+    assert backend.stats()['evictions'] == 1
+
+    now = cache.time.monotonic()
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now + 11)
+    assert backend.get('a') is None
+    assert backend.stats()['evictions'] == 2
+
+
+def test_search_cache_hits_until_the_catalog_changes(fresh_client):
+    client = fresh_client
+    first = client.get('/api/search?q=Clean%20Code').get_json()
+    again = client.get('/api/search?q=clean   code').get_json()
+    assert first == again
+    assert app_module.search_cache.stats()['hits'] == 1
+
+    book = first['results'][0]
+    with client.session_transaction() as sess:
+        sess['student_id'] = 1
+    client.post(f"/student/borrow/{book['id']}")
+    after = client.get('/api/search?q=clean code').get_json()
+    assert after['results'][0]['copies'] == book['copies'] - 1
+    assert app_module.search_cache.stats()['misses'] == 2
@@ -0,0 +1,68 @@
+import io
+
+import catalog_io
+import create_db
+
+
+def test_validate_book_matches_admin_form_rules():
+    assert catalog_io.validate_book({'title': ' T ', 'year': '2001', 'copies': ''}) == (('T', '', 2001, '', 1, ''), [])
+    row, errors = catalog_io.validate_book({'title': '', 'copies': 'x', 'year': 'y'})
+    assert row is None
+    assert errors == ['Title is required', 'Copies must be a number', 'Year must be a number']
+
+
+def test_import_upserts_by_isbn_and_reports_bad_rows(tmp_path):
+    conn = create_db.connect(tmp_path / 'library.db')
+    create_db.copy_template(conn, sample=True)
+    triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' ORDER BY name").fetchall()
+    version = conn.execute("SELECT value FROM meta WHERE key = 'catalog_version'").fetchone()[0]
+    data = io.StringIO(
+        'title,author,year,isbn,copies,department\n'
+        'Clean Code 2nd Edition,Robert C. Martin,2024,0132350882,5,CSE\n'
+        'Brand New,Someone,2020,9999999999,1,Math\n'
+        ',Nobody,2020,,1,Math\n'
+        'No Isbn,Anon,,,2,CSE\n'
+    )
+    report = catalog_io.import_books(conn, catalog_io.read_records(data, 'csv'), batch_size=2)
+    assert (report.inserted, report.updated, report.skipped) == (2, 1, 1)
+    assert report.errors == ['Line 4: Title is required']
+    row = conn.execute("SELECT title, copies FROM books WHERE isbn = '0132350882'").fetchall()
+    assert row == [('Clean Code 2nd Edition', 5)]
+    # the suspended triggers are back and their work was done set-based
+    fts = "SELECT COUNT(*) FROM books_fts WHERE books_fts MATCH ?"
+    assert conn.execute(fts, ('brand',)).fetchone()[0] == 1
+    assert conn.execute(fts, ('edition',)).fetchone()[0] == 1
+    assert conn.execute("INSERT INTO books_fts(books_fts, rank) VALUES ('integrity-check', 1)")
+    assert conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' ORDER BY name").fetchall() == triggers
+    assert conn.execute("SELECT value FROM meta WHERE key = 'catalog_version'").fetchone()[0] == version + 1
+    facets = "SELECT facet, value, books FROM facet_counts WHERE books > 0 ORDER BY facet, value"
+    adjusted = conn.execute(facets).fetchall()
+    create_db.repair_facet_counts(conn)
+    assert adjusted == conn.execute(facets).fetchall()
+    terms = "SELECT term, books FROM search_terms WHERE books > 0 ORDER BY term"
+    adjusted = conn.execute(terms).fetchall()
+    create_db.repair_search_terms(conn)
+    assert adjusted == conn.execute(terms).fetchall() and ('edition', 1) in adjusted
+    departments = ('SELECT department, copies, on_loan FROM analytics_departments'
+                   ' WHERE copies != 0 OR on_loan != 0 ORDER BY department')
+    adjusted = conn.execute(departments).fetchall()
+    create_db.repair_analytics_departments(conn)
+    assert adjusted == conn.execute(departments).fetchall()
+
+
+def test_export_round_trips_through_import(tmp_path):
+    conn = create_db.connect(tmp_path / 'library.db')
+    create_db.copy_template(conn, sample=True)
+    for fmt in ('csv', 'jsonl'):
+        exported = ''.join(catalog_io.export_books(conn, fmt))
+        report = catalog_io.import_books(conn, catalog_io.read_records(io.StringIO(exported), fmt))
+        assert (report.inserted, report.updated) == (0, len(create_db.sample))
+
+
+def test_admin_import_endpoint(fresh_client):
+    fresh_client.post('/admin/login', data={'password': 'rahul@123'})
+    data = {'file': (io.BytesIO(b'{"title": "Uploaded", "isbn": "123", "copies": 2}\nnot json\n'), 'books.jsonl')}
+    fresh_client.post('/admin/import', data=data)
+    page = fresh_client.get('/admin')
+    assert b'Imported 1 new' in page.data and b'Line 2: Not a JSON object' in page.data
+    assert fresh_client.get('/api/search?q=uploaded').get_json()['results'][0]['copies'] == 2
@@ -0,0 +1,18 @@
+def test_conditional_requests(fresh_client):
+    client = fresh_client
+    rv = client.get('/api/search?dept=CSE')
+    etag = rv.headers['ETag']
+    assert rv.headers['Cache-Control'] == 'public, no-cache'
+    assert client.get('/api/search?dept=CSE', headers={'If-None-Match': etag}).status_code == 304
+    # a different search has a different tag
+    assert client.get('/api/search?dept=Math', headers={'If-None-Match': etag}).status_code == 200
+
+    client.post('/student/login', data={'email': 'student@example.com', 'password': 'student123'})
+    client.get('/')  # consume the login flash
+    dash = client.get('/student/dashboard')
+    tag = dash.headers['ETag']
+    assert client.get('/student/dashboard', headers={'If-None-Match': tag}).status_code == 304
+    # borrowing changes the borrow version stamp, so the dashboard is rendered again
+    book_id = client.get('/api/search?available=1').get_json()['results'][0]['id']
+    client.post(f'/student/borrow/{book_id}', follow_redirects=True)
+    assert client.get('/student/dashboard', headers={'If-None-Match': tag}).status_code == 200
@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import create_db
+import db as db_pool
+
+
+def test_pooled_connections_are_tuned_and_reused(tmp_path):
+    path = tmp_path / 'library.db'
+    create_db.migrate(create_db.connect(path))
+    config = dict(db_pool.env_config(), DB_POOL_SIZE=2, DB_BUSY_TIMEOUT=1234)
+    pool = db_pool.ConnectionPool(str(path), config)
+
+    conn = pool.acquire()
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == 1234
+    assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+    pool.release(conn)
+    assert pool.acquire() is conn
+    pool.close()
+
+
+def test_read_only_pool_rejects_writes(tmp_path):
+    path = tmp_path / 'library.db'
+    create_db.copy_template(create_db.connect(path), sample=True)
+    pool = db_pool.ConnectionPool(str(path), db_pool.env_config(), readonly=True)
+    conn = pool.acquire()
+    assert conn.execute('SELECT COUNT(*) FROM books').fetchone()[0] == len(create_db.sample)
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("INSERT INTO books (title) VALUES ('nope')")
+    pool.release(conn)
+    pool.close()
+
+
+def test_app_returns_connections_to_the_pool(fresh_db):
+    import app as app_module
+    with app_module.app.test_request_context():
+        first = app_module.get_db()
+    with app_module.app.test_request_context():
+        assert app_module.get_db() is first
+
+
+def test_memory_target_is_filled_from_the_template(monkeypatch):
+    import app as app_module
+    path = db_pool.memory_path('test-memory-target')
+    monkeypatch.setitem(app_module.app.config, 'DB_PATH', path)
+    assert app_module.create_app({'DB_PATH': path}) is app_module.app
+    with app_module.app.test_request_context():
+        db = app_module.get_db()
+        assert create_db.schema_version(db) == len(create_db.MIGRATIONS)
+        # the schema only: the sample data is for --seed and test fixtures
+        assert db.execute('SELECT COUNT(*) FROM students').fetchone()[0] == 0
+    # a second connection sees the same database, and writes stay in memory
+    other = db_pool.connect(path, app_module.app.config)
+    other.execute("INSERT INTO books (title) VALUES ('Only in memory')")
+    other.commit()
+    with app_module.app.test_request_context():
+        assert app_module.get_db().execute("SELECT 1 FROM books WHERE title = 'Only in memory'").fetchone()
+    other.close()
+    db_pool.close_pools()
+
+
+def test_memory_readers_wait_out_an_open_write(memory_db):
+    config = dict(db_pool.env_config(), DB_BUSY_TIMEOUT=5000)
+    writer = db_pool.connect(memory_db, config)
+    reader = db_pool.connect(memory_db, config, readonly=True)
+    books = reader.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+    writer.execute('BEGIN IMMEDIATE')
+    writer.execute("INSERT INTO books (title) VALUES ('Mid-write')")
+
+    def commit():
+        time.sleep(0.2)
+        writer.execute('COMMIT')
+    threading.Thread(target=commit).start()
+    # the read waits for the commit within busy_timeout instead of failing on a table lock
+    assert reader.execute('SELECT COUNT(*) FROM books').fetchone()[0] == books + 1
+    writer.close()
+    reader.close()
+
+
+def test_new_database_file_is_copied_from_the_template(tmp_path):
+    path = str(tmp_path / 'library.db')
+    pool = db_pool.get_pool(path, db_pool.env_config(), init=create_db.init_database)
+    conn = pool.acquire()
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert create_db.schema_version(conn) == len(create_db.MIGRATIONS)
+    conn.execute("INSERT INTO books (title, copies) VALUES ('Kept', 0)")
+    conn.commit()
+    pool.release(conn)
+    db_pool.close_pools()
+    # a database that already has tables is left as it is
+    pool = db_pool.get_pool(path, db_pool.env_config(), init=create_db.init_database)
+    conn = pool.acquire()
+    assert [tuple(r) for r in conn.execute('SELECT title, copies FROM books')] == [('Kept', 0)]
+    pool.release(conn)
+    db_pool.close_pools()
@@ -1,12 +1,15 @@
+import re
+import time
+
 import pytest
+import app as app_module
 from app import app
 
-# Import create_db to ensure database and sample data exist
 import create_db
 
 
 @pytest.fixture
-def client():
+def client(memory_db):
     app.config['TESTING'] = True
     app.config['WTF_CSRF_ENABLED'] = False
     with app.test_client() as c:
@@ -23,8 +26,75 @@ def test_search_api(client):
     rv = client.get('/api/search')
     assert rv.status_code == 200
     data = rv.get_json()
-    assert isinstance(data, list)
-    assert len(data) >= 1
+    assert isinstance(data['results'], list)
+    assert len(data['results']) >= 1
+
+
+def test_search_api_fulltext(client):
+    # prefix and multi-word matching through the FTS index
+    data = client.get('/api/search?q=tanenb').get_json()['results']
+    assert any(b['title'] == 'Computer Networks' for b in data)
+    data = client.get('/api/search?q=database concepts').get_json()['results']
+    assert data[0]['title'] == 'Database System Concepts'
+    data = client.get('/api/search?q=0262033').get_json()['results']
+    assert any(b['isbn'] == '0262033844' for b in data)
+    # filters still apply on top of the text match
+    data = client.get('/api/search?q=silberschatz&min_year=2015').get_json()['results']
+    assert [b['title'] for b in data] == ['Operating System Concepts'] * len(data) and data
+    # FTS operators in user input are treated as plain text
+    assert client.get('/api/search?q=%22AND%20OR*').status_code == 200
+
+
+def test_search_api_pagination(client):
+    everything = client.get('/api/search?stream=1').get_json()
+    assert everything['next_cursor'] is None
+    seen = []
+    url = '/api/search?limit=3'
+    while url:
+        page = client.get(url).get_json()
+        assert len(page['results']) <= 3
+        seen.extend(b['id'] for b in page['results'])
+        url = page['next_cursor'] and f"/api/search?limit=3&cursor={page['next_cursor']}"
+    assert seen == [b['id'] for b in everything['results']]
+    assert client.get('/api/search?cursor=not-a-cursor').status_code == 400
+
+
+def test_search_facets_follow_catalog_changes(fresh_client):
+    def facets():
+        return fresh_client.get('/api/search?facets=1&limit=1').get_json()['facets']
+
+    assert facets() == {'department': {'CSE': 8, 'Math': 2}, 'decade': {'2000': 3, '2010': 7},
+                        'available': {'1': 10}}
+    assert 'facets' not in fresh_client.get('/api/search?limit=1').get_json()
+    fresh_client.post('/admin/login', data={'password': 'rahul@123'})
+    fresh_client.post('/admin/add', data={'title': 'Optics', 'year': '1995', 'copies': '1', 'department': 'Physics'})
+    fresh_client.post('/admin/edit/3', data={'title': 'Linear Algebra', 'year': '2016', 'copies': '0', 'department': 'Math'})
+    fresh_client.post('/admin/delete/1')
+    assert facets() == {'department': {'CSE': 7, 'Math': 2, 'Physics': 1}, 'decade': {'1990': 1, '2000': 2, '2010': 7},
+                        'available': {'0': 1, '1': 9}}
+    # borrowing the last copy moves the book to unavailable
+    fresh_client.post('/student/login', data={'email': 'student@example.com', 'password': 'student123'})
+    fresh_client.post('/student/borrow/7')
+    assert facets()['available'] == {'0': 2, '1': 8}
+
+
+def test_search_falls_back_to_close_spellings(fresh_client):
+    def search(q):
+        return fresh_client.get('/api/search', query_string={'q': q}).get_json()
+
+    page = search('tanenbum')
+    assert page['fuzzy'] and [b['title'] for b in page['results']] == ['Computer Networks']
+    page = search('silbershatz operating')
+    assert [b['title'] for b in page['results']] == ['Operating System Concepts']
+    # the closest spelling ranks first; exact matches need no fallback
+    assert search('datbase')['results'][0]['title'] == 'Database System Concepts'
+    assert 'fuzzy' not in search('tanenbaum')
+    assert search('zzzzqq') == {'results': [], 'next_cursor': None}
+    # the vocabulary follows edits to the catalogue
+    fresh_client.post('/admin/login', data={'password': 'rahul@123'})
+    fresh_client.post('/admin/edit/8', data={'title': 'Computer Networks', 'author': 'Kurose, Ross', 'copies': '1'})
+    assert search('tanenbum')['results'] == []
+    assert [b['id'] for b in search('kurosse')['results']] == [8]
 
 
 def test_student_login_and_dashboard_and_borrow(client):
@@ -34,7 +104,7 @@ def test_student_login_and_dashboard_and_borrow(client):
     assert b'Welcome' in resp.data or b'Logged in' in resp.data
 
     # get a book from API
-    js = client.get('/api/search').get_json()
+    js = client.get('/api/search').get_json()['results']
     book_id = js[0]['id']
     title = js[0]['title']
 
@@ -47,4 +117,55 @@ def test_student_login_and_dashboard_and_borrow(client):
 
     # return the borrow entry (find borrow id)
     # simple way: search dashboard page for 'Return' forms and assume one exists
-    assert b'Return' in dash.data
\ No newline at end of file
+    assert b'Return' in dash.data
+
+def test_admin_dashboard_and_export_stream(client):
+    client.post('/admin/login', data={'password': 'rahul@123'})
+    page = client.get('/admin')
+    assert page.status_code == 200
+    assert b'Logged in as admin' in page.data and b'Clean Code' in page.data
+    # the flash was consumed even though the page body was streamed
+    assert b'Logged in as admin' not in client.get('/admin').data
+    export = client.get('/admin/export')
+    lines = export.data.decode().splitlines()
+    assert export.mimetype == 'application/x-ndjson'
+    assert len(lines) == len(client.get('/api/search?stream=1').get_json()['results'])
+
+
+def test_fingerprinted_static_assets(client):
+    page = client.get('/').data.decode()
+    url = re.search(r'src="(/static/js/main\.js\?v=[0-9a-f]+)"', page).group(1)
+    rv = client.get(url)
+    assert rv.status_code == 200
+    assert 'immutable' in rv.headers['Cache-Control']
+
+
+def test_admin_borrows_filters_and_pages(fresh_client, fresh_db, monkeypatch):
+    conn = create_db.connect(fresh_db)
+    day = 86400
+    now = int(time.time())
+    # borrow n was taken n days ago; every third one is still out
+    conn.executemany('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts, returned_at, returned_ts)'
+                     ' VALUES (1, 1, ?, ?, ?, ?)',
+                     [('ts', now - n * day) + (('ts', now - n * day + 7200) if n % 3 else (None, None))
+                      for n in range(1, 31)])
+    conn.close()
+    monkeypatch.setattr(app_module, 'PAGE_SIZE', 4)
+    fresh_client.post('/admin/login', data={'password': 'rahul@123'})
+
+    def borrow_ids(query):
+        page = fresh_client.get('/admin/borrows' + query).data.decode()
+        older = re.search(r'href="([^"]*)">Older', page)
+        return [int(i) for i in re.findall(r'<td>(\d+)</td>', page)], older and older.group(1).replace('&amp;', '&')
+
+    ids, older = borrow_ids('?status=active')
+    assert ids == [3, 6, 9, 12]
+    assert borrow_ids(older[len('/admin/borrows'):])[0] == [15, 18, 21, 24]
+    assert borrow_ids('?status=overdue')[0] == [15, 18, 21, 24]
+    assert borrow_ids('?status=returned&student=student@example.com')[0] == [1, 2, 4, 5]
+    assert borrow_ids('?student=nobody@example.com')[0] == []
+    day_of = time.strftime('%Y-%m-%d', time.gmtime(now - 10 * day))
+    assert borrow_ids(f'?from={day_of}&to={day_of}')[0] == [10]
+    page = fresh_client.get('/admin/borrows?status=returned&limit=1').data.decode()
+    assert '0d 2h</td>' in page
+    assert fresh_client.get('/admin/borrows?from=yesterday').status_code == 400
@@ -0,0 +1,87 @@
+import time
+
+import batch
+import create_db
+import fines
+
+DAY = 86400
+NOW = 1_700_000_000
+CONFIG = dict(fines.env_config(), FINE_PER_DAY=25, FINE_MAX=1000, FINES_CHUNK=2, FINES_PAUSE=0)
+
+
+def add_borrow(conn, borrowed_days_ago, returned_days_ago=None, student_id=1):
+    borrowed = int(NOW - borrowed_days_ago * DAY)
+    returned = int(NOW - returned_days_ago * DAY) if returned_days_ago is not None else None
+    return conn.execute('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts, returned_at, returned_ts)'
+                        ' VALUES (?, 1, ?, ?, ?, ?)',
+                        (student_id, f'ts {borrowed}', borrowed, returned and f'ts {returned}', returned)).lastrowid
+
+
+def fine_rows(conn):
+    return [tuple(r) for r in conn.execute('SELECT borrow_id, returned_ts IS NOT NULL, amount_cents FROM fines ORDER BY borrow_id')]
+
+
+def test_fines_are_assessed_incrementally_in_chunks(fresh_db):
+    conn = create_db.connect(fresh_db)
+    # due 14 days after the borrow (create_db.DEFAULT_LOAN_SECONDS)
+    add_borrow(conn, 30, 20)  # on time
+    late = add_borrow(conn, 30, 13.5)  # 2.5 days late: 3 started days
+    very_late = add_borrow(conn, 200, 10)  # capped
+    out = [add_borrow(conn, days) for days in (20, 16, 15)]
+    not_due = add_borrow(conn, 5)
+
+    # FINES_CHUNK=2: five fines in several transactions
+    assert fines.run(conn, CONFIG, NOW) == {'fines_overdue': 3, 'fines_returned': 2}
+    assert fine_rows(conn) == [(late, 1, 75), (very_late, 1, 1000)] + [(b, 0, None) for b in out]
+    assert conn.execute("SELECT value FROM meta WHERE key = 'fine_version'").fetchone()[0] >= 3
+
+    # the next run only reads what changed since: a late return settles its
+    # fine, and a loan falling due joins the overdue ones
+    assert fines.run(conn, CONFIG, NOW) == {'fines_overdue': 0, 'fines_returned': 0}
+    conn.execute('UPDATE borrows SET returned_ts = ?, returned_at = ? WHERE id = ?', (NOW, 'now', out[0]))
+    later = NOW + 10 * DAY
+    assert fines.run(conn, CONFIG, later) == {'fines_overdue': 1, 'fines_returned': 1}
+    assert dict((r[0], r[1:]) for r in fine_rows(conn))[out[0]] == (1, 150)
+    assert not_due in [r[0] for r in fine_rows(conn)]
+
+
+def test_an_interrupted_run_resumes_from_its_checkpoint(fresh_db):
+    conn = create_db.connect(fresh_db)
+    for days in range(20, 30):
+        add_borrow(conn, days, days - 16)
+    # one committed chunk, then the job stops
+    assert fines.run_chunk(conn, CONFIG, 'fines_returned', NOW, NOW) == (2, False)
+    assert batch.checkpoint(conn, 'fines_returned')[0] == NOW - 12 * DAY
+    assert fines.run(conn, CONFIG, NOW) == {'fines_overdue': 0, 'fines_returned': 8}
+    assert [r[2] for r in fine_rows(conn)] == [50] * 10
+
+
+def test_borrow_pages_show_due_dates_and_fines(fresh_client, fresh_db):
+    conn = create_db.connect(fresh_db)
+    borrow_id = add_borrow(conn, 20)
+    fines.run(conn, CONFIG, NOW)
+    fresh_client.post('/admin/login', data={'password': 'rahul@123'})
+    page = fresh_client.get('/admin/borrows?status=overdue').data.decode()
+    assert f'<td>{borrow_id}</td>' in page and '10.00' in page
+    fresh_client.post('/student/login', data={'email': 'student@example.com', 'password': 'student123'})
+    fresh_client.post('/student/borrow/2')
+    page = fresh_client.get('/student/dashboard').data.decode()
+    assert 'Fine: 10.00 and growing' in page
+    due = conn.execute("SELECT date(due_ts, 'unixepoch') FROM borrows WHERE id = ?", (borrow_id + 1,)).fetchone()[0]
+    assert f'Due: {due}' in page
+
+
+def test_a_late_return_stops_the_shown_fine_before_the_job_settles_it(fresh_client, fresh_db):
+    conn = create_db.connect(fresh_db)
+    now = int(time.time())
+    # due 6 days ago and back 3 days late, after the job found it overdue
+    conn.execute('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts) VALUES (1, 1, ?, ?)',
+                 ('then', now - 20 * DAY))
+    fines.run(conn, CONFIG, now)
+    conn.execute('UPDATE borrows SET returned_at = ?, returned_ts = ? WHERE student_id = 1',
+                 ('back', now - 3 * DAY))
+    fresh_client.post('/admin/login', data={'password': 'rahul@123'})
+    assert '<td>0.75</td>' in fresh_client.get('/admin/borrows?status=returned').data.decode()
+    fresh_client.post('/student/login', data={'email': 'student@example.com', 'password': 'student123'})
+    page = fresh_client.get('/student/dashboard').data.decode()
+    assert 'Fine: 0.75' in page and 'and growing' not in page
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+import app as app_module
+import create_db
+import hashing
+
+FAST = 'pbkdf2:sha256:1000'
+
+
+def slow_job(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def test_pool_hashes_and_refuses_past_its_queue():
+    hasher = hashing.Hasher(FAST, workers=1, queue_size=1, timeout=5, nice=0)
+    try:
+        pwhash = hasher.hash('secret')
+        assert hasher.verify(pwhash, 'secret') and not hasher.verify(pwhash, 'wrong')
+        # one job running and one queued fill every slot
+        busy = [threading.Thread(target=hasher.run, args=(slow_job, 0.5)) for _ in range(2)]
+        for t in busy:
+            t.start()
+        while hasher.slots._value:
+            time.sleep(0.01)
+        with pytest.raises(hashing.HashingBusy):
+            hasher.hash('secret')
+        assert hasher.stats()['refused'] == 1
+        for t in busy:
+            t.join()
+        assert hasher.verify(hasher.hash('again'), 'again')
+    finally:
+        hasher.close()
+
+
+def test_needs_rehash_compares_stored_parameters():
+    hasher = hashing.Hasher('scrypt', workers=0)
+    assert not hasher.needs_rehash(hasher.hash('pw'))
+    assert hasher.needs_rehash(hashing.Hasher(FAST, workers=0).hash('pw'))
+
+
+def test_pool_starts_without_os_nice(monkeypatch):
+    # Windows has no os.nice; the hashing processes must still start
+    monkeypatch.delattr(hashing.os, 'nice')
+    hashing._lower_priority(10)
+    hasher = hashing.Hasher(FAST, workers=1, nice=10)
+    try:
+        assert not hasher.needs_rehash(hasher.hash('pw'))
+    finally:
+        hasher.close()
+
+
+def test_create_app_rebuilds_the_hasher(monkeypatch):
+    monkeypatch.setattr(app_module, 'hasher', app_module.hasher)
+    for key in ('HASH_METHOD', 'HASH_WORKERS'):
+        monkeypatch.setitem(app_module.app.config, key, app_module.app.config[key])
+    app_module.create_app({'HASH_METHOD': FAST, 'HASH_WORKERS': 0})
+    assert (app_module.hasher.method, app_module.hasher.workers) == (FAST, 0)
+    assert app_module.hasher.verify(app_module.hasher.hash('pw'), 'pw')
+
+
+def test_login_rehashes_outdated_hashes(fresh_client, fresh_db, monkeypatch):
+    monkeypatch.setattr(app_module, 'hasher', hashing.Hasher(FAST, workers=0))
+    fresh_client.post('/student/login', data={'email': 'student@example.com', 'password': 'student123'})
+    conn = create_db.connect(fresh_db)
+    stored = conn.execute("SELECT password_hash FROM students WHERE email = 'student@example.com'").fetchone()[0]
+    assert stored.startswith(FAST + '$')
+    fresh_client.get('/student/logout')
+    rv = fresh_client.post('/student/login', data={'email': 'student@example.com', 'password': 'student123'})
+    assert rv.status_code == 302
+
+
+def test_busy_hasher_answers_503(fresh_client, monkeypatch):
+    hasher = hashing.Hasher(FAST, workers=0)
+
+    def refuse(*args):
+        raise hashing.HashingBusy('Too many sign-ins right now, please try again in a moment.')
+    monkeypatch.setattr(hasher, 'run', refuse)
+    monkeypatch.setattr(app_module, 'hasher', hasher)
+    rv = fresh_client.post('/student/login', data={'email': 'student@example.com', 'password': 'student123'})
+    assert rv.status_code == 503 and rv.headers['Retry-After'] == '1'
+    assert b'Too many sign-ins' in rv.data
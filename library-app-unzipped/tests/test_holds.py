@@ -0,0 +1,141 @@
+import json
+import threading
+
+import app as app_module
+import create_db
+import db as db_pool
+import holds
+
+
+def log_in(client, name):
+    client.get('/student/logout')
+    email = f'{name}@example.com'
+    client.post('/student/register', data={'name': name, 'email': email, 'password': 'pw'})
+    client.post('/student/login', data={'email': email, 'password': 'pw'})
+
+
+def copies(db_path, book_id):
+    conn = create_db.connect(db_path)
+    try:
+        return conn.execute('SELECT copies FROM books WHERE id = ?', (book_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def flashed(client):
+    with client.session_transaction() as sess:
+        return [message for _, message in sess.pop('_flashes', [])]
+
+
+def events(client, **headers):
+    # HOLD_EVENTS_TIMEOUT is 0 here, so the stream ends after what is ready now
+    body = client.get('/student/events', headers=headers).data.decode()
+    return [json.loads(line[len('data: '):]) for line in body.splitlines() if line.startswith('data: ')]
+
+
+def test_copies_go_to_holds_in_order(fresh_client, fresh_db, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'HOLD_EVENTS_TIMEOUT', 0)
+    # book 3 has a single copy
+    log_in(fresh_client, 'ann')
+    fresh_client.post('/student/borrow/3')
+    assert copies(fresh_db, 3) == 0
+    fresh_client.post('/student/hold/4')
+    assert flashed(fresh_client)[-1] == 'A copy is available, borrow it instead'
+    log_in(fresh_client, 'bob')
+    fresh_client.post('/student/hold/3')
+    fresh_client.post('/student/hold/3')
+    assert flashed(fresh_client)[-1] == 'You already have a hold on this book'
+    log_in(fresh_client, 'cat')
+    fresh_client.post('/student/hold/3')
+
+    # the returned copy skips the shelf and goes to the first in line
+    log_in(fresh_client, 'ann')
+    fresh_client.post('/student/return/1')
+    assert copies(fresh_db, 3) == 0
+    log_in(fresh_client, 'cat')
+    assert events(fresh_client) == []
+    fresh_client.post('/student/borrow/3')
+    assert flashed(fresh_client)[-1].startswith('Book not available. Place a hold')
+    log_in(fresh_client, 'bob')
+    [ready] = events(fresh_client)
+    assert (ready['book_id'], ready['title']) == (3, 'Linear Algebra and Its Applications')
+    assert b'set aside for you' in fresh_client.get('/student/dashboard').data
+    fresh_client.post('/student/borrow/3')
+    assert b'Borrowed: Linear Algebra' in fresh_client.get('/student/dashboard').data
+
+    # the next return goes to the next in line, and cancelling a ready hold
+    # puts the copy back on the shelf once nobody else is waiting
+    fresh_client.post('/student/return/2')
+    log_in(fresh_client, 'cat')
+    [ready] = events(fresh_client)
+    assert events(fresh_client, **{'Last-Event-ID': str(ready_seq(fresh_db))}) == []
+    fresh_client.post(f"/student/cancel-hold/{ready['hold_id']}")
+    assert copies(fresh_db, 3) == 1
+    fresh_client.post(f"/student/cancel-hold/{ready['hold_id']}")
+    assert flashed(fresh_client)[-1] == 'Hold not found'
+
+
+def ready_seq(db_path):
+    conn = create_db.connect(db_path)
+    try:
+        return conn.execute('SELECT MAX(ready_seq) FROM holds').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_uncollected_copies_expire_to_the_next_hold(fresh_db):
+    conn = db_pool.connect(fresh_db, app_module.app.config)
+    with conn:
+        conn.execute('UPDATE books SET copies = 0 WHERE id = 5')
+        for student_id in (1, 2):
+            holds.place(conn, student_id, 5, 1000)
+        first = holds.pass_on(conn, 5, 1000)
+    assert holds.expire(conn, 1000 + 3600, 7200) == 0
+    with conn:
+        assert holds.expire(conn, 1000 + 7201, 7200) == 1
+    assert [tuple(r) for r in conn.execute('SELECT id, student_id, ready_ts FROM holds')] == [(first + 1, 2, 8201)]
+    with conn:
+        assert holds.expire(conn, 8201 + 7201, 7200) == 1
+    assert conn.execute('SELECT copies FROM books WHERE id = 5').fetchone()[0] == 1
+
+
+def test_notifier_wakes_only_the_students_concerned(fresh_db):
+    notifier = holds.Notifier(lambda: db_pool.get_pool(fresh_db, app_module.app.config, readonly=True), poll=0.01)
+    woken = {student_id: threading.Event() for student_id in (1, 2)}
+    for student_id, event in woken.items():
+        notifier.subscribe(student_id, event.set)
+    conn = db_pool.connect(fresh_db, app_module.app.config)
+    with conn:
+        conn.execute('UPDATE books SET copies = 0 WHERE id = 5')
+        holds.place(conn, 2, 5, 1000)
+        holds.pass_on(conn, 5, 1000)
+    assert woken[2].wait(5)
+    assert not woken[1].is_set()
+    thread = notifier.thread
+    for student_id, event in woken.items():
+        notifier.unsubscribe(student_id, event.set)
+    # the thread stops once nobody listens
+    thread.join(5)
+    assert not thread.is_alive() and notifier.thread is None
+
+
+def test_lapsed_pickup_readies_the_next_hold_without_other_writes(fresh_db, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'HOLD_PICKUP_DAYS', 60 / 86400)
+    conn = db_pool.connect(fresh_db, app_module.app.config)
+    now = app_module.utc_now()[1]
+    with conn:
+        conn.execute('UPDATE books SET copies = 0 WHERE id = 5')
+        for student_id in (1, 2):
+            holds.place(conn, student_id, 5, now - 600)
+        # student 1's copy was set aside two minutes ago and never collected
+        holds.pass_on(conn, 5, now - 120)
+    notifier = holds.Notifier(lambda: app_module.database_pool(readonly=True), poll=0.01,
+                              expire=app_module.expire_lapsed_holds)
+    woken = threading.Event()
+    notifier.subscribe(2, woken.set)
+    try:
+        assert woken.wait(5)
+    finally:
+        notifier.unsubscribe(2, woken.set)
+    assert [tuple(r) for r in conn.execute('SELECT student_id, ready_ts IS NOT NULL FROM holds')] == [(2, 1)]
+    conn.close()
@@ -0,0 +1,54 @@
+import re
+
+from flask import Flask
+
+import app as app_module
+import metrics
+
+
+def sample(text, name, **labels):
+    label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+    match = re.search(rf'^{re.escape(name)}{{{re.escape(label_text)}}} (\S+)$', text, re.M)
+    return float(match.group(1)) if match else None
+
+
+def test_metrics_endpoint_reports_requests_sql_and_templates(fresh_client):
+    def scrape():
+        return fresh_client.get('/metrics').data.decode()
+
+    def delta(name, **labels):
+        return (sample(after, name, **labels) or 0) - (sample(before, name, **labels) or 0)
+
+    before = scrape()
+    # observations are made when the server closes the response, after any streamed body
+    for url in ['/', '/api/search?q=data', '/api/search?q=data&stream=1']:
+        fresh_client.get(url).close()
+    after = scrape()
+    assert delta('library_requests_total', endpoint='api_search', status='200') == 2
+    assert delta('library_request_duration_seconds_count', endpoint='api_search') == 2
+    assert delta('library_request_sql_queries_sum', endpoint='api_search') >= 2
+    assert delta('library_request_sql_seconds_sum', endpoint='api_search') > 0
+    assert delta('library_template_render_seconds_count', template='index.html') == 1
+    assert re.search(r'^library_search_cache_misses 1$', after, re.M)
+
+
+def test_metrics_token_and_disabled_app(fresh_client, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'METRICS_TOKEN', 's3cret')
+    assert fresh_client.get('/metrics').status_code == 401
+    assert fresh_client.get('/metrics', headers={'Authorization': 'Bearer s3cret'}).status_code == 200
+
+    other = Flask(__name__)
+    other.config.update(metrics.env_config(), METRICS_ENABLED=False)
+    metrics.init_app(other, metrics.Metrics())
+    assert not other.before_request_funcs and not other.after_request_funcs
+    with other.test_request_context():
+        conn = object()
+        assert metrics.track(conn) is conn
+
+
+def test_slow_sampled_requests_are_profiled(fresh_client, monkeypatch, tmp_path):
+    monkeypatch.setitem(app_module.app.config, 'PROFILE_SAMPLE_RATE', 1.0)
+    monkeypatch.setitem(app_module.app.config, 'PROFILE_SLOW_MS', 0)
+    monkeypatch.setitem(app_module.app.config, 'PROFILE_DIR', str(tmp_path / 'profiles'))
+    fresh_client.get('/api/search?q=data').close()
+    assert [p.name.endswith('-api_search.prof') for p in (tmp_path / 'profiles').iterdir()] == [True]
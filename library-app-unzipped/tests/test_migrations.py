@@ -0,0 +1,25 @@
+import create_db
+
+
+def test_migrate_is_idempotent(tmp_path):
+    conn = create_db.connect(tmp_path / 'library.db')
+    assert create_db.migrate(conn) == list(range(1, len(create_db.MIGRATIONS) + 1))
+    assert create_db.migrate(conn) == []
+    # the sample data, with its known student password, only comes from --seed
+    assert conn.execute('SELECT COUNT(*) FROM students').fetchone()[0] == 0
+    create_db.seed(conn)
+    assert conn.execute('SELECT COUNT(*) FROM books').fetchone()[0] == len(create_db.sample)
+    assert create_db.schema_version(conn) == len(create_db.MIGRATIONS)
+
+
+def test_active_borrow_counters_check_and_repair(tmp_path):
+    conn = create_db.connect(tmp_path / 'library.db')
+    create_db.migrate(conn)
+    create_db.seed(conn)
+    conn.execute("INSERT INTO borrows (student_id, book_id, borrowed_at) VALUES (1, 1, '2024-01-01T00:00:00')")
+    conn.execute("INSERT INTO borrows (student_id, book_id, borrowed_at, returned_at)"
+                 " VALUES (1, 2, '2024-01-01T00:00:00', '2024-01-02T00:00:00')")
+    assert create_db.check_active_borrows(conn) == [(1, 0, 1)]
+    assert create_db.repair_active_borrows(conn) == 1
+    assert create_db.check_active_borrows(conn) == []
+    assert conn.execute('SELECT active_borrows FROM students WHERE id = 1').fetchone()[0] == 1
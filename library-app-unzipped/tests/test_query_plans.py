@@ -0,0 +1,118 @@
+import re
+import sqlite3
+
+import pytest
+
+import app as app_module
+import ask
+import create_db
+import db as db_pool
+
+# statements that read every row on purpose, in rowid order, where walking the
+# table itself is the cheapest plan there is
+WHOLE_TABLE_READS = {
+    'SELECT id, title, author, year, isbn, copies, department FROM books ORDER BY id',  # /admin/export
+    'SELECT facet, value, books FROM facet_counts WHERE books > 0',  # a few dozen rows
+}
+
+
+@pytest.fixture
+def traced(fresh_db, monkeypatch):
+    """Run the app against a fresh database and record every statement it executes."""
+    statements = []
+
+    def tracing(get_db):
+        def traced_get_db():
+            db = get_db()
+            db.set_trace_callback(statements.append)
+            return db
+        return traced_get_db
+    monkeypatch.setattr(app_module, 'get_db', tracing(app_module.get_db))
+    monkeypatch.setattr(app_module, 'get_read_db', tracing(app_module.get_read_db))
+    # the /api/ask index is built by python ask.py, not by a request
+    conn = db_pool.connect(fresh_db, app_module.app.config, readonly=True)
+    conn.isolation_level = None
+    ask.build(conn, ask.directory(str(fresh_db), app_module.app.config))
+    conn.close()
+
+    app_module.app.config['TESTING'] = True
+    app_module.app.config['WTF_CSRF_ENABLED'] = False
+    with app_module.app.test_client() as client:
+        yield client, statements, fresh_db
+
+
+def exercise(client):
+    for url in ['/api/search', '/api/search?q=database', '/api/search?q=data&dept=CSE',
+                '/api/search?dept=Math', '/api/search?min_year=2009&max_year=2012',
+                '/api/search?available=1', '/api/search?limit=2', '/api/search?facets=1',
+                '/api/search?q=tanenbum&dept=CSE', '/api/search?q=concepts&stream=1']:
+        assert client.get(url).status_code == 200
+    page = client.get('/api/search?limit=2').get_json()
+    client.get('/api/search?limit=2&cursor=' + page['next_cursor'])
+    page = client.get('/api/search?q=data&limit=1').get_json()
+    client.get('/api/search?q=data&limit=1&cursor=' + page['next_cursor'])
+    client.get('/api/ask?q=anything+on+databases+available+after+2009')
+    client.get('/api/availability?ids=1,2,99&isbns=0132350882,nope')
+
+    client.post('/student/register', data={'name': 'Plan', 'email': 'plan@example.com', 'password': 'pw'})
+    client.post('/student/login', data={'email': 'plan@example.com', 'password': 'pw'})
+    client.post('/student/borrow/1')
+    client.get('/student/dashboard')
+    client.post('/api/borrow', json={'ids': [4], 'isbns': ['0073383090', 'nope']})
+    client.post('/student/return/1')
+    # the only copy of book 3 goes to the student waiting for it
+    client.post('/student/borrow/3')
+    client.get('/student/logout')
+    client.post('/student/register', data={'name': 'Queue', 'email': 'queue@example.com', 'password': 'pw'})
+    client.post('/student/login', data={'email': 'queue@example.com', 'password': 'pw'})
+    client.post('/student/hold/3')
+    client.get('/student/logout')
+    client.post('/student/login', data={'email': 'plan@example.com', 'password': 'pw'})
+    client.post('/student/return/2')
+    client.get('/student/logout')
+    client.post('/student/login', data={'email': 'queue@example.com', 'password': 'pw'})
+    client.get('/student/dashboard')
+    client.post('/student/cancel-hold/1')
+    client.get('/student/logout')
+
+    client.post('/admin/login', data={'password': app_module.ADMIN_PASSWORD})
+    client.get('/admin')
+    for query in ['', '?status=active', '?status=overdue', '?status=returned', '?student=1',
+                  '?student=plan@example.com&status=returned', '?from=2024-01-01&to=2024-12-31']:
+        client.get('/admin/borrows' + query)
+    client.get('/admin/export')
+    client.get('/admin/analytics')
+    client.get('/admin/analytics?month=2024-01&months=3&format=json')
+    client.post('/admin/add', data={'title': 'Plan Book', 'copies': '1'})
+    client.get('/admin/edit/2')
+    client.post('/admin/edit/2', data={'title': 'Clean Code', 'copies': '2'})
+    client.post('/admin/delete/11')
+    client.get('/api/ask?q=plan+book+in+CSE')
+
+
+def test_every_query_uses_an_index(traced):
+    client, statements, db_path = traced
+    exercise(client)
+    # FTS5 also traces its own lookups on the 'main'.'books_fts_*' shadow tables
+    queries = {s for s in statements
+               if re.match(r'\s*(SELECT|UPDATE|DELETE)\b', s, re.I) and "'main'." not in s}
+    assert queries
+
+    conn = sqlite3.connect(db_path)
+    full_scans = {}
+    for sql in queries:
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql)]
+        # a SCAN is fine when it walks an index (ordered browse) or the FTS table
+        scans = [d for d in plan if d.startswith('SCAN') and 'USING' not in d and 'VIRTUAL TABLE' not in d]
+        if scans and sql not in WHOLE_TABLE_READS:
+            full_scans[sql] = plan
+    conn.close()
+    assert not full_scans, full_scans
+
+
+def test_active_borrow_counters_stay_consistent(traced):
+    client, statements, db_path = traced
+    exercise(client)
+    conn = create_db.connect(db_path)
+    assert create_db.check_active_borrows(conn) == []
+    assert not any('COUNT(*)' in s for s in statements)
@@ -0,0 +1,105 @@
+import random
+import sqlite3
+from collections import Counter, defaultdict
+
+import numpy as np
+
+import app as app_module
+import create_db
+import recs
+
+CONFIG = dict(recs.env_config(), RECS_TOP_K=4, RECS_WINDOW=3)
+
+
+def add_borrows(conn, rnd, n, students=8, books=12):
+    conn.executemany('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts) VALUES (?, ?, ?, 0)',
+                     [(rnd.randint(1, students), rnd.randint(1, books), 'then') for _ in range(n)])
+    conn.commit()
+
+
+def expected_counts(conn, window):
+    # each student's books in first-borrow order, each paired with the `window` before it
+    books = defaultdict(list)
+    for student_id, book_id in conn.execute('SELECT student_id, book_id FROM borrows ORDER BY id'):
+        if book_id not in books[student_id]:
+            books[student_id].append(book_id)
+    counts = Counter()
+    for seen in books.values():
+        for i, b in enumerate(seen):
+            for a in seen[max(0, i - window):i]:
+                counts[a, b] += 1
+                counts[b, a] += 1
+    return counts
+
+
+def stored_counts(path):
+    build = recs.Build(path, CONFIG)
+    counts = Counter()
+    for name in ('base', 'delta'):
+        indptr, indices, n = build.matrix(name)
+        for row, col, c in zip(recs.csr_rows(indptr, 0, len(indptr) - 1).tolist(),
+                               np.asarray(indices).tolist(), np.asarray(n).tolist()):
+            counts[row, col] += c
+    return counts
+
+
+def test_incremental_runs_match_a_rebuild(fresh_db, tmp_path, monkeypatch):
+    # small passes, so the rebuild and compaction split the rows too
+    monkeypatch.setattr(recs, 'PAIRS_PER_PASS', 7)
+    conn = create_db.connect(fresh_db)
+    path = str(tmp_path / 'recs')
+    rnd = random.Random(3)
+    add_borrows(conn, rnd, 30)
+    assert recs.run(conn, CONFIG, path) == (30, True)
+    reader = recs.Recommendations(path)
+    for n in (0, 1, 9, 14, 40):
+        add_borrows(conn, rnd, n)
+        assert recs.run(conn, CONFIG, path) == (n, False)
+        counts = expected_counts(conn, 3)
+        assert stored_counts(path) == counts
+        reader.refresh()
+        for book_id in range(1, 13):
+            top = sorted(((b, c) for (a, b), c in counts.items() if a == book_id), key=lambda t: (-t[1], t[0]))[:4]
+            assert reader.also_borrowed(book_id, 4) == top
+    generation = reader.generation
+    assert recs.run(conn, CONFIG, path, rebuild=True) == (conn.execute('SELECT MAX(id) FROM borrows').fetchone()[0], True)
+    assert stored_counts(path) == expected_counts(conn, 3)
+    assert reader.refresh() == generation + 1
+    # only the newest build's files are kept
+    assert len(list((tmp_path / 'recs').iterdir())) == 8
+
+
+def test_update_after_many_students_borrowed(fresh_db, tmp_path):
+    conn = create_db.connect(fresh_db)
+    path = str(tmp_path / 'recs')
+    add_borrows(conn, random.Random(5), 30)
+    recs.run(conn, CONFIG, path)
+    # more students than SQLite allows host parameters in one statement
+    conn.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    conn.executemany('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts) VALUES (?, ?, ?, 0)',
+                     [(s, s % 12 + 1, 'then') for s in range(1, 2001)])
+    conn.commit()
+    assert recs.run(conn, CONFIG, path) == (2000, False)
+    assert stored_counts(path) == expected_counts(conn, 3)
+
+
+def test_search_and_dashboard_show_also_borrowed(fresh_client, fresh_db):
+    conn = create_db.connect(fresh_db)
+    # two other students borrowed Computer Networks (8) with Operating System Concepts (6)
+    conn.executemany('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts) VALUES (?, ?, ?, 0)',
+                     [(5, 8, 'then'), (5, 6, 'then'), (6, 6, 'then'), (6, 8, 'then'), (6, 3, 'then')])
+    conn.commit()
+    search = fresh_client.get('/api/search?q=networks')
+    assert search.get_json()['results'][0]['also_borrowed'] == []
+
+    recs.run(conn, app_module.app.config, recs.directory(fresh_db, app_module.app.config))
+    # a new build changes the response, so the old ETag no longer matches
+    again = fresh_client.get('/api/search?q=networks', headers={'If-None-Match': search.headers['ETag']})
+    assert again.status_code == 200
+    assert again.get_json()['results'][0]['also_borrowed'] == [
+        {'id': 6, 'title': 'Operating System Concepts'}, {'id': 3, 'title': 'Linear Algebra and Its Applications'}]
+
+    fresh_client.post('/student/login', data={'email': 'student@example.com', 'password': 'student123'})
+    fresh_client.post('/student/borrow/8')
+    page = fresh_client.get('/student/dashboard').data.decode()
+    assert 'Students who borrowed this also borrowed: Operating System Concepts, Linear Algebra and Its Applications' in page
@@ -0,0 +1,95 @@
+import app as app_module
+import create_db
+import db as db_pool
+import replica
+
+CATALOG = [
+    'SELECT * FROM books ORDER BY id',
+    'SELECT * FROM facet_counts ORDER BY facet, value',
+    'SELECT term, books FROM search_terms WHERE books > 0 ORDER BY term',
+    "SELECT rowid FROM books_fts WHERE books_fts MATCH 'lamport OR kurose OR tanenbaum' ORDER BY rowid",
+    "SELECT value FROM meta WHERE key = 'catalog_version'",
+]
+
+
+def rows(conn, sql):
+    return [tuple(r) for r in conn.execute(sql)]
+
+
+def test_replica_follows_the_primary(tmp_path):
+    conn = create_db.connect(tmp_path / 'primary.db')
+    create_db.copy_template(conn, sample=True)
+    conn.close()
+    primary = db_pool.connect(tmp_path / 'primary.db', app_module.app.config)
+    publisher = replica.Publisher(primary, tmp_path / 'published', snapshot_every=5)
+    publisher.step()
+    follower, lagging = (replica.Follower(db_pool.connect(tmp_path / name, app_module.app.config), tmp_path / 'published')
+                         for name in ('replica.db', 'lagging.db'))
+    follower.step()
+    lagging.step()
+    assert rows(follower.conn, 'SELECT COUNT(*) FROM books') == [(10,)]
+    # nothing but the catalogue leaves the primary
+    assert rows(follower.conn, 'SELECT COUNT(*) FROM students') == [(0,)]
+
+    with primary:
+        primary.execute("INSERT INTO books (title, author, year, isbn, copies, department)"
+                        " VALUES ('Replicated Systems', 'Lamport, Leslie', 1998, 'r-1', 2, 'CSE')")
+        primary.execute('UPDATE books SET copies = 0 WHERE id = 1')
+        primary.execute("UPDATE books SET author = 'Kurose, Ross' WHERE id = 8")
+        primary.execute('DELETE FROM books WHERE id = 2')
+    assert publisher.step() == 4
+    assert follower.step() == 4
+    for sql in CATALOG:
+        assert rows(follower.conn, sql) == rows(primary, sql)
+    assert rows(primary, 'SELECT COUNT(*) FROM catalog_changes') == [(0,)]
+    assert replica.fresh(follower.conn, 5)
+
+    # the fifth change reaches snapshot_every; segments since the previous
+    # snapshot stay, and a replica further behind restores the newest one
+    with primary:
+        primary.execute('UPDATE books SET copies = 1 WHERE id = 1')
+    publisher.step()
+    assert follower.step() == 1
+    with primary:
+        primary.executemany('UPDATE books SET copies = copies + 1 WHERE id = ?', [(i,) for i in range(3, 8)])
+    publisher.step()
+    assert [s['after'] for s in publisher.manifest['segments']] == [5]
+    assert follower.step() == 5 and lagging.step() == 0
+    for sql in CATALOG:
+        assert rows(follower.conn, sql) == rows(lagging.conn, sql) == rows(primary, sql)
+
+
+def test_search_falls_back_when_the_replica_is_missing(fresh_client, tmp_path, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'REPLICA_PATH', str(tmp_path / 'replica.db'))
+    rv = fresh_client.get('/api/search', query_string={'q': 'tanenbaum'})
+    assert [b['title'] for b in rv.get_json()['results']] == ['Computer Networks']
+    # the worker did not create an empty replica in its place
+    assert not (tmp_path / 'replica.db').exists()
+
+
+def test_search_reads_the_replica_while_it_is_fresh(fresh_db, fresh_client, tmp_path, monkeypatch):
+    primary = db_pool.connect(fresh_db, app_module.app.config)
+    publisher = replica.Publisher(primary, tmp_path / 'published')
+    publisher.step()
+    follower = replica.Follower(db_pool.connect(tmp_path / 'replica.db', app_module.app.config), tmp_path / 'published')
+    follower.step()
+    monkeypatch.setitem(app_module.app.config, 'REPLICA_PATH', str(tmp_path / 'replica.db'))
+
+    def titles(q):
+        return [b['title'] for b in fresh_client.get('/api/search', query_string={'q': q}).get_json()['results']]
+
+    # writes go to the primary; searches see them once the replica has
+    fresh_client.post('/admin/login', data={'password': 'rahul@123'})
+    fresh_client.post('/admin/add', data={'title': 'Optics', 'year': '1995', 'copies': '1', 'department': 'Physics'})
+    assert titles('optics') == []
+    assert b'Optics' in fresh_client.get('/admin').data
+    publisher.step()
+    follower.step()
+    assert titles('optics') == ['Optics']
+
+    # a replica further behind than REPLICA_MAX_LAG is passed over
+    fresh_client.post('/admin/add', data={'title': 'Acoustics', 'year': '1995', 'copies': '1', 'department': 'Physics'})
+    assert titles('acoustics') == []
+    monkeypatch.setitem(app_module.app.config, 'REPLICA_MAX_LAG', -1)
+    assert titles('acoustics') == ['Acoustics']
+    assert titles('acoustics&stream=1') == ['Acoustics']
@@ -0,0 +1,129 @@
+"""The analytics rollups (analytics.py) over a large borrow history.
+
+Builds a database with synthetic borrows (default 10,000,000 over three
+years), then:
+
+1. catches up on the whole history, as the first run after the migration
+   does, and reports how long the job's chunks held the write lock;
+2. times the run after that, a day later, with a day's worth of new
+   borrows and returns, which is what a scheduled run sees;
+3. times the /admin/analytics report (12 months, top books) from the
+   rollups, and the same numbers computed from borrows for comparison.
+
+Usage: python tools/bench_analytics.py [borrows] [--chunk N] [--db PATH]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+import analytics  # noqa: E402
+import create_db  # noqa: E402
+import db as db_pool  # noqa: E402
+from synthetic import build_database  # noqa: E402
+
+DAY = 86400
+REPORTS = 200
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def timed_chunks(held):
+    run_chunk = analytics.run_chunk
+
+    def timed(*args):
+        started = time.perf_counter()
+        try:
+            return run_chunk(*args)
+        finally:
+            held.append(time.perf_counter() - started)
+    return timed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('borrows', nargs='?', type=int, default=10000000)
+    parser.add_argument('--students', type=int, default=20000)
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--chunk', type=int, default=None, help='borrows per transaction (default LIB_ANALYTICS_CHUNK)')
+    parser.add_argument('--db', help='reuse a database built by an earlier run instead of a temporary one')
+    args = parser.parse_args()
+    config = dict(db_pool.env_config(), **analytics.env_config())
+    if args.chunk:
+        config['ANALYTICS_CHUNK'] = args.chunk
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'bench.db')
+        if not os.path.exists(path):
+            started = time.perf_counter()
+            build_database(path, books=args.books, students=args.students, borrows=args.borrows)
+            print(f'{args.borrows} borrows (built in {time.perf_counter() - started:.0f}s)')
+        conn = db_pool.connect(path, config)
+        conn.isolation_level = None
+        conn.row_factory = sqlite3.Row
+        create_db.migrate(conn)
+        for table in ('analytics_days', 'analytics_book_months', 'analytics_books'):
+            conn.execute(f'DELETE FROM {table}')
+        conn.execute("DELETE FROM checkpoints WHERE name LIKE 'analytics_%'")
+
+        held = []
+        analytics.run_chunk = timed_chunks(held)
+        started = time.perf_counter()
+        totals = analytics.run(conn, config)
+        elapsed = time.perf_counter() - started
+        print(f"catch-up: {totals['analytics_borrowed']} borrows + {totals['analytics_returned']} returns"
+              f' in {elapsed:.1f}s, {len(held)} chunks of {config["ANALYTICS_CHUNK"]}')
+        print(f'  write lock held per chunk: p50 {statistics.median(held) * 1000:.1f} ms,'
+              f' p99 {percentile(held, 99) * 1000:.1f} ms, max {max(held) * 1000:.1f} ms')
+
+        # a day's traffic: new borrows, and returns of open loans
+        rnd = random.Random(1)
+        now = int(time.time()) + DAY
+        books = conn.execute('SELECT MAX(id) FROM books').fetchone()[0]
+        conn.execute('BEGIN')
+        conn.executemany('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts) VALUES (?, ?, ?, ?)',
+                         [(rnd.randint(1, args.students), rnd.randint(1, books), 'now', now - rnd.randint(120, DAY))
+                          for _ in range(10000)])
+        conn.execute('UPDATE borrows SET returned_ts = ?, returned_at = ? WHERE id IN'
+                     ' (SELECT id FROM borrows WHERE returned_ts IS NULL LIMIT 10000)', (now - 3600, 'now'))
+        conn.execute('COMMIT')
+        held.clear()
+        started = time.perf_counter()
+        totals = analytics.run(conn, config, now)
+        print(f"next day: {totals['analytics_borrowed']} borrows + {totals['analytics_returned']} returns"
+              f' in {(time.perf_counter() - started) * 1000:.0f} ms ({len(held)} chunks)')
+
+        month = analytics.month_of(now)
+        times = []
+        for _ in range(REPORTS):
+            started = time.perf_counter()
+            analytics.report(conn, month, 12)
+            times.append(time.perf_counter() - started)
+        print(f'report from the rollups, 12 months: p50 {statistics.median(times) * 1000:.2f} ms,'
+              f' p95 {percentile(times, 95) * 1000:.2f} ms')
+
+        started = time.perf_counter()
+        since = int(time.mktime(time.strptime(analytics.months_back(month, 11) + '-01', '%Y-%m-%d')))
+        conn.execute('''
+            SELECT strftime('%Y-%m', br.returned_ts, 'unixepoch'), b.department, COUNT(*), AVG(br.returned_ts - br.borrowed_ts)
+            FROM borrows br LEFT JOIN books b ON b.id = br.book_id WHERE br.returned_ts >= ? GROUP BY 1, 2
+        ''', (since,)).fetchall()
+        conn.execute('SELECT book_id, COUNT(*) FROM borrows GROUP BY book_id ORDER BY 2 DESC LIMIT 10').fetchall()
+        print(f'the same from borrows: {time.perf_counter() - started:.1f}s')
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
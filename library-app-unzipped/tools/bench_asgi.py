@@ -0,0 +1,176 @@
+"""Many concurrent searches: sync gunicorn against uvicorn serving asgi.py.
+
+Builds a synthetic catalogue, starts each server with the same number of
+worker processes, and keeps N connections busy issuing /api/search requests
+for a fixed time, for each N in --concurrency. Queries mix cheap filters and
+full-text searches on common words, which rank every match and are the slow
+ones. Reports requests per second, latency percentiles, the median of the
+cheap filter searches alone (whether they wait behind the slow ones) and
+failed requests (refused, reset or slower than --timeout).
+
+    python tools/bench_asgi.py --books 200000 --workers 2 --concurrency 10,100,1000
+
+The client is a small asyncio HTTP/1.1 loop in this process, so on a small
+machine it takes CPU from both servers alike. Gunicorn's sync workers close
+the connection after every response, and the client reconnects when told to.
+"""
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / 'tools'))
+
+from bench_routes import free_port, start_gunicorn  # noqa: E402
+from synthetic import DEPARTMENTS, WORDS, build_database  # noqa: E402
+
+
+def start_uvicorn(db_path, workers, env):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', '--workers', str(workers), '--host', '127.0.0.1', '--port', str(port),
+         '--log-level', 'warning', '--no-access-log', '--backlog', '4096', 'asgi:app'],
+        cwd=ROOT, env=dict(os.environ, LIB_DB_PATH=db_path, **env))
+    base = f'http://127.0.0.1:{port}'
+    for _ in range(200):
+        if proc.poll() is not None:
+            raise RuntimeError('uvicorn exited during startup')
+        try:
+            urllib.request.urlopen(base + '/api/search', timeout=1).read()
+            return proc, base
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError('uvicorn did not start')
+
+
+def search_urls(rnd, n):
+    urls = []
+    for _ in range(n):
+        kind = rnd.random()
+        if kind < 0.4:
+            urls.append(('text', f'/api/search?q={rnd.choice(WORDS)}'))
+        elif kind < 0.7:
+            urls.append(('text', f'/api/search?q={rnd.choice(WORDS)}+{rnd.choice(WORDS)}&available=1'))
+        else:
+            urls.append(('filter', f'/api/search?dept={rnd.choice(DEPARTMENTS)}&limit=20'))
+    return urls
+
+
+class Connection:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def get(self, path):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(f'GET {path} HTTP/1.1\r\nHost: {self.host}\r\n\r\n'.encode())
+        status = int((await self.reader.readline()).split()[1])
+        length, close = 0, False
+        while True:
+            line = (await self.reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            name = name.lower()
+            if name == 'content-length':
+                length = int(value)
+            elif name == 'connection' and value.strip().lower() == 'close':
+                close = True
+        await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def load(base, concurrency, seconds, timeout, urls):
+    host, port = base.rsplit('//', 1)[1].split(':')
+    latencies, failures = {'text': [], 'filter': []}, 0
+    deadline = time.monotonic() + seconds
+
+    async def user(i):
+        nonlocal failures
+        conn = Connection(host, int(port))
+        n = i
+        while time.monotonic() < deadline:
+            kind, path = urls[n % len(urls)]
+            n += concurrency
+            start = time.perf_counter()
+            try:
+                status = await asyncio.wait_for(conn.get(path), timeout)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError, IndexError):
+                failures += 1
+                conn.close()
+                await asyncio.sleep(0.05)
+                continue
+            if status != 200:
+                failures += 1
+                continue
+            latencies[kind].append(time.perf_counter() - start)
+        conn.close()
+
+    started = time.monotonic()
+    await asyncio.gather(*(user(i) for i in range(concurrency)))
+    return latencies, failures, time.monotonic() - started
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=200000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--concurrency', default='10,100,1000')
+    parser.add_argument('--seconds', type=float, default=15)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--servers', default='gunicorn,uvicorn')
+    parser.add_argument('--db', help='reuse a database built by an earlier run instead of a temporary one')
+    args = parser.parse_args()
+    levels = [int(c) for c in args.concurrency.split(',')]
+    urls = search_urls(random.Random(0), 5000)
+    starters = {'gunicorn': start_gunicorn, 'uvicorn': start_uvicorn}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db or os.path.join(tmp, 'bench.db')
+        if not os.path.exists(db_path):
+            started = time.perf_counter()
+            build_database(db_path, books=args.books, students=100, borrows=1000)
+            print(f'{args.books} books (built in {time.perf_counter() - started:.0f}s)')
+        print(f"{'server':<9} {'open':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+              f" {'filter p50':>10} {'failed':>7}")
+        for name in args.servers.split(','):
+            # the cache would turn the repeated URLs into lookups; measure the queries
+            proc, base = starters[name](db_path, args.workers, {'LIB_SEARCH_CACHE_SIZE': '0'})
+            try:
+                for concurrency in levels:
+                    by_kind, failures, elapsed = asyncio.run(
+                        load(base, concurrency, args.seconds, args.timeout, urls))
+                    latencies = by_kind['text'] + by_kind['filter']
+                    print(f'{name:<9} {concurrency:>5} {len(latencies) / elapsed:>8.1f}'
+                          f' {percentile(latencies, 50) * 1000:>8.1f} {percentile(latencies, 95) * 1000:>8.1f}'
+                          f' {percentile(latencies, 99) * 1000:>8.1f} {percentile(by_kind["filter"], 50) * 1000:>10.1f}'
+                          f' {failures:>7}')
+            finally:
+                proc.terminate()
+                proc.wait()
+
+
+if __name__ == '__main__':
+    main()
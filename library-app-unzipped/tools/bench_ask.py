@@ -0,0 +1,97 @@
+"""The /api/ask assistant (ask.py) on a large catalogue.
+
+Builds a synthetic catalogue (default 500,000 books), then times:
+
+1. building the index, with the build's peak memory and size on disk;
+2. the first question a new worker answers, which maps the index;
+3. questions drawn from the catalogue's title words, with and without
+   filters, as p50/p95 per question;
+4. the same questions with ASK_MAX_CHANGES books changed since the build,
+   which are scored from their rows on every question.
+
+Usage: python tools/bench_ask.py [books] [--questions N] [--db PATH]
+"""
+import argparse
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+import ask  # noqa: E402
+import db as db_pool  # noqa: E402
+from synthetic import WORDS, build_database  # noqa: E402
+
+TEMPLATES = ('{0}', '{0} {1}', 'do you have anything on {0} that is available?',
+             'books on {0} {1} after 2010', '{0} in CSE before 2000')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def timed(assistant, conn, questions):
+    times = []
+    for q in questions:
+        started = time.perf_counter()
+        assistant.ask(conn, q, 5)
+        times.append((time.perf_counter() - started) * 1000)
+    return f'p50 {statistics.median(times):.2f} ms, p95 {percentile(times, 95):.2f} ms'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('books', nargs='?', type=int, default=500000)
+    parser.add_argument('--questions', type=int, default=500)
+    parser.add_argument('--db', help='reuse a database built by an earlier run instead of a temporary one')
+    args = parser.parse_args()
+    config = dict(db_pool.env_config(), **ask.env_config())
+    rnd = random.Random(1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'bench.db')
+        if not os.path.exists(path):
+            started = time.perf_counter()
+            build_database(path, books=args.books, students=10, borrows=10)
+            print(f'{args.books} books (built in {time.perf_counter() - started:.0f}s)')
+        out = os.path.join(tmp, 'ask')
+        conn = db_pool.connect(path, config)
+        conn.isolation_level = None
+
+        started = time.perf_counter()
+        ask.build(conn, out)
+        elapsed = time.perf_counter() - started
+        m = ask.read_manifest(out)
+        size = sum(os.path.getsize(os.path.join(out, f)) for f in os.listdir(out))
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"index build: {elapsed:.1f}s for {m['books']:,} books, {m['terms']:,} terms,"
+              f' {size / 2 ** 20:.0f} MiB on disk, peak RSS {peak:.0f} MiB')
+
+        questions = [rnd.choice(TEMPLATES).format(rnd.choice(WORDS), rnd.choice(WORDS))
+                     for _ in range(args.questions)]
+        assistant = ask.Assistant(out, config)
+        started = time.perf_counter()
+        assistant.ask(conn, questions[0], 5)
+        print(f'first question of a new worker: {(time.perf_counter() - started) * 1000:.1f} ms')
+        print(f'questions: {timed(assistant, conn, questions)}')
+
+        books = conn.execute('SELECT MAX(id) FROM books').fetchone()[0]
+        conn.execute('BEGIN')
+        conn.executemany('UPDATE books SET year = year + 1 WHERE id = ?',
+                         [(i,) for i in rnd.sample(range(1, books + 1), config['ASK_MAX_CHANGES'])])
+        conn.execute('COMMIT')
+        assistant.ask(conn, questions[0], 5)
+        print(f"questions with {config['ASK_MAX_CHANGES']} changed books: {timed(assistant, conn, questions)}")
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
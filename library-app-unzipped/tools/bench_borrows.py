@@ -0,0 +1,79 @@
+"""Latency of /admin/borrows pages over a large borrow history.
+
+Builds a database with synthetic students, books and borrows (default
+5,000,000 borrows), then times each filter through the Flask test client,
+including paging a few cursors deep.
+
+Usage: python tools/bench_borrows.py [borrows] [--students N] [--books N]
+"""
+import argparse
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+import app as app_module  # noqa: E402
+from synthetic import build_database  # noqa: E402
+
+URLS = [
+    '/admin/borrows',
+    '/admin/borrows?status=active',
+    '/admin/borrows?status=overdue',
+    '/admin/borrows?status=returned',
+    '/admin/borrows?student=4242',
+    '/admin/borrows?student=student77@example.com&status=returned',
+    '/admin/borrows?from=2025-01-01&to=2025-01-31',
+    '/admin/borrows?status=active&from=2024-06-01&to=2024-12-31',
+]
+REPEAT = 20
+PAGES = 5
+
+
+def timed_get(client, url):
+    start = time.perf_counter()
+    rv = client.get(url)
+    elapsed = (time.perf_counter() - start) * 1000
+    assert rv.status_code == 200, (url, rv.status_code)
+    return elapsed, rv
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('borrows', nargs='?', type=int, default=5000000)
+    parser.add_argument('--students', type=int, default=20000)
+    parser.add_argument('--books', type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        started = time.perf_counter()
+        build_database(path, books=args.books, students=args.students, borrows=args.borrows)
+        print(f'{args.borrows} borrows, {args.students} students, {args.books} books '
+              f'(built in {time.perf_counter() - started:.0f}s)')
+        app = app_module.create_app({'DB_PATH': path, 'TESTING': True})
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['is_admin'] = True
+            print(f"{'url':<62} {'p50 ms':>7} {'max ms':>7} {'page ' + str(PAGES) + ' ms':>9}")
+            for url in URLS:
+                times = [timed_get(client, url)[0] for _ in range(REPEAT)]
+                # follow "Older" links to time a page a few cursors deep
+                next_url, deep = url, 0.0
+                for _ in range(PAGES):
+                    deep, rv = timed_get(client, next_url)
+                    match = re.search(rb'href="([^"]*cursor=[^"]*)">Older', rv.data)
+                    if not match:
+                        break
+                    next_url = match.group(1).decode().replace('&amp;', '&')
+                print(f'{url:<62} {statistics.median(times):>7.1f} {max(times):>7.1f} {deep:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Concurrent load test for the connection settings.
+
+Runs the same read-heavy mix (searches plus borrows) from several processes,
+once with the old per-request connection in rollback-journal mode and once with
+the pooled WAL configuration, and prints latency percentiles for both.
+
+Usage: python tools/bench_db.py [--procs 4] [--requests 500] [--books 20000]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+import app as app_module  # noqa: E402
+import create_db  # noqa: E402
+from synthetic import book_rows  # noqa: E402
+
+CONFIGS = {
+    'per-request connection, rollback journal': {
+        'DB_POOL_SIZE': 0, 'DB_JOURNAL_MODE': 'DELETE', 'DB_SYNCHRONOUS': 'FULL',
+        'DB_MMAP_SIZE': 0, 'DB_CACHE_SIZE': -2000,
+    },
+    'pooled, WAL + tuned pragmas': {},
+}
+SEARCHES = ['/api/search?q=algorithms', '/api/search?dept=CSE', '/api/search?available=1',
+            '/api/search?q=tanenbaum&min_year=2000', '/api/search']
+
+
+def build(path, books, students):
+    conn = create_db.connect(path)
+    create_db.migrate(conn)
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO books (title,author,year,isbn,copies,department) VALUES (?,?,?,?,?,?)',
+                     ((t, a, y, i, 10 ** 6, d) for t, a, y, i, c, d in book_rows(books)))
+    conn.executemany('INSERT INTO students (name, email, password_hash) VALUES (?,?,?)',
+                     ((f'load{i}', f'load{i}@example.com', 'x') for i in range(students)))
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def worker(db_path, config, first_student, requests, start, results):
+    app_module.create_app(dict(config, DB_PATH=db_path, TESTING=True, WTF_CSRF_ENABLED=False))
+    reads, writes = [], []
+    start.wait()
+    with app_module.app.test_client() as client:
+        for i in range(requests):
+            began = time.perf_counter()
+            if i % 5 == 4:
+                with client.session_transaction() as sess:
+                    sess.clear()
+                    sess['student_id'] = first_student + i // 5
+                client.post(f'/student/borrow/{1 + i % 50}')
+                writes.append(time.perf_counter() - began)
+            else:
+                client.get(SEARCHES[i % len(SEARCHES)])
+                reads.append(time.perf_counter() - began)
+    results.put((reads, writes))
+
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] * 1000
+
+
+def run(name, config, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        build(path, args.books, args.procs * args.requests)
+        if config.get('DB_JOURNAL_MODE') == 'DELETE':
+            create_db.connect(path).execute('PRAGMA journal_mode = DELETE')
+        ctx = multiprocessing.get_context('fork')
+        start, results = ctx.Event(), ctx.Queue()
+        procs = [ctx.Process(target=worker, args=(path, config, 2 + n * args.requests, args.requests, start, results))
+                 for n in range(args.procs)]
+        for p in procs:
+            p.start()
+        began = time.perf_counter()
+        start.set()
+        reads, writes = [], []
+        for _ in procs:
+            r, w = results.get()
+            reads += r
+            writes += w
+        elapsed = time.perf_counter() - began
+        for p in procs:
+            p.join()
+    total = len(reads) + len(writes)
+    print(f'{name}: {total / elapsed:.0f} req/s')
+    for label, values in (('search', reads), ('borrow', writes)):
+        print(f'  {label:<7} p50 {pct(values, 50):7.2f} ms   p95 {pct(values, 95):7.2f} ms   p99 {pct(values, 99):7.2f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--procs', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=500, help='requests per process')
+    parser.add_argument('--books', type=int, default=20000)
+    args = parser.parse_args()
+    for name, config in CONFIGS.items():
+        run(name, config, args)
+
+
+if __name__ == '__main__':
+    main()
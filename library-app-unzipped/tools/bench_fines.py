@@ -0,0 +1,140 @@
+"""The fines batch job (fines.py) over a large borrow history.
+
+Builds a database with synthetic borrows (default 10,000,000, about half of
+them returned late), then:
+
+1. catches up on the whole history, as the first run after the migration
+   does, while a second connection keeps doing borrow-sized write
+   transactions, and reports how long the job's chunks held the write lock
+   and how long the writer waited for it;
+2. times the run after that: a day later, with a day's worth of new late
+   returns and newly overdue loans, which is what a scheduled run sees;
+3. times one full-table recount of the same fines for comparison, which is
+   what a job without checkpoints would pay on every run.
+
+Usage: python tools/bench_fines.py [borrows] [--chunk N] [--db PATH]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+import db as db_pool  # noqa: E402
+import fines  # noqa: E402
+from synthetic import build_database  # noqa: E402
+
+DAY = 86400
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else 0.0
+
+
+def writer(path, config, stop, waits):
+    # one borrow and one return per transaction, like the borrow/return routes
+    conn = db_pool.connect(path, config)
+    conn.isolation_level = None
+    rnd = random.Random(1)
+    last = conn.execute('SELECT MAX(id) FROM borrows').fetchone()[0]
+    while not stop.is_set():
+        now = int(time.time())
+        started = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        waits.append(time.perf_counter() - started)
+        conn.execute('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts, due_ts) VALUES (?, ?, ?, ?, ?)',
+                     (rnd.randint(1, 1000), rnd.randint(1, 1000), 'now', now, now + 14 * DAY))
+        conn.execute('UPDATE borrows SET returned_ts = ?, returned_at = ? WHERE id = ? AND returned_ts IS NULL',
+                     (now, 'now', rnd.randint(1, last)))
+        conn.execute('COMMIT')
+        time.sleep(0.005)
+    conn.close()
+
+
+def timed_chunks(held):
+    run_chunk = fines.run_chunk
+
+    def timed(*args):
+        started = time.perf_counter()
+        try:
+            return run_chunk(*args)
+        finally:
+            held.append(time.perf_counter() - started)
+    return timed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('borrows', nargs='?', type=int, default=10000000)
+    parser.add_argument('--students', type=int, default=20000)
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--chunk', type=int, default=None, help='borrows per transaction (default LIB_FINES_CHUNK)')
+    parser.add_argument('--db', help='reuse a database built by an earlier run instead of a temporary one')
+    args = parser.parse_args()
+    config = dict(db_pool.env_config(), **fines.env_config())
+    if args.chunk:
+        config['FINES_CHUNK'] = args.chunk
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'bench.db')
+        if not os.path.exists(path):
+            started = time.perf_counter()
+            build_database(path, books=args.books, students=args.students, borrows=args.borrows)
+            print(f'{args.borrows} borrows (built in {time.perf_counter() - started:.0f}s)')
+        conn = db_pool.connect(path, config)
+        conn.isolation_level = None
+        conn.execute('DELETE FROM fines')
+        conn.execute("DELETE FROM checkpoints WHERE name LIKE 'fines_%'")
+
+        held, waits = [], []
+        fines.run_chunk = timed_chunks(held)
+        stop = threading.Event()
+        thread = threading.Thread(target=writer, args=(path, config, stop, waits))
+        thread.start()
+        started = time.perf_counter()
+        try:
+            totals = fines.run(conn, config)
+        finally:
+            stop.set()
+            thread.join()
+        elapsed = time.perf_counter() - started
+        written = sum(totals.values())
+        print(f"catch-up: {totals['fines_overdue']} overdue + {totals['fines_returned']} late returns"
+              f' in {elapsed:.1f}s ({written / elapsed:,.0f} fines/s), {len(held)} chunks of {config["FINES_CHUNK"]}')
+        print(f'  write lock held per chunk: p50 {statistics.median(held) * 1000:.1f} ms,'
+              f' p99 {percentile(held, 99) * 1000:.1f} ms, max {max(held) * 1000:.1f} ms')
+        print(f'  concurrent writer, {len(waits)} transactions: lock wait p50 {statistics.median(waits) * 1000:.2f} ms,'
+              f' p99 {percentile(waits, 99) * 1000:.1f} ms, max {max(waits) * 1000:.1f} ms')
+
+        # a day's traffic: new late returns among the open loans, and the loans falling due
+        now = int(time.time()) + DAY
+        rows = conn.execute('SELECT id FROM borrows WHERE returned_ts IS NULL AND due_ts < ? LIMIT 2000',
+                            (now - DAY,)).fetchall()
+        conn.executemany('UPDATE borrows SET returned_ts = ?, returned_at = ? WHERE id = ?',
+                         [(now - 3600, 'now', r[0]) for r in rows])
+        held.clear()
+        started = time.perf_counter()
+        totals = fines.run(conn, config, now)
+        print(f"next day: {totals['fines_overdue']} newly overdue + {totals['fines_returned']} late returns"
+              f' in {(time.perf_counter() - started) * 1000:.0f} ms ({len(held)} chunks)')
+
+        started = time.perf_counter()
+        count, amount = conn.execute(f'''
+            SELECT COUNT(*), SUM({fines.amount_sql(config, 'due_ts', 'COALESCE(returned_ts, ?)')}) FROM borrows
+            WHERE returned_ts > due_ts OR (returned_ts IS NULL AND due_ts < ?)
+        ''', (now, now)).fetchone()
+        print(f'full recount of {count} fines ({amount / 100:,.2f} total): {time.perf_counter() - started:.1f}s per run')
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
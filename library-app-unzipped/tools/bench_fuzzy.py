@@ -0,0 +1,110 @@
+"""Latency of typo-tolerant searches on a large catalogue.
+
+Builds a synthetic catalogue (default 500,000 books, with authors drawn from
+50,000 made-up surnames so the vocabulary is realistically large), then
+times /api/search through the Flask test client, with the result cache off,
+for misspelt author names and title words: one edit (deletion, substitution
+or transposition) away from a word in the catalogue, alone and with a word
+from one of the author's titles. Exact searches on rare
+words are timed alongside for comparison.
+
+Also reports how often the misspelt word's intended spelling was among the
+words the results were matched on. Exits with status 1 when the p95 of a
+misspelt search is above --budget-ms (default 10).
+
+Usage: python tools/bench_fuzzy.py [books] [--surnames N] [--queries N]
+"""
+import argparse
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+import app as app_module  # noqa: E402
+import cache  # noqa: E402
+from synthetic import WORDS, build_database, made_up_surnames  # noqa: E402
+
+
+def misspell(word, rnd):
+    i = rnd.randrange(1, len(word) - 1)
+    edit = rnd.choice(('delete', 'substitute', 'transpose'))
+    if edit == 'delete':
+        return word[:i] + word[i + 1:]
+    if edit == 'substitute':
+        return word[:i] + rnd.choice('aeiourstnl'.replace(word[i], '')) + word[i + 1:]
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:] if word[i] != word[i + 1] else word[:i] + word[i + 2:]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('books', nargs='?', type=int, default=500000)
+    parser.add_argument('--surnames', type=int, default=50000)
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--budget-ms', type=float, default=10.0)
+    parser.add_argument('--db', help='reuse a database built by an earlier run instead of a temporary one')
+    args = parser.parse_args()
+    rnd = random.Random(1)
+    surnames = [s.lower() for s in made_up_surnames(args.surnames)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'bench.db')
+        if not os.path.exists(path):
+            started = time.perf_counter()
+            build_database(path, books=args.books, students=10, borrows=10, surnames=args.surnames)
+            print(f'{args.books} books, {args.surnames} extra surnames (built in {time.perf_counter() - started:.0f}s)')
+        app_module.create_app({'DB_PATH': path})
+        app_module.search_cache = cache.SearchCache(cache.MemoryBackend(maxsize=0))
+        db = app_module.db_pool.connect(path, app_module.app.config, readonly=True)
+        terms = db.execute('SELECT COUNT(*) FROM search_terms WHERE books > 0').fetchone()[0]
+        print(f'{terms} distinct words in titles and authors')
+
+        author_typos = [(w, misspell(w, rnd)) for w in rnd.sample(surnames, args.queries)]
+        # a word from one of the author's titles, as someone half remembering a book would type
+        title_of = {w: db.execute('SELECT title FROM books_fts WHERE books_fts MATCH ? LIMIT 1',
+                                  (f'author:"{w}"',)).fetchone() for w, _ in author_typos}
+        db.close()
+        title_typos = [(w, misspell(w, rnd)) for w in (rnd.choice([w for w in WORDS if len(w) > 4])
+                                                       for _ in range(args.queries))]
+        cases = {
+            'exact author': [(w, w) for w, _ in author_typos],
+            'misspelt author': author_typos,
+            'misspelt title word': title_typos,
+            'misspelt author + word': [(w, f'{t} {rnd.choice(title_of[w][0].split())}')
+                                       for w, t in author_typos if title_of[w]],
+        }
+        failed = False
+        with app_module.app.test_client() as client:
+            client.get('/api/search?q=warmup')
+            print(f"{'query':<24} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'max ms':>7} {'found':>6}")
+            for name, queries in cases.items():
+                times, found = [], 0
+                for intended, q in queries:
+                    start = time.perf_counter()
+                    page = client.get('/api/search', query_string={'q': q}).get_json()
+                    times.append((time.perf_counter() - start) * 1000)
+                    words = {w for b in page['results'] for w in re.findall(r'\w+', f"{b['title']} {b['author']}".lower())}
+                    found += intended in words
+                p95 = percentile(times, 95)
+                print(f'{name:<24} {statistics.median(times):>7.2f} {p95:>7.2f} {percentile(times, 99):>7.2f}'
+                      f' {max(times):>7.2f} {found / len(queries):>6.0%}')
+                failed |= name.startswith('misspelt') and p95 > args.budget_ms
+        if failed:
+            print(f'p95 of a misspelt search is above {args.budget_ms} ms')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
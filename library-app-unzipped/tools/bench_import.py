@@ -0,0 +1,75 @@
+"""Throughput and peak memory of the bulk import.
+
+Writes a synthetic CSV (default 1,000,000 rows), imports it into an empty
+database, then imports it again so every row takes the ISBN upsert path.
+
+Usage: python tools/bench_import.py [rows] [--format csv|jsonl] [--batch-size N]
+"""
+import argparse
+import csv
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+import catalog_io  # noqa: E402
+import create_db  # noqa: E402
+from synthetic import book_rows  # noqa: E402
+
+
+def write_file(path, rows, fmt):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(catalog_io.BOOK_FIELDS)
+            writer.writerows(book_rows(rows))
+        else:
+            for row in book_rows(rows):
+                f.write(json.dumps(dict(zip(catalog_io.BOOK_FIELDS, row))) + '\n')
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('rows', nargs='?', type=int, default=1000000)
+    parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    parser.add_argument('--batch-size', type=int, default=catalog_io.BATCH_SIZE)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data = os.path.join(tmp, f'books.{args.format}')
+        write_file(data, args.rows, args.format)
+        conn = create_db.connect(os.path.join(tmp, 'bench.db'))
+        create_db.migrate(conn)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        print(f'{args.rows} rows, {os.path.getsize(data) / 2 ** 20:.0f} MiB {args.format}, '
+              f'batch size {args.batch_size}; RSS before import {peak_rss_mb():.0f} MiB')
+        for label in ('insert', 'upsert'):
+            with open(data, newline='', encoding='utf-8') as f:
+                started = time.perf_counter()
+                report = catalog_io.import_books(conn, catalog_io.read_records(f, args.format), args.batch_size)
+                elapsed = time.perf_counter() - started
+            print(f'  {label}: {report.summary()} in {elapsed:.1f}s '
+                  f'({report.rows / elapsed:,.0f} rows/s), peak RSS {peak_rss_mb():.0f} MiB')
+        started = time.perf_counter()
+        size = sum(len(chunk) for chunk in catalog_io.export_books(conn, args.format))
+        elapsed = time.perf_counter() - started
+        print(f'  export: {size / 2 ** 20:.0f} MiB in {elapsed:.1f}s ({args.rows / elapsed:,.0f} rows/s), '
+              f'peak RSS {peak_rss_mb():.0f} MiB')
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
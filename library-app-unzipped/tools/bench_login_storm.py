@@ -0,0 +1,153 @@
+"""Search latency while a login storm is hashing passwords.
+
+Runs the app under gunicorn with threaded workers, as the Procfile and
+Dockerfile do, first with hashing inline on the request threads
+(LIB_HASH_WORKERS=0) and then with the hashing pool, and for each measures
+/api/search latency alone and during a storm of logins.
+
+Usage: python tools/bench_login_storm.py [--seconds N] [--storm-threads N] [--threads N]
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+SEARCHES = ['/api/search?q=data', '/api/search?q=operating+systems', '/api/search?dept=CSE',
+            '/api/search?q=compil&available=1']
+STUDENTS = 200
+
+
+def make_app(db_path):
+    # gunicorn's entry point; the load generator posts logins without fetching a form first
+    import app as app_module
+    return app_module.create_app({'DB_PATH': db_path, 'WTF_CSRF_ENABLED': False})
+
+
+def build(db_path):
+    import create_db
+    from werkzeug.security import generate_password_hash
+    from synthetic import book_rows
+    conn = create_db.connect(db_path)
+    create_db.migrate(conn)
+    pwhash = generate_password_hash('storm-password', os.environ.get('LIB_HASH_METHOD', 'scrypt:32768:8:1'))
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO books (title,author,year,isbn,copies,department) VALUES (?,?,?,?,?,?)',
+                     book_rows(20000))
+    conn.executemany('INSERT INTO students (name, email, password_hash) VALUES (?,?,?)',
+                     ((f'Storm {i}', f'storm{i}@example.com', pwhash) for i in range(STUDENTS)))
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def storm(base, stop, counts):
+    opener = urllib.request.build_opener(NoRedirect)
+    i = 0
+    while not stop.is_set():
+        data = urllib.parse.urlencode({'email': f'storm{i % STUDENTS}@example.com',
+                                       'password': 'storm-password'}).encode()
+        i += 1
+        try:
+            opener.open(base + '/student/login', data, timeout=30).read()
+            status = 200
+        except urllib.error.HTTPError as e:
+            status = e.code
+            # close it before waiting: gunicorn holds its loop until the client closes
+            e.read()
+            e.close()
+            # a refused login waits as long as the server asks before trying again
+            if status == 503:
+                time.sleep(float(e.headers.get('Retry-After', 1)))
+        counts[status] = counts.get(status, 0) + 1
+
+
+def probe(base, seconds):
+    latencies = []
+    deadline = time.monotonic() + seconds
+    i = 0
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        urllib.request.urlopen(base + SEARCHES[i % len(SEARCHES)], timeout=60).read()
+        latencies.append((time.perf_counter() - start) * 1000)
+        i += 1
+    return latencies
+
+
+def percentile(values, p):
+    return statistics.quantiles(values, n=100)[p - 1] if len(values) > 1 else values[0]
+
+
+def run(db_path, label, env, seconds, storm_threads, threads):
+    port = free_port()
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--worker-class', 'gthread', '--threads', str(threads),
+                             '--bind', f'127.0.0.1:{port}', '--pythonpath', f'{ROOT},{ROOT / "tools"}',
+                             f'bench_login_storm:make_app({db_path!r})'],
+                            cwd=ROOT, env=dict(os.environ, **env), stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(base + '/api/search', timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        for phase in ('idle', 'storm'):
+            stop, counts = threading.Event(), {}
+            threads = [threading.Thread(target=storm, args=(base, stop, counts))
+                       for _ in range(storm_threads if phase == 'storm' else 0)]
+            for t in threads:
+                t.start()
+            latencies = probe(base, seconds)
+            stop.set()
+            for t in threads:
+                t.join()
+            logins = ', '.join(f'{n} x {code}' for code, n in sorted(counts.items())) or '-'
+            print(f'{label:<14} {phase:<6} {len(latencies):>8} {percentile(latencies, 50):>7.1f} '
+                  f'{percentile(latencies, 95):>7.1f} {percentile(latencies, 99):>7.1f}   {logins}')
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--storm-threads', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=16, help='gunicorn threads, as in the Procfile')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        build(db_path)
+        print(f"{'hashing':<14} {'phase':<6} {'searches':>8} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7}   logins")
+        # with the search cache off every probe goes to the database
+        common = {'LIB_SEARCH_CACHE_SIZE': '0'}
+        run(db_path, 'inline', dict(common, LIB_HASH_WORKERS='0'), args.seconds, args.storm_threads, args.threads)
+        run(db_path, 'pool', common, args.seconds, args.storm_threads, args.threads)
+
+
+if __name__ == '__main__':
+    main()
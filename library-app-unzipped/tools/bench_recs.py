@@ -0,0 +1,91 @@
+"""The "also borrowed" recommendations (recs.py) over a large borrow history.
+
+Builds a database with synthetic borrows (default 10,000,000), then times:
+
+1. a full rebuild of the co-borrow matrix and the top-k table, with the
+   job's peak memory;
+2. an incremental run after a day's worth of new borrows, which is what a
+   scheduled run sees;
+3. lookups through the memory-mapped table, as the web workers do them, for
+   k = 3 and k = RECS_TOP_K.
+
+Usage: python tools/bench_recs.py [borrows] [--window N] [--db PATH]
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+import db as db_pool  # noqa: E402
+import recs  # noqa: E402
+from synthetic import build_database  # noqa: E402
+
+LOOKUPS = 100000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('borrows', nargs='?', type=int, default=10000000)
+    parser.add_argument('--students', type=int, default=20000)
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--new', type=int, default=10000, help='borrows added before the incremental run')
+    parser.add_argument('--window', type=int, default=None, help='RECS_WINDOW (default LIB_RECS_WINDOW)')
+    parser.add_argument('--db', help='reuse a database built by an earlier run instead of a temporary one')
+    args = parser.parse_args()
+    config = dict(db_pool.env_config(), **recs.env_config())
+    if args.window:
+        config['RECS_WINDOW'] = args.window
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.db or os.path.join(tmp, 'bench.db')
+        if not os.path.exists(path):
+            started = time.perf_counter()
+            build_database(path, books=args.books, students=args.students, borrows=args.borrows)
+            print(f'{args.borrows} borrows (built in {time.perf_counter() - started:.0f}s)')
+        out = os.path.join(tmp, 'recs')
+        conn = db_pool.connect(path, config)
+
+        started = time.perf_counter()
+        borrows, _ = recs.run(conn, config, out, rebuild=True)
+        elapsed = time.perf_counter() - started
+        m = recs.read_manifest(out)
+        size = sum(os.path.getsize(os.path.join(out, f)) for f in os.listdir(out))
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"full rebuild of {borrows} borrows, window {config['RECS_WINDOW']}: {elapsed:.1f}s"
+              f" ({borrows / elapsed:,.0f} borrows/s), {m['base_entries']:,} matrix entries,"
+              f' {size / 2 ** 20:.0f} MiB on disk, peak RSS {peak:.0f} MiB')
+
+        rnd = random.Random(1)
+        students = conn.execute('SELECT MAX(id) FROM students').fetchone()[0]
+        books = conn.execute('SELECT MAX(id) FROM books').fetchone()[0]
+        conn.executemany('INSERT INTO borrows (student_id, book_id, borrowed_at, borrowed_ts) VALUES (?, ?, ?, ?)',
+                         [(rnd.randint(1, students), rnd.randint(1, books), 'now', int(time.time()))
+                          for _ in range(args.new)])
+        conn.commit()
+        started = time.perf_counter()
+        borrows, _ = recs.run(conn, config, out)
+        m = recs.read_manifest(out)
+        print(f'incremental run, {borrows} new borrows: {time.perf_counter() - started:.2f}s'
+              f" (delta {m['delta_entries']:,} entries)")
+
+        reader = recs.Recommendations(out)
+        reader.refresh()
+        ids = [rnd.randint(1, books) for _ in range(LOOKUPS)]
+        for k in (3, config['RECS_TOP_K']):
+            started = time.perf_counter()
+            for book_id in ids:
+                reader.also_borrowed(book_id, k)
+            print(f'lookup, k={k}: {(time.perf_counter() - started) / LOOKUPS * 1e6:.1f} us')
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
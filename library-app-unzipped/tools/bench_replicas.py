@@ -0,0 +1,146 @@
+"""Search throughput as read replicas are added, and how far they trail.
+
+Simulates a host per replica on this machine: builds a synthetic primary,
+runs ``replica.py publish`` next to it, and for each count N in --replicas
+runs N hosts, each a ``replica.py follow`` process keeping its own replica
+file and a gunicorn serving /api/search from that file. Keeps --concurrency
+connections per host busy with searches for --seconds, and reports the
+total requests per second, the speed-up over one replica and latency
+percentiles. Then updates books on the primary and reports how long each
+change took to show up in the search results of every host.
+
+    python tools/bench_replicas.py --books 100000 --replicas 1,2,4
+
+The hosts share this machine's cores, so throughput can only grow with N up
+to the core count (printed first); the client loop takes a share of them too.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+import replica  # noqa: E402
+from bench_asgi import load, percentile, search_urls  # noqa: E402
+from bench_routes import start_gunicorn  # noqa: E402
+from synthetic import build_database  # noqa: E402
+
+
+def start_role(role, directory, interval, env):
+    return subprocess.Popen([sys.executable, 'replica.py', role, directory, '--interval', str(interval)],
+                            cwd=ROOT, env=dict(os.environ, **env))
+
+
+def wait_for(check, what, timeout=600):
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() > deadline:
+            raise RuntimeError(f'timed out waiting for {what}')
+        time.sleep(0.1)
+
+
+def replica_ready(path, max_lag):
+    try:
+        conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    except sqlite3.OperationalError:
+        return False
+    try:
+        return replica.fresh(conn, max_lag)
+    finally:
+        conn.close()
+
+
+def found(base, token):
+    # the exact title: close spellings of the previous check's token match too
+    with urllib.request.urlopen(f'{base}/api/search?q={token}', timeout=5) as resp:
+        return any(token in b['title'] for b in json.loads(resp.read())['results'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--books', type=int, default=100000)
+    parser.add_argument('--replicas', default='1,2,4')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers per host')
+    parser.add_argument('--concurrency', type=int, default=8, help='connections per host')
+    parser.add_argument('--seconds', type=float, default=15)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--interval', type=float, default=0.2, help='publish and follow interval in seconds')
+    parser.add_argument('--writes', type=int, default=10, help='changes timed for replication lag')
+    parser.add_argument('--db', help='reuse a database built by an earlier run instead of a temporary one')
+    args = parser.parse_args()
+    levels = [int(n) for n in args.replicas.split(',')]
+    urls = search_urls(random.Random(0), 5000)
+    print(f'{os.cpu_count()} CPU cores')
+
+    procs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db or os.path.join(tmp, 'primary.db')
+        if not os.path.exists(db_path):
+            started = time.perf_counter()
+            build_database(db_path, books=args.books, students=100, borrows=1000)
+            print(f'{args.books} books (built in {time.perf_counter() - started:.0f}s)')
+        published = os.path.join(tmp, 'published')
+        try:
+            procs.append(start_role('publish', published, args.interval, {'LIB_DB_PATH': db_path}))
+            wait_for(lambda: os.path.exists(os.path.join(published, replica.MANIFEST)), 'the first snapshot')
+            hosts = []
+            print(f"{'replicas':>8} {'req/s':>8} {'speed-up':>8} {'p50 ms':>8} {'p95 ms':>8} {'failed':>7}")
+            single = None
+            for n in levels:
+                while len(hosts) < n:
+                    path = os.path.join(tmp, f'replica-{len(hosts)}.db')
+                    # the cache would turn the repeated URLs into lookups; measure the queries
+                    env = {'LIB_REPLICA_PATH': path, 'LIB_SEARCH_CACHE_SIZE': '0'}
+                    procs.append(start_role('follow', published, args.interval, env))
+                    wait_for(lambda: replica_ready(path, 5), f'replica {len(hosts)}')
+                    proc, base = start_gunicorn(db_path, args.workers, env)
+                    procs.append(proc)
+                    hosts.append(base)
+
+                async def run_all():
+                    return await asyncio.gather(*(load(base, args.concurrency, args.seconds, args.timeout, urls)
+                                                  for base in hosts))
+
+                results = asyncio.run(run_all())
+                latencies = [t for by_kind, _, _ in results for kind in by_kind.values() for t in kind]
+                failures = sum(f for _, f, _ in results)
+                rate = len(latencies) / max(elapsed for _, _, elapsed in results)
+                single = single or rate / n
+                print(f'{n:>8} {rate:>8.1f} {rate / single:>7.2f}x {percentile(latencies, 50) * 1000:>8.1f}'
+                      f' {percentile(latencies, 95) * 1000:>8.1f} {failures:>7}')
+
+            conn = sqlite3.connect(db_path, isolation_level=None)
+            lags = []
+            for i in range(args.writes):
+                token = f'replicationcheck{i}x{random.randrange(10 ** 6)}'
+                conn.execute('UPDATE books SET title = ? WHERE id = ?', (f'Replication Check {token}', i + 1))
+                written = time.monotonic()
+                pending = set(hosts)
+                while pending:
+                    pending = {base for base in pending if not found(base, token)}
+                    time.sleep(0.01)
+                lags.append(time.monotonic() - written)
+            conn.close()
+            print(f'replication lag over {len(hosts)} hosts: median {statistics.median(lags) * 1000:.0f} ms,'
+                  f' max {max(lags) * 1000:.0f} ms (publish and follow every {args.interval}s)')
+        finally:
+            for proc in procs:
+                proc.terminate()
+            for proc in procs:
+                proc.wait()
+
+
+if __name__ == '__main__':
+    main()
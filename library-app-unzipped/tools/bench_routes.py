@@ -0,0 +1,358 @@
+"""Load test for every main route, with a saved baseline to catch regressions.
+
+Builds a synthetic database (sizes configurable up to millions of rows; see
+synthetic.build_database), then runs each scenario against either the Flask
+test client in this process or a real gunicorn server, and reports
+p50/p95/p99 latency and requests per second per scenario.
+
+    python tools/bench_routes.py --books 100000 --borrows 1000000 --save-baseline base.json
+    python tools/bench_routes.py --books 100000 --borrows 1000000 --baseline base.json
+
+With --baseline the run exits with status 1 when a scenario's p95 rose, or
+its req/s fell, by more than --tolerance (default 25%) against the saved run;
+p95 also has to rise by at least --min-delta-ms.
+Baselines only compare like with like: the sizes, driver, workers,
+concurrency and scenario list have to match.
+
+Sessions log in through the real forms, CSRF tokens included, so the same
+scenarios run unchanged against the test client and gunicorn.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import re
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+from synthetic import DEPARTMENTS, WORDS, build_database  # noqa: E402
+
+PASSWORD = 'bench-password'
+CSRF_RE = re.compile(r'name="csrf_token" value="([^"]+)"')
+# statuses a scenario may legitimately get back; anything else is an error
+OK_STATUSES = {200, 302, 304}
+
+
+class TestClientSession:
+    """One logged-in (or anonymous) user, driven through app.test_client()."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+        self.token = None
+
+    def request(self, method, url, data=None):
+        rv = self.client.open(url, method=method, data=data)
+        body = rv.get_data()
+        rv.close()
+        return rv.status_code, body
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpSession:
+    """One user talking HTTP to a running server, with its own cookie jar."""
+
+    def __init__(self, base):
+        self.base = base
+        self.token = None
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+
+    def request(self, method, url, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        req = urllib.request.Request(self.base + url, body, method=method)
+        try:
+            with self.opener.open(req, timeout=60) as rv:
+                return rv.status, rv.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+def login(session, form_url, data):
+    _, page = session.request('GET', form_url)
+    session.token = CSRF_RE.search(page.decode()).group(1)
+    status, _ = session.request('POST', form_url, dict(data, csrf_token=session.token))
+    if status != 302:
+        raise RuntimeError(f'login at {form_url} failed with {status}')
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def timed(self, name, session, method, url, data=None):
+        if data is not None and session.token:
+            data = dict(data, csrf_token=session.token)
+        start = time.perf_counter()
+        status, body = session.request(method, url, data)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.samples.setdefault(name, []).append(elapsed)
+            if status not in OK_STATUSES:
+                self.errors[name] = self.errors.get(name, 0) + 1
+        return status, body
+
+
+# Each scenario makes one or more timed requests as ``user`` ('anon',
+# 'student' or 'admin'); ``ctx`` holds ids picked from the database.
+
+def search_text(rec, session, rnd, ctx):
+    q = ' '.join(rnd.sample(WORDS, rnd.randint(1, 2)))
+    rec.timed('search_text', session, 'GET', '/api/search?q=' + urllib.parse.quote(q))
+
+
+def search_filter(rec, session, rnd, ctx):
+    year = rnd.randint(1970, 2020)
+    rec.timed('search_filter', session, 'GET',
+              f'/api/search?dept={rnd.choice(DEPARTMENTS)}&min_year={year}&max_year={year + 5}&available=1')
+
+
+def search_page2(rec, session, rnd, ctx):
+    url = '/api/search?q=' + rnd.choice(WORDS)
+    _, body = session.request('GET', url)
+    cursor = json.loads(body).get('next_cursor')
+    if cursor:
+        rec.timed('search_page2', session, 'GET', f'{url}&cursor={cursor}')
+
+
+def index_page(rec, session, rnd, ctx):
+    rec.timed('index', session, 'GET', '/')
+
+
+def student_dashboard(rec, session, rnd, ctx):
+    rec.timed('student_dashboard', session, 'GET', '/student/dashboard')
+
+
+def borrow_return(rec, session, rnd, ctx):
+    book_id = rnd.choice(ctx['books'])
+    rec.timed('borrow', session, 'POST', f'/student/borrow/{book_id}', {})
+    with ctx['db_lock']:
+        row = ctx['db'].execute('SELECT id FROM borrows WHERE student_id = ? AND returned_at IS NULL ORDER BY id DESC',
+                                (session.student_id,)).fetchone()
+    if row:
+        rec.timed('return', session, 'POST', f'/student/return/{row[0]}', {})
+
+
+def admin_dashboard(rec, session, rnd, ctx):
+    rec.timed('admin_dashboard', session, 'GET', '/admin')
+
+
+def admin_borrows(rec, session, rnd, ctx):
+    query = rnd.choice(['', '?status=active', '?status=overdue', '?status=returned',
+                        f'?student={rnd.choice(ctx["students"])}', '?from=2025-01-01&to=2025-03-31'])
+    rec.timed('admin_borrows', session, 'GET', '/admin/borrows' + query)
+
+
+SCENARIOS = {
+    'search_text': ('anon', search_text),
+    'search_filter': ('anon', search_filter),
+    'search_page2': ('anon', search_page2),
+    'index': ('anon', index_page),
+    'student_dashboard': ('student', student_dashboard),
+    'borrow_return': ('student', borrow_return),
+    'admin_borrows': ('admin', admin_borrows),
+    'admin_dashboard': ('admin', admin_dashboard),
+}
+
+
+def pick_context(db_path, sessions_needed):
+    db = sqlite3.connect(db_path, check_same_thread=False)
+    ctx = {
+        'db': db,
+        'db_lock': threading.Lock(),
+        'books': [r[0] for r in db.execute('SELECT id FROM books WHERE copies > 0 ORDER BY random() LIMIT 1000')],
+        # students with nothing out, so the borrow limit never refuses a bench borrow
+        'free_students': db.execute("SELECT id, email FROM students WHERE active_borrows = 0 AND email GLOB 'student[0-9]*'"
+                                    ' ORDER BY id LIMIT ?', (sessions_needed,)).fetchall(),
+        'students': [r[0] for r in db.execute('SELECT id FROM students ORDER BY random() LIMIT 100')],
+    }
+    return ctx
+
+
+def make_session(kind, new_session, ctx, index, admin_password):
+    session = new_session()
+    if kind == 'student':
+        session.student_id, email = ctx['free_students'][index]
+        login(session, '/student/login', {'email': email, 'password': PASSWORD})
+    elif kind == 'admin':
+        login(session, '/admin/login', {'password': admin_password})
+    return session
+
+
+def run_scenario(name, new_session, ctx, concurrency, requests, admin_password, seed):
+    kind, scenario = SCENARIOS[name]
+    sessions = [make_session(kind, new_session, ctx, i, admin_password) for i in range(concurrency)]
+    rec = Recorder()
+    per_thread = max(1, requests // concurrency)
+
+    def drive(i):
+        rnd = random.Random(seed * 1000 + i)
+        for _ in range(per_thread):
+            scenario(rec, sessions[i], rnd, ctx)
+
+    # one untimed pass warms caches and pools the way a running server has them
+    scenario(Recorder(), sessions[0], random.Random(seed), ctx)
+    threads = [threading.Thread(target=drive, args=(i,)) for i in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    results = {}
+    for op, samples in rec.samples.items():
+        ms = sorted(s * 1000 for s in samples)
+        cuts = statistics.quantiles(ms, n=100) if len(ms) > 1 else [ms[0]] * 99
+        results[op] = {'n': len(ms), 'errors': rec.errors.get(op, 0), 'rps': round(len(ms) / wall, 1),
+                       'p50': round(cuts[49], 2), 'p95': round(cuts[94], 2), 'p99': round(cuts[98], 2)}
+    return results
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(db_path, workers, env):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--bind', f'127.0.0.1:{port}',
+         '--log-level', 'warning', 'app:app'],
+        cwd=ROOT, env=dict(os.environ, LIB_DB_PATH=db_path, **env))
+    base = f'http://127.0.0.1:{port}'
+    for _ in range(200):
+        if proc.poll() is not None:
+            raise RuntimeError('gunicorn exited during startup')
+        try:
+            urllib.request.urlopen(base + '/api/search', timeout=1).read()
+            return proc, base
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError('gunicorn did not start')
+
+
+def compare(results, baseline, tolerance, min_delta_ms):
+    """Return the regressions of ``results`` against ``baseline`` as messages.
+
+    A latency regression has to clear both the relative tolerance and
+    ``min_delta_ms``, so jitter on millisecond routes does not fail a run.
+    """
+    problems = []
+    for op, old in baseline['results'].items():
+        new = results.get(op)
+        if new is None:
+            problems.append(f'{op}: missing from this run')
+            continue
+        if new['p95'] > old['p95'] * (1 + tolerance) and new['p95'] - old['p95'] > min_delta_ms:
+            problems.append(f"{op}: p95 {new['p95']:.1f} ms vs baseline {old['p95']:.1f} ms")
+        if new['rps'] < old['rps'] * (1 - tolerance):
+            problems.append(f"{op}: {new['rps']:.0f} req/s vs baseline {old['rps']:.0f} req/s")
+        if new['errors'] > old['errors']:
+            problems.append(f"{op}: {new['errors']} errors vs baseline {old['errors']}")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--books', type=int, default=20000)
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--borrows', type=int, default=100000)
+    parser.add_argument('--db', help='reuse a database built by an earlier run instead of building one')
+    parser.add_argument('--driver', choices=('testclient', 'gunicorn'), default='testclient')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--concurrency', type=int, default=1, help='simultaneous users per scenario')
+    parser.add_argument('--requests', type=int, default=200, help='iterations per scenario')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help='fail when this run regressed against the saved JSON')
+    parser.add_argument('--save-baseline', help='write this run as a baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--min-delta-ms', type=float, default=2.0,
+                        help='smallest p95 increase that counts as a regression')
+    args = parser.parse_args(argv)
+    names = [n for n in args.scenarios.split(',') if n]
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    config = {'books': args.books, 'students': args.students, 'borrows': args.borrows, 'driver': args.driver,
+              'workers': args.workers if args.driver == 'gunicorn' else None, 'concurrency': args.concurrency,
+              'requests': args.requests, 'scenarios': names}
+    admin_password = os.environ.get('LIB_ADMIN_PASS', 'rahul@123')
+    env = {'LIB_ADMIN_PASS': admin_password}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db or os.path.join(tmp, 'bench.db')
+        if not args.db or not os.path.exists(args.db):
+            started = time.perf_counter()
+            build_database(db_path, args.books, args.students, args.borrows, args.seed, PASSWORD)
+            print(f'built {args.books} books, {args.students} students, {args.borrows} borrows '
+                  f'in {time.perf_counter() - started:.0f}s')
+        ctx = pick_context(db_path, args.concurrency)
+        proc = None
+        if args.driver == 'gunicorn':
+            proc, base = start_gunicorn(db_path, args.workers, env)
+            new_session = lambda: HttpSession(base)  # noqa: E731
+        else:
+            os.environ['LIB_DB_PATH'] = db_path
+            import app as app_module
+            app = app_module.create_app({'DB_PATH': db_path})
+            new_session = lambda: TestClientSession(app)  # noqa: E731
+        try:
+            results = {}
+            for name in names:
+                results.update(run_scenario(name, new_session, ctx, args.concurrency, args.requests,
+                                            admin_password, args.seed))
+        finally:
+            if proc is not None:
+                proc.terminate()
+                proc.wait()
+            ctx['db'].close()
+
+    print(f"{'operation':<18} {'n':>6} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for op, r in results.items():
+        print(f"{op:<18} {r['n']:>6} {r['errors']:>6} {r['rps']:>8.1f} {r['p50']:>8.2f} {r['p95']:>8.2f} {r['p99']:>8.2f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'config': config, 'results': results}, f, indent=2, sort_keys=True)
+        print(f'baseline written to {args.save_baseline}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != config:
+            print(f"baseline {args.baseline} was recorded with {baseline['config']}, this run is {config}")
+            return 2
+        problems = compare(results, baseline, args.tolerance, args.min_delta_ms)
+        for p in problems:
+            print('REGRESSION ' + p)
+        if problems:
+            return 1
+        print(f'no regressions against {args.baseline} (tolerance {args.tolerance:.0%})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""Compare the FTS5 search path with the old LIKE scan.
+
+Usage: python tools/bench_search.py [rows ...]   (default: 10000 100000 1000000)
+"""
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / 'tools'))
+
+import create_db  # noqa: E402
+from app import fts_query  # noqa: E402
+from synthetic import book_rows  # noqa: E402
+
+QUERIES = ['tanenbaum', 'operating systems', 'compil', 'distributed algorithms', '100000123']
+REPEAT = 20
+
+LIKE_SQL = ("SELECT id, title, author, year, isbn, copies, department FROM books"
+            " WHERE (title LIKE ? OR author LIKE ? OR isbn LIKE ? ) ORDER BY title LIMIT 200")
+FTS_SQL = ("SELECT b.id, b.title, b.author, b.year, b.isbn, b.copies, b.department"
+           " FROM books_fts JOIN books b ON b.id = books_fts.rowid WHERE books_fts MATCH ?"
+           " ORDER BY bm25(books_fts, 10.0, 5.0, 1.0), b.title LIMIT 200")
+
+
+def build(path, n):
+    conn = create_db.connect(path)
+    create_db.migrate(conn)
+    conn.execute('BEGIN')
+    conn.executemany('INSERT INTO books (title,author,year,isbn,copies,department) VALUES (?,?,?,?,?,?)',
+                     book_rows(n))
+    conn.execute('COMMIT')
+    return conn
+
+
+def timed(conn, sql, params):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        conn.execute(sql, params).fetchall()
+    return (time.perf_counter() - start) / REPEAT * 1000
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]
+    print(f"{'rows':>9} {'query':<24} {'LIKE ms':>9} {'FTS ms':>9} {'speedup':>8}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = build(os.path.join(tmp, 'bench.db'), n)
+            for q in QUERIES:
+                like = f'%{q}%'
+                t_like = timed(conn, LIKE_SQL, (like, like, like))
+                t_fts = timed(conn, FTS_SQL, (fts_query(q),))
+                print(f'{n:>9} {q:<24} {t_like:>9.2f} {t_fts:>9.2f} {t_like / t_fts:>7.1f}x')
+            conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Synthetic catalog data for the benchmark scripts in tools/."""
+import random
+import time
+from datetime import datetime, timezone
+
+WORDS = ('algorithms data structures systems database operating networks compiler design '
+         'linear algebra discrete mathematics probability statistics machine learning '
+         'artificial intelligence modern introduction principles applications analysis '
+         'theory computation distributed parallel software engineering security graphics '
+         'calculus physics chemistry circuits signals control digital embedded').split()
+SURNAMES = ('Cormen Martin Strang Silberschatz Russell Norvig Rosen Tanenbaum Aho Ullman '
+            'Hoffer Knuth Sedgewick Kernighan Ritchie Stroustrup Patterson Hennessy Sipser '
+            'Bishop Goodfellow Mitchell Feller Apostol Spivak Halliday Oppenheim Ogata').split()
+DEPARTMENTS = ('CSE', 'Math', 'ECE', 'EEE', 'Physics', 'Chemistry', 'Mechanical', 'Civil')
+
+
+ONSETS = 'b br c ch d dr f g gr h j k kr l m n p pr r s sch st t tr v w z'.split()
+VOWELS = 'a e i o u y ai au ei ie oa ou'.split()
+CODAS = [''] + 'n r s l m k t x rt nd ng ck st'.split()
+
+
+def made_up_surnames(n, seed=0):
+    """``n`` distinct invented surnames, for a vocabulary the size of a real catalogue's.
+
+    Syllables are drawn at random from onset, vowel and coda parts, so
+    letters combine about as variously as in real names.
+    """
+    rnd = random.Random(seed)
+    names = set()
+    while len(names) < n:
+        names.add(''.join(rnd.choice(ONSETS) + rnd.choice(VOWELS) + rnd.choice(CODAS)
+                          for _ in range(rnd.randint(2, 3))).title())
+    return sorted(names)
+
+
+def book_rows(n, seed=0, surnames=0):
+    """Yield ``n`` (title, author, year, isbn, copies, department) tuples; authors
+    come from SURNAMES plus ``surnames`` made-up ones."""
+    rnd = random.Random(seed)
+    pool = SURNAMES + made_up_surnames(surnames, seed) if surnames else SURNAMES
+    for i in range(n):
+        title = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 5))).title()
+        author = ', '.join(rnd.choice(pool) for _ in range(rnd.randint(1, 3)))
+        yield (title, author, rnd.randint(1970, 2024), '%010d' % (1000000000 + i),
+               rnd.randint(0, 5), rnd.choice(DEPARTMENTS))
+
+
+def student_rows(n, password_hash='x'):
+    """Yield ``n`` (name, email, password_hash) tuples; the hash is a placeholder."""
+    for i in range(n):
+        yield f'Student {i}', f'student{i}@example.com', password_hash
+
+
+def borrow_rows(n, students, books, now, seed=0, years=3, open_share=0.02, loan_days=14):
+    """Yield ``n`` borrows, oldest first, spread over the ``years`` before ``now``.
+
+    Tuples are (student_id, book_id, borrowed_at, returned_at, borrowed_ts,
+    returned_ts, due_ts); about ``open_share`` of them are still out, and
+    returns come up to 30 days after the borrow, so about half are late.
+    """
+    rnd = random.Random(seed)
+    start = now - years * 365 * 86400
+    step = (now - start) / n
+    for i in range(n):
+        borrowed = int(start + i * step)
+        returned = None
+        if rnd.random() >= open_share:
+            returned = min(now, borrowed + rnd.randint(3600, 30 * 86400))
+        yield (rnd.randint(1, students), rnd.randint(1, books), iso(borrowed),
+               iso(returned) if returned else None, borrowed, returned, borrowed + loan_days * 86400)
+
+
+def iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+def build_database(path, books=10000, students=1000, borrows=100000, seed=0, password='bench-password', surnames=0):
+    """Create a migrated database at ``path`` holding the synthetic rows.
+
+    Students are student<i>@example.com, all with ``password``. Books go in
+    with the FTS triggers suspended and are indexed in one statement, as a
+    bulk import does, so millions of rows load in minutes. ``surnames`` adds
+    that many made-up author names (see book_rows).
+    """
+    import catalog_io
+    import create_db
+    from werkzeug.security import generate_password_hash
+
+    conn = create_db.connect(path)
+    create_db.migrate(conn)
+    conn.execute('BEGIN IMMEDIATE')
+    saved = catalog_io.suspend_triggers(conn)
+    last_id = conn.execute('SELECT MAX(id) FROM books').fetchone()[0] or 0
+    conn.executemany('INSERT INTO books (title,author,year,isbn,copies,department) VALUES (?,?,?,?,?,?)',
+                     book_rows(books, seed, surnames))
+    conn.execute('INSERT INTO books_fts(rowid, title, author, isbn) SELECT id, title, author, isbn FROM books WHERE id > ?',
+                 (last_id,))
+    create_db.adjust_facet_counts(conn, 'books.id > ?', (last_id,))
+    create_db.adjust_search_terms(conn, 'books.id > ?', (last_id,))
+    create_db.adjust_analytics_departments(conn, 'books.id > ?', (last_id,))
+    catalog_io.restore_triggers(conn, saved)
+    conn.executemany('INSERT INTO students (name, email, password_hash) VALUES (?,?,?)',
+                     student_rows(students, generate_password_hash(password)))
+    total_students = conn.execute('SELECT MAX(id) FROM students').fetchone()[0]
+    total_books = conn.execute('SELECT MAX(id) FROM books').fetchone()[0]
+    conn.executemany('INSERT INTO borrows (student_id, book_id, borrowed_at, returned_at, borrowed_ts, returned_ts, due_ts)'
+                     ' VALUES (?,?,?,?,?,?,?)', borrow_rows(borrows, total_students, total_books, int(time.time()), seed))
+    create_db.repair_active_borrows(conn)
+    conn.execute('COMMIT')
+    conn.execute('ANALYZE')
+    conn.close()